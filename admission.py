@@ -0,0 +1,216 @@
+import asyncio
+import math
+import os
+import re
+import time
+from collections import OrderedDict, deque
+from starlette.requests import HTTPConnection
+from starlette.responses import JSONResponse
+
+# Sustained requests per second and burst allowed per session and per client
+# IP on the rate-limited routes; a rate of 0 turns that limit off
+SESSION_RATE = float(os.environ.get("EHOSPITAL_SESSION_RATE", "1"))
+SESSION_BURST = float(os.environ.get("EHOSPITAL_SESSION_BURST", "10"))
+IP_RATE = float(os.environ.get("EHOSPITAL_IP_RATE", "20"))
+IP_BURST = float(os.environ.get("EHOSPITAL_IP_BURST", "60"))
+
+# Chat turns run at once per process, turns allowed to wait for one, and how
+# long (seconds) they wait before being shed; 0 active turns the limit off
+MAX_ACTIVE_CHATS = int(os.environ.get("EHOSPITAL_MAX_ACTIVE_CHATS", "16"))
+CHAT_QUEUE = int(os.environ.get("EHOSPITAL_CHAT_QUEUE", "64"))
+CHAT_QUEUE_WAIT = float(os.environ.get("EHOSPITAL_CHAT_QUEUE_WAIT", "2"))
+
+# Buckets kept per limiter before the least recently used are dropped
+MAX_BUCKETS = 100_000
+
+# Routes that can start remote fetches, speech synthesis or recognition:
+# all of them are rate limited, and chat turns also take a concurrency slot.
+# Speech recognition already sheds with 503 when its own queue is full.
+RATE_LIMITED = re.compile(r"^/(chat|login|speech|speech/stream|speech/[^/]+/finish)$")
+CONCURRENCY_LIMITED = re.compile(r"^/chat$")
+
+# Raised when a request is not admitted; retry_after is in seconds
+class Rejected(Exception):
+    def __init__(self, status_code, reason, retry_after):
+        super().__init__(reason)
+        self.status_code = status_code
+        self.reason = reason
+        self.retry_after = retry_after
+
+    # Whole seconds, as Retry-After wants them
+    def retry_seconds(self):
+        return max(1, math.ceil(self.retry_after))
+
+    def headers(self):
+        return {"Retry-After": str(self.retry_seconds())}
+
+# Token buckets by key: each key earns rate tokens per second up to burst,
+# and a request spends one. Only the least recently used keys are kept.
+class RateLimiter:
+    def __init__(self, rate, burst, max_keys=MAX_BUCKETS):
+        self.rate = rate
+        self.burst = burst
+        self.max_keys = max_keys
+        self._buckets = OrderedDict()  # key -> (tokens, updated)
+
+    # Spend a token for key; returns 0 if admitted, else the seconds until one is earned
+    def take(self, key):
+        if self.rate <= 0 or key is None:
+            return 0
+        now = time.monotonic()
+        tokens, updated = self._buckets.pop(key, (self.burst, now))
+        tokens = min(self.burst, tokens + (now - updated) * self.rate)
+        wait = 0
+        if tokens >= 1:
+            tokens -= 1
+        else:
+            wait = (1 - tokens) / self.rate
+        self._buckets[key] = (tokens, now)
+        if len(self._buckets) > self.max_keys:
+            self._buckets.popitem(last=False)
+        return wait
+
+    def __len__(self):
+        return len(self._buckets)
+
+# At most limit holders at once; up to max_queue more wait in arrival order
+# for max_wait seconds, and the rest are shed straight away. Used from one
+# event loop, like the rest of the app's per-process state.
+class ConcurrencyLimiter:
+    def __init__(self, limit, max_queue, max_wait):
+        self.limit = limit
+        self.max_queue = max_queue
+        self.max_wait = max_wait
+        self.active = 0
+        self._waiters = deque()
+        self._hold = 0.05  # moving average of seconds a slot is held, for Retry-After
+        self.stats = {"queued": 0, "queue_full": 0, "queue_timeouts": 0, "queue_wait_seconds": 0.0}
+
+    @property
+    def waiting(self):
+        return len(self._waiters)
+
+    # Seconds until the queue ahead of a new request has likely drained
+    def retry_after(self):
+        return self._hold * (len(self._waiters) + 1) / max(1, self.limit)
+
+    async def acquire(self):
+        if self.limit <= 0:
+            return
+        if self.active < self.limit and not self._waiters:
+            self.active += 1
+            return
+        if len(self._waiters) >= self.max_queue:
+            self.stats["queue_full"] += 1
+            raise Rejected(503, "overloaded", self.retry_after())
+        self.stats["queued"] += 1
+        waiter = asyncio.get_running_loop().create_future()
+        self._waiters.append(waiter)
+        start = time.perf_counter()
+        try:
+            await asyncio.wait({waiter}, timeout=self.max_wait)
+        except asyncio.CancelledError:
+            self._abandon(waiter)
+            raise
+        finally:
+            self.stats["queue_wait_seconds"] += time.perf_counter() - start
+        if not waiter.done():
+            self._abandon(waiter)
+            self.stats["queue_timeouts"] += 1
+            raise Rejected(503, "overloaded", self.retry_after())
+
+    # Leave the queue; a slot handed over meanwhile is passed on
+    def _abandon(self, waiter):
+        if waiter.done() and not waiter.cancelled():
+            self.release()
+            return
+        waiter.cancel()
+        try:
+            self._waiters.remove(waiter)
+        except ValueError:
+            pass
+
+    # Hand the slot to the longest waiting request, or free it
+    def release(self, held=None):
+        if self.limit <= 0:
+            return
+        if held is not None:
+            self._hold += (held - self._hold) * 0.1
+        while self._waiters:
+            waiter = self._waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)
+                return
+        self.active -= 1
+
+# Admission control for one process: session and client IP token buckets on
+# the rate-limited routes, then a concurrency slot for chat turns. Requests
+# over a rate get 429, requests that find the chat queue full or wait too
+# long get 503, both with Retry-After.
+class Admission:
+    def __init__(self, session_rate=SESSION_RATE, session_burst=SESSION_BURST, ip_rate=IP_RATE,
+                 ip_burst=IP_BURST, max_active=MAX_ACTIVE_CHATS, max_queue=CHAT_QUEUE, max_wait=CHAT_QUEUE_WAIT):
+        self.sessions = RateLimiter(session_rate, session_burst)
+        self.ips = RateLimiter(ip_rate, ip_burst)
+        self.chats = ConcurrencyLimiter(max_active, max_queue, max_wait)
+        self._stats = {"admitted": 0, "shed_session_rate": 0, "shed_ip_rate": 0, "shed_overload": 0}
+
+    # Spend a token of the session's and the client's buckets, or raise Rejected
+    def check_rate(self, session_id, client_ip):
+        wait = self.sessions.take(session_id)
+        if wait:
+            self._stats["shed_session_rate"] += 1
+            raise Rejected(429, "rate_limited", wait)
+        wait = self.ips.take(client_ip)
+        if wait:
+            self._stats["shed_ip_rate"] += 1
+            raise Rejected(429, "rate_limited", wait)
+
+    async def acquire(self):
+        try:
+            await self.chats.acquire()
+        except Rejected:
+            self._stats["shed_overload"] += 1
+            raise
+
+    def admitted(self):
+        self._stats["admitted"] += 1
+
+    def stats(self):
+        stats = dict(self._stats, **self.chats.stats)
+        stats.update(active=self.chats.active, waiting=self.chats.waiting,
+                     session_buckets=len(self.sessions), ip_buckets=len(self.ips))
+        return stats
+
+admission = Admission()
+
+# ASGI middleware applying admission to HTTP requests before they reach the
+# router, so shed requests cost no body parsing or session load
+class AdmissionMiddleware:
+    def __init__(self, app, admission=admission):
+        self.app = app
+        self.admission = admission
+
+    async def __call__(self, scope, receive, send):
+        path = scope.get("path", "")
+        if scope["type"] != "http" or scope["method"] != "POST" or not RATE_LIMITED.match(path):
+            await self.app(scope, receive, send)
+            return
+        connection = HTTPConnection(scope)
+        client_ip = connection.client.host if connection.client else None
+        limited = CONCURRENCY_LIMITED.match(path)
+        try:
+            self.admission.check_rate(connection.cookies.get("session_id"), client_ip)
+            if limited:
+                await self.admission.acquire()
+        except Rejected as e:
+            response = JSONResponse(status_code=e.status_code, content={"status": e.reason}, headers=e.headers())
+            await response(scope, receive, send)
+            return
+        self.admission.admitted()
+        start = time.perf_counter()
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            if limited:
+                self.admission.chats.release(time.perf_counter() - start)
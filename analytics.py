@@ -0,0 +1,213 @@
+import os
+import threading
+from functools import lru_cache
+
+# Exports of the patients_analysis table; later files win for a patient_id
+ANALYSIS_FILES = ("data/patients_analysis (2).csv", "data/patients_analysis (3).csv")
+
+# Numeric columns served by the analytics endpoints
+METRICS = (
+    "age", "height", "weight", "chestpain", "restingBP", "serum_cholesterol", "fastingbloodsugar",
+    "restingrelectro", "maxheartrate", "exerciseangia", "oldpeak", "slope", "noofmajorvessels", "target",
+)
+
+PERCENTILES = (5, 25, 50, 75, 95)
+
+# Width in years of the age group a patient is compared against
+AGE_BAND = 10
+
+# Filtered columns (one per metric and filter) kept for reuse
+CACHE_SIZE = 512
+
+class UnknownMetric(ValueError):
+    pass
+
+class UnknownPatient(LookupError):
+    pass
+
+# Smallest dtype per column: integers without gaps become int8/16/32, columns
+# with missing values or fractions become float32, gender becomes a category
+def downcast(frame):
+    import pandas as pd
+    for column in frame.columns:
+        if column == "gender":
+            frame[column] = frame[column].astype(str).str.strip().str.title().astype("category")
+            continue
+        values = frame[column]
+        if values.dtype.kind not in "iuf":
+            values = pd.to_numeric(values, errors="coerce")
+        if values.dtype.kind in "iu" or (values.notna().all() and (values % 1 == 0).all()):
+            frame[column] = pd.to_numeric(values, downcast="integer")
+        else:
+            frame[column] = values.astype("float32")
+    return frame
+
+def read_analysis_csv(path):
+    import pandas as pd
+    return pd.read_csv(path, usecols=["patient_id", "gender", *METRICS], keep_default_na=False, na_values=[""])
+
+# Column store of the patients_analysis exports for cohort questions.
+#
+# The CSVs are read once (and again only when a file changes) into downcast
+# columns. Queries select a cohort with vectorized masks; the sorted, NaN-free
+# values of each (metric, gender, age range) cohort are cached, so a repeated
+# filter costs a binary search or a slice instead of a scan. numpy and pandas
+# are imported by the methods that use them, so importing the app does not
+# load them until the first analytics request.
+class PatientAnalytics:
+    def __init__(self, paths=ANALYSIS_FILES):
+        self.paths = paths
+        self.frame = None
+        self._fingerprint = None
+        self._lock = threading.Lock()
+        self._reset_caches()
+
+    @classmethod
+    def from_frame(cls, frame):
+        analytics = cls(paths=())
+        analytics._set_frame(downcast(frame.copy()))
+        analytics._fingerprint = ()
+        return analytics
+
+    def _reset_caches(self):
+        self._cohort_values = lru_cache(maxsize=CACHE_SIZE)(self._cohort_values_uncached)
+        self._distribution = lru_cache(maxsize=CACHE_SIZE)(self._distribution_uncached)
+
+    def _set_frame(self, frame):
+        frame = frame.drop_duplicates("patient_id", keep="last").sort_values("patient_id").reset_index(drop=True)
+        self.frame = frame
+        self._patient_ids = frame["patient_id"].to_numpy(dtype="int64")
+        self._columns = {metric: frame[metric].to_numpy() for metric in METRICS}
+        self._ages = self._columns["age"].astype("float32")
+        self._genders = frame["gender"].cat.codes.to_numpy()
+        self._gender_names = list(frame["gender"].cat.categories)
+        self._gender_codes = {name: code for code, name in enumerate(self._gender_names)}
+        self._reset_caches()
+
+    # Load or reload the CSVs if any of them changed since the last load
+    def refresh(self):
+        fingerprint = tuple((path, os.stat(path).st_mtime_ns) for path in self.paths if os.path.exists(path))
+        if fingerprint == self._fingerprint:
+            return
+        with self._lock:
+            if fingerprint == self._fingerprint:
+                return
+            import pandas as pd
+            frames = [read_analysis_csv(path) for path, _ in fingerprint]
+            frame = pd.concat(frames, ignore_index=True) if frames else pd.DataFrame(columns=["patient_id", "gender", *METRICS])
+            self._set_frame(downcast(frame))
+            self._fingerprint = fingerprint
+
+    def _column(self, metric):
+        if metric not in self._columns:
+            raise UnknownMetric(f"Unknown metric: {metric}")
+        return self._columns[metric]
+
+    # Sorted values of metric for one cohort, without missing values
+    def _cohort_values_uncached(self, metric, gender, age_min, age_max):
+        import numpy as np
+        values = self._column(metric)
+        mask = np.ones(len(values), dtype=bool)
+        if gender is not None:
+            mask &= self._genders == self._gender_codes.get(gender, -2)
+        if age_min is not None:
+            mask &= self._ages >= age_min
+        if age_max is not None:
+            mask &= self._ages <= age_max
+        values = values[mask]
+        if values.dtype.kind == "f":
+            values = values[~np.isnan(values)]
+        values = np.sort(values)
+        values.flags.writeable = False
+        return values
+
+    def cohort_values(self, metric, gender=None, age_min=None, age_max=None):
+        self.refresh()
+        gender = gender.strip().title() if gender else None
+        return self._cohort_values(metric, gender, age_min, age_max)
+
+    def summary(self, metric, gender=None, age_min=None, age_max=None):
+        values = self.cohort_values(metric, gender, age_min, age_max)
+        if not len(values):
+            return {"count": 0}
+        return {
+            "count": int(len(values)),
+            "mean": float(values.mean(dtype="float64")),
+            "std": float(values.std(dtype="float64")),
+            "min": float(values[0]),
+            "max": float(values[-1]),
+        }
+
+    def _distribution_uncached(self, metric, gender, age_min, age_max, bins):
+        import numpy as np
+        values = self._cohort_values(metric, gender, age_min, age_max)
+        if not len(values):
+            return {"edges": [], "counts": []}
+        counts, edges = np.histogram(values.astype("float64"), bins=bins)
+        return {"edges": edges.tolist(), "counts": counts.tolist()}
+
+    def distribution(self, metric, gender=None, age_min=None, age_max=None, bins=20):
+        self.refresh()
+        gender = gender.strip().title() if gender else None
+        result = dict(self._distribution(metric, gender, age_min, age_max, bins))
+        result.update(self.summary(metric, gender, age_min, age_max))
+        return result
+
+    def percentiles(self, metric, q=PERCENTILES, gender=None, age_min=None, age_max=None):
+        import numpy as np
+        values = self.cohort_values(metric, gender, age_min, age_max)
+        if not len(values):
+            return {"count": 0, "percentiles": {}}
+        # values are sorted, so interpolate directly instead of letting np.percentile partition again
+        ranks = np.asarray(q, dtype="float64") / 100 * (len(values) - 1)
+        low = np.floor(ranks).astype(int)
+        high = np.minimum(low + 1, len(values) - 1)
+        points = values[low] + (values[high].astype("float64") - values[low]) * (ranks - low)
+        return {"count": int(len(values)), "percentiles": {f"{p:g}": float(v) for p, v in zip(q, points)}}
+
+    # Where a patient's value falls among patients of the same gender and age group
+    def patient_percentile(self, patient_id, metric, age_band=AGE_BAND):
+        import numpy as np
+        self.refresh()
+        column = self._column(metric)
+        # Search with the array's own dtype; a Python int would make numpy cast the whole array
+        try:
+            position = np.searchsorted(self._patient_ids, np.int64(patient_id))
+        except OverflowError:
+            raise UnknownPatient(f"No analysis record for patient {patient_id}")
+        if position >= len(self._patient_ids) or self._patient_ids[position] != patient_id:
+            raise UnknownPatient(f"No analysis record for patient {patient_id}")
+        value = column[position]
+        age = self._ages[position]
+        gender_code = self._genders[position]
+        gender = self._gender_names[gender_code] if gender_code >= 0 else None
+        age_min = int(age // age_band * age_band) if not np.isnan(age) else None
+        age_max = age_min + age_band - 1 if age_min is not None else None
+        cohort = {"gender": gender, "age_min": age_min, "age_max": age_max}
+        if np.isnan(float(value)):
+            return {"patient_id": int(patient_id), "metric": metric, "value": None, "percentile": None, "cohort": cohort}
+        values = self._cohort_values(metric, gender, age_min, age_max)
+        # Mid-rank: values below count fully, ties count half
+        below = np.searchsorted(values, value, side="left")
+        through = np.searchsorted(values, value, side="right")
+        cohort["count"] = int(len(values))
+        return {
+            "patient_id": int(patient_id),
+            "metric": metric,
+            "value": float(value),
+            "percentile": float((below + through) / 2 / len(values) * 100),
+            "cohort": cohort,
+        }
+
+    def stats(self):
+        self.refresh()
+        info = self._cohort_values.cache_info()
+        return {
+            "rows": int(len(self.frame)),
+            "memory_bytes": int(self.frame.memory_usage(deep=True).sum()),
+            "cache_hits": info.hits,
+            "cache_misses": info.misses,
+            "cached_cohorts": info.currsize,
+        }
+
+analytics = PatientAnalytics()
@@ -1,9 +1,26 @@
 
+import gzip
+import hashlib
+import json
+import math
 import sqlite3
-import pandas as pd
-from flask import Flask, request, jsonify, render_template
+from concurrent.futures import TimeoutError as WriteTimeout, wait
+from datetime import datetime, timezone
+from flask import Flask, request, jsonify, render_template, Response, stream_with_context, make_response
 from flask_session import Session
 from flasgger import Swagger
+from db import pool, file_lock
+from message_queue import message_writer
+from analytics import analytics, METRICS, PERCENTILES, UnknownMetric, UnknownPatient
+from search import search, build_search_index, InvalidQuery, SEARCH_LIMIT
+from response_cache import resource_version
+import inbox
+
+# brotli is optional; without it responses are offered gzip only
+try:
+    import brotli
+except ImportError:
+    brotli = None
 
 app = Flask(__name__)
 app.config['SESSION_TYPE'] = 'filesystem'
@@ -16,24 +33,193 @@ app.config['SWAGGER'] = {
 }
 swagger = Swagger(app)
 
-# Database connection helper
-def get_db_connection():
-    conn = sqlite3.connect('database.db')
-    conn.row_factory = sqlite3.Row
-    return conn
+# Default and maximum page sizes for the list endpoints
+PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1000
+
+# Rows streamed per fetch in NDJSON mode
+STREAM_BATCH = 500
+
+# Seconds a caller waits for its message to be committed
+WRITE_TIMEOUT = 10
+
+# Retry-After of a write that was not committed within WRITE_TIMEOUT
+WRITE_RETRY_AFTER = 5
+
+# Largest histogram the distribution endpoint builds
+MAX_BINS = 200
+
+# Seconds between keep-alive comments on an idle change feed stream
+FEED_KEEPALIVE = 15
+
+# JSON bodies smaller than this are sent uncompressed
+COMPRESS_MIN_SIZE = 1024
+
+# Fast settings: the bodies are generated per request, not stored
+GZIP_LEVEL = 5
+BROTLI_QUALITY = 4
+
+# Values a message field may hold: text or a whole number
+def _scalar(value):
+    return value is None or isinstance(value, (str, int)) and not isinstance(value, bool)
+
+# Row tuple for the message writer, or None if a required field is missing
+# or a field is not text or a number
+def message_row(data):
+    if not isinstance(data, dict) or any(data.get(key) in (None, '') for key in ('patient_id', 'doctor_id', 'message')):
+        return None
+    if not all(_scalar(data.get(key)) for key in ('patient_id', 'doctor_id', 'patient_FName', 'patient_LName', 'message')):
+        return None
+    return (data['patient_id'], data['doctor_id'], data.get('patient_FName'), data.get('patient_LName'), data['message'])
+
+# Columns clients may select per table; passwords are never served
+COLUMNS = {
+    'patients': ['id', 'uuid', 'Age', 'Gender', 'FName', 'LName', 'EmailId'],
+    'messages': ['id', 'patient_id', 'doctor_id', 'doctor_FName', 'doctor_LName', 'patient_FName',
+                 'patient_LName', 'message', 'time_sent', 'time_stamp'],
+    'patients_treatment': ['id', 'patient_id', 'doctor_id', 'treatment', 'RecordDate', 'disease_type', 'disease_id'],
+}
+
+# List rows of a table with keyset pagination (cursor + limit), optional column
+# projection and an optional NDJSON streaming mode
+def list_rows(table, where="1 = 1", params=()):
+    allowed = COLUMNS[table]
+    fields = request.args.get('fields')
+    if fields:
+        columns = [c.strip() for c in fields.split(',') if c.strip()]
+        unknown = [c for c in columns if c not in allowed]
+        if unknown:
+            return jsonify({"error": f"Unknown fields: {', '.join(unknown)}", "allowed": allowed}), 400
+        if 'id' not in columns:
+            columns.insert(0, 'id')
+    else:
+        columns = allowed
+    try:
+        cursor = int(request.args.get('cursor', 0))
+        limit = request.args.get('limit')
+        limit = min(int(limit), MAX_PAGE_SIZE) if limit is not None else None
+    except ValueError:
+        return jsonify({"error": "cursor and limit must be integers"}), 400
+    if limit is not None and limit < 1:
+        return jsonify({"error": "limit must be positive"}), 400
+    streaming = request.args.get('format') == 'ndjson'
+    if limit is None and not streaming:
+        limit = PAGE_SIZE
+
+    sql = f"SELECT {', '.join(columns)} FROM {table} WHERE {where} AND id > ? ORDER BY id"
+    params = tuple(params) + (cursor,)
+    if limit is not None:
+        sql += " LIMIT ?"
+        params += (limit,)
+
+    if streaming:
+        def generate():
+            with pool.connection() as conn:
+                rows = conn.execute(sql, params)
+                while True:
+                    batch = rows.fetchmany(STREAM_BATCH)
+                    if not batch:
+                        break
+                    yield ''.join(json.dumps(dict(row)) + '\n' for row in batch)
+        return Response(stream_with_context(generate()), mimetype='application/x-ndjson')
+
+    with pool.connection() as conn:
+        rows = conn.execute(sql, params).fetchall()
+    response = jsonify([dict(row) for row in rows])
+    if len(rows) == limit:
+        response.headers['X-Next-Cursor'] = str(rows[-1]['id'])
+    return response
+
+# list_rows behind validators from the resource's version counter: the
+# ETag covers the version and the query string, so If-None-Match (or
+# If-Modified-Since) is answered with 304 without reading any rows. The
+# version is read before the rows, so a write in between can only make the
+# ETag older than the body, which costs the client one more full response.
+def conditional_rows(resource, scope, table, where="1 = 1", params=()):
+    version = resource_version(resource, scope)
+    if version is None:
+        return list_rows(table, where, params)
+    number, changed_at = version
+    key = f"{resource}:{scope}:{number}:{changed_at}:{request.full_path}"
+    etag = hashlib.blake2b(key.encode('utf-8'), digest_size=12).hexdigest()
+    last_modified = datetime.fromtimestamp(int(changed_at), timezone.utc) if changed_at else None
+    if request.if_none_match:
+        fresh = request.if_none_match.contains_weak(etag)
+    else:
+        fresh = bool(last_modified and request.if_modified_since and last_modified <= request.if_modified_since)
+    response = Response(status=304) if fresh else make_response(list_rows(table, where, params))
+    if response.status_code in (200, 304):
+        # Weak: the same ETag is served for gzip, brotli and identity bodies
+        response.set_etag(etag, weak=True)
+        if last_modified:
+            response.last_modified = last_modified
+        response.headers['Cache-Control'] = 'private, no-cache'
+        response.vary.add('Accept-Encoding')
+    return response
+
+# Encoding to compress a response with, from the client's Accept-Encoding
+def negotiate_encoding():
+    encodings = ['br', 'gzip'] if brotli is not None else ['gzip']
+    quality = {encoding: request.accept_encodings.quality(encoding) for encoding in encodings}
+    best = max(encodings, key=lambda encoding: quality[encoding])
+    return best if quality[best] > 0 else None
+
+# Compress complete JSON bodies of COMPRESS_MIN_SIZE bytes or more; streamed
+# responses (NDJSON, change feeds) are sent as produced
+@app.after_request
+def compress_response(response):
+    if (response.status_code != 200 or response.is_streamed or response.direct_passthrough
+            or response.mimetype != 'application/json' or 'Content-Encoding' in response.headers):
+        return response
+    response.vary.add('Accept-Encoding')
+    body = response.get_data()
+    if len(body) < COMPRESS_MIN_SIZE:
+        return response
+    encoding = negotiate_encoding()
+    if encoding == 'br':
+        response.set_data(brotli.compress(body, quality=BROTLI_QUALITY))
+    elif encoding == 'gzip':
+        response.set_data(gzip.compress(body, compresslevel=GZIP_LEVEL))
+    else:
+        return response
+    response.headers['Content-Encoding'] = encoding
+    return response
 
 @app.route('/patients', methods=['GET'])
 def get_patients():
-    """Retrieve all patients
+    """Retrieve patients, one page at a time
     ---
+    parameters:
+      - name: fields
+        in: query
+        type: string
+        required: false
+        description: Comma-separated columns to return (id is always included)
+      - name: cursor
+        in: query
+        type: integer
+        required: false
+        description: Return rows with id greater than this value (the X-Next-Cursor of the previous page)
+      - name: limit
+        in: query
+        type: integer
+        required: false
+        description: Page size (default 100, max 1000). In NDJSON mode, no limit streams every remaining row
+      - name: format
+        in: query
+        type: string
+        enum: [json, ndjson]
+        required: false
+        description: ndjson streams one JSON object per line instead of a single array
     responses:
       200:
-        description: A list of patients
+        description: A page of patients ordered by id. When more rows follow, the X-Next-Cursor header holds the cursor for the next page
+      304:
+        description: Unchanged since the ETag in If-None-Match (or the If-Modified-Since date); responses carry ETag and Last-Modified
+      400:
+        description: Unknown field or invalid cursor/limit
     """
-    conn = get_db_connection()
-    patients = conn.execute('SELECT * FROM patients').fetchall()
-    conn.close()
-    return jsonify([dict(p) for p in patients])
+    return conditional_rows('patients', 0, 'patients')
 
 @app.route('/message', methods=['POST'])
 def send_message():
@@ -62,54 +248,596 @@ def send_message():
               type: string
     responses:
       200:
-        description: Message stored successfully
+        description: Message stored successfully; id is the new message id
+      400:
+        description: patient_id, doctor_id or message is missing, or a field is not text or a number
+      503:
+        description: The message was not committed within the write timeout; it may still be stored later
+    """
+    row = message_row(request.json)
+    if row is None:
+        return jsonify({"error": "patient_id, doctor_id and message are required, as text or numbers"}), 400
+    # Queued for the group-commit writer; returns once the row is durable
+    try:
+        message_id = message_writer.submit(row).result(WRITE_TIMEOUT)
+    except WriteTimeout:
+        return write_timeout({})
+    return jsonify({"message": "Message stored successfully", "id": message_id}), 200
+
+@app.route('/messages:batch', methods=['POST'])
+def send_messages_batch():
+    """Send several patient messages in one request
+    ---
+    parameters:
+      - name: body
+        in: body
+        required: true
+        schema:
+          type: object
+          required:
+            - messages
+          properties:
+            messages:
+              type: array
+              items:
+                $ref: '#/definitions/Message'
+    responses:
+      200:
+        description: All messages stored; ids are the new message ids in request order
+      400:
+        description: The body has no messages list, or a message is missing a required field or has one that is not text or a number
+      500:
+        description: Some messages could not be stored; failed lists their indexes and ids has null for them
+      503:
+        description: Some messages were not committed within the write timeout; pending lists their indexes
     """
     data = request.json
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    cursor.execute(
-        "INSERT INTO messages (patient_id, doctor_id, patient_FName, patient_LName, message, time_stamp) VALUES (?, ?, ?, ?, ?, datetime('now'))",
-        (data['patient_id'], data['doctor_id'], data['patient_FName'], data['patient_LName'], data['message'])
-    )
-    conn.commit()
-    conn.close()
-    return jsonify({"message": "Message stored successfully"}), 200
+    messages = data.get('messages') if isinstance(data, dict) else None
+    if not isinstance(messages, list) or not messages:
+        return jsonify({"error": "messages must be a non-empty list"}), 400
+    rows = [message_row(m) for m in messages]
+    invalid = [i for i, row in enumerate(rows) if row is None]
+    if invalid:
+        return jsonify({"error": "patient_id, doctor_id and message are required, as text or numbers",
+                        "invalid": invalid}), 400
+    futures = message_writer.submit_many(rows)
+    done, _ = wait(futures, WRITE_TIMEOUT)
+    pending = [i for i, future in enumerate(futures) if future not in done]
+    failed = [i for i, future in enumerate(futures) if future in done and future.exception() is not None]
+    ids = [future.result() if future in done and future.exception() is None else None for future in futures]
+    if pending:
+        return write_timeout({"ids": ids, "pending": pending, "failed": failed})
+    if failed:
+        return jsonify({"error": "some messages could not be stored", "ids": ids, "failed": failed}), 500
+    return jsonify({"message": "Messages stored successfully", "ids": ids}), 200
+
+# 503 for writes the group-commit writer has not committed in time. They stay
+# queued, so a retry may store a message twice.
+def write_timeout(content):
+    response = jsonify(dict(content, error="not stored in time, the database is busy; it may still be stored"))
+    response.headers["Retry-After"] = str(WRITE_RETRY_AFTER)
+    return response, 503
 
 @app.route('/messages/<patient_id>', methods=['GET'])
 def get_messages(patient_id):
-    """Retrieve all messages for a patient
+    """Retrieve messages for a patient, one page at a time
     ---
     parameters:
       - name: patient_id
         in: path
         type: string
         required: true
+      - name: fields
+        in: query
+        type: string
+        required: false
+        description: Comma-separated columns to return (id is always included)
+      - name: cursor
+        in: query
+        type: integer
+        required: false
+        description: Return rows with id greater than this value (the X-Next-Cursor of the previous page)
+      - name: limit
+        in: query
+        type: integer
+        required: false
+        description: Page size (default 100, max 1000). In NDJSON mode, no limit streams every remaining row
+      - name: format
+        in: query
+        type: string
+        enum: [json, ndjson]
+        required: false
+        description: ndjson streams one JSON object per line instead of a single array
     responses:
       200:
-        description: A list of messages for the given patient
+        description: A page of messages for the given patient ordered by id. When more rows follow, the X-Next-Cursor header holds the cursor for the next page
+      304:
+        description: Unchanged since the ETag in If-None-Match (or the If-Modified-Since date); responses carry ETag and Last-Modified
+      400:
+        description: Unknown field or invalid cursor/limit
     """
-    conn = get_db_connection()
-    messages = conn.execute('SELECT * FROM messages WHERE patient_id = ?', (patient_id,)).fetchall()
-    conn.close()
-    return jsonify([dict(m) for m in messages])
+    return conditional_rows('messages', patient_id, 'messages', 'patient_id = ?', (patient_id,))
+
+@app.route('/doctors/<int:doctor_id>/inbox', methods=['GET'])
+def get_inbox(doctor_id):
+    """A doctor's conversations, most recent first, with unread counts
+    ---
+    parameters:
+      - name: doctor_id
+        in: path
+        type: integer
+        required: true
+      - name: before
+        in: query
+        type: integer
+        required: false
+        description: Return conversations whose last message id is below this value (the X-Next-Cursor of the previous page)
+      - name: limit
+        in: query
+        type: integer
+        required: false
+        description: Page size (default 50, max 500)
+      - name: unread
+        in: query
+        type: boolean
+        required: false
+        description: Only conversations with unread messages
+    responses:
+      200:
+        description: The doctor's unread message and conversation totals, and a page of conversations (patient, message and unread counts, last message). When more follow, the X-Next-Cursor header holds the cursor for the next page
+      400:
+        description: Invalid before/limit
+    """
+    try:
+        before = request.args.get('before', type=int)
+        limit = int(request.args.get('limit', inbox.INBOX_PAGE))
+    except ValueError:
+        return jsonify({"error": "before and limit must be integers"}), 400
+    unread_only = request.args.get('unread', '').lower() in ('1', 'true', 'yes')
+    threads = inbox.threads(doctor_id, before, limit, unread_only)
+    response = jsonify(dict(inbox.unread(doctor_id), doctor_id=doctor_id, conversations=threads))
+    if threads and len(threads) == min(max(limit, 1), inbox.MAX_INBOX_PAGE):
+        response.headers['X-Next-Cursor'] = str(threads[-1]['last_message_id'])
+    return response
+
+@app.route('/doctors/<int:doctor_id>/threads/<int:patient_id>', methods=['GET'])
+def get_thread(doctor_id, patient_id):
+    """Messages between a doctor and a patient, one page at a time
+    ---
+    parameters:
+      - name: doctor_id
+        in: path
+        type: integer
+        required: true
+      - name: patient_id
+        in: path
+        type: integer
+        required: true
+      - name: fields
+        in: query
+        type: string
+        required: false
+        description: Comma-separated columns to return (id is always included)
+      - name: cursor
+        in: query
+        type: integer
+        required: false
+        description: Return messages with id greater than this value (the X-Next-Cursor of the previous page)
+      - name: limit
+        in: query
+        type: integer
+        required: false
+        description: Page size (default 100, max 1000). In NDJSON mode, no limit streams every remaining row
+      - name: format
+        in: query
+        type: string
+        enum: [json, ndjson]
+        required: false
+        description: ndjson streams one JSON object per line instead of a single array
+    responses:
+      200:
+        description: A page of the conversation ordered by id. When more rows follow, the X-Next-Cursor header holds the cursor for the next page
+      304:
+        description: Unchanged since the ETag in If-None-Match (or the If-Modified-Since date); responses carry ETag and Last-Modified
+      400:
+        description: Unknown field or invalid cursor/limit
+    """
+    return conditional_rows('messages', patient_id, 'messages', 'doctor_id = ? AND patient_id = ?', (doctor_id, patient_id))
+
+@app.route('/doctors/<int:doctor_id>/threads/<int:patient_id>/read', methods=['POST'])
+def mark_thread_read(doctor_id, patient_id):
+    """Mark a conversation read
+    ---
+    parameters:
+      - name: doctor_id
+        in: path
+        type: integer
+        required: true
+      - name: patient_id
+        in: path
+        type: integer
+        required: true
+      - name: body
+        in: body
+        required: false
+        schema:
+          type: object
+          properties:
+            through_id:
+              type: integer
+              description: Last message id read (default the conversation's last message). The read marker never moves back
+    responses:
+      200:
+        description: The conversation's counts and read marker after the update
+      400:
+        description: through_id is not an integer
+      404:
+        description: The doctor has no conversation with the patient
+    """
+    data = request.get_json(silent=True) or {}
+    through_id = data.get('through_id') if isinstance(data, dict) else None
+    if through_id is not None and (not isinstance(through_id, int) or isinstance(through_id, bool)):
+        return jsonify({"error": "through_id must be an integer"}), 400
+    thread = inbox.mark_read(doctor_id, patient_id, through_id)
+    if thread is None:
+        return jsonify({"error": "No such conversation"}), 404
+    return jsonify(thread)
+
+# Cursor and limit of a change feed request
+def feed_args():
+    since = request.headers.get('Last-Event-ID') or request.args.get('since', 0)
+    return int(since), int(request.args.get('limit', inbox.FEED_LIMIT))
+
+@app.route('/doctors/<int:doctor_id>/messages', methods=['GET'])
+def get_doctor_messages(doctor_id):
+    """New messages for a doctor since a message id (long poll)
+    ---
+    parameters:
+      - name: doctor_id
+        in: path
+        type: integer
+        required: true
+      - name: since
+        in: query
+        type: integer
+        required: false
+        description: Return messages with id greater than this value (the X-Next-Cursor of the previous response; default 0)
+      - name: limit
+        in: query
+        type: integer
+        required: false
+        description: Most messages to return (default 100, max 1000)
+      - name: wait
+        in: query
+        type: number
+        required: false
+        description: Seconds to wait for a new message when there is none yet (max 30)
+    responses:
+      200:
+        description: Messages ordered by id, possibly empty once wait has passed. X-Next-Cursor holds the since value for the next request
+      400:
+        description: Invalid since/limit/wait
+    """
+    try:
+        since, limit = feed_args()
+        wait = float(request.args.get('wait', 0))
+        if not math.isfinite(wait):
+            raise ValueError(wait)
+    except ValueError:
+        return jsonify({"error": "since, limit and wait must be numbers"}), 400
+    rows = inbox.feed.poll(doctor_id, since, limit, wait)
+    response = jsonify(rows)
+    response.headers['X-Next-Cursor'] = str(rows[-1]['id'] if rows else since)
+    return response
+
+@app.route('/doctors/<int:doctor_id>/feed', methods=['GET'])
+def doctor_feed(doctor_id):
+    """Server-sent event stream of a doctor's new messages
+    ---
+    parameters:
+      - name: doctor_id
+        in: path
+        type: integer
+        required: true
+      - name: since
+        in: query
+        type: integer
+        required: false
+        description: Start after this message id; on reconnect the Last-Event-ID header is used instead (default 0)
+    produces:
+      - text/event-stream
+    responses:
+      200:
+        description: One "message" event per new message, its id as the event id, with keep-alive comments while idle
+      400:
+        description: Invalid since
+    """
+    try:
+        since, limit = feed_args()
+    except ValueError:
+        return jsonify({"error": "since and limit must be integers"}), 400
+
+    def generate():
+        cursor = since
+        while True:
+            rows = inbox.feed.poll(doctor_id, cursor, limit, FEED_KEEPALIVE)
+            if not rows:
+                yield ": keep-alive\n\n"
+                continue
+            yield ''.join(f"id: {row['id']}\nevent: message\ndata: {json.dumps(row)}\n\n" for row in rows)
+            cursor = rows[-1]['id']
+    return Response(stream_with_context(generate()), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
 
 @app.route('/treatments/<patient_id>', methods=['GET'])
 def get_treatments(patient_id):
-    """Retrieve treatment history for a patient
+    """Retrieve treatment history for a patient, one page at a time
+    ---
+    parameters:
+      - name: patient_id
+        in: path
+        type: string
+        required: true
+      - name: fields
+        in: query
+        type: string
+        required: false
+        description: Comma-separated columns to return (id is always included)
+      - name: cursor
+        in: query
+        type: integer
+        required: false
+        description: Return rows with id greater than this value (the X-Next-Cursor of the previous page)
+      - name: limit
+        in: query
+        type: integer
+        required: false
+        description: Page size (default 100, max 1000). In NDJSON mode, no limit streams every remaining row
+      - name: format
+        in: query
+        type: string
+        enum: [json, ndjson]
+        required: false
+        description: ndjson streams one JSON object per line instead of a single array
+    responses:
+      200:
+        description: A page of treatments ordered by id. When more rows follow, the X-Next-Cursor header holds the cursor for the next page
+      304:
+        description: Unchanged since the ETag in If-None-Match (or the If-Modified-Since date); responses carry ETag and Last-Modified
+      400:
+        description: Unknown field or invalid cursor/limit
+    """
+    return conditional_rows('treatments', patient_id, 'patients_treatment', 'patient_id = ?', (patient_id,))
+
+# Search results for the q, patient_id and limit query parameters
+def search_rows(kind):
+    patient_id = request.args.get('patient_id', type=int)
+    limit = request.args.get('limit', SEARCH_LIMIT, type=int)
+    return jsonify(search(kind, request.args.get('q', ''), patient_id, limit))
+
+@app.errorhandler(InvalidQuery)
+def invalid_query(e):
+    return jsonify({"error": str(e)}), 400
+
+@app.route('/search/treatments', methods=['GET'])
+def search_treatments():
+    """Full-text search over treatments and disease types
+    ---
+    parameters:
+      - name: q
+        in: query
+        type: string
+        required: true
+        description: Text to find (at least 3 characters, English or Persian)
+      - name: patient_id
+        in: query
+        type: integer
+        required: false
+        description: Only search this patient's treatments
+      - name: limit
+        in: query
+        type: integer
+        required: false
+        description: Number of results (default 20, max 200)
+    responses:
+      200:
+        description: Treatments containing the text, newest first (match "exact"); when there are none, treatments with a close spelling, best first (match "fuzzy")
+      400:
+        description: Query shorter than 3 characters
+    """
+    return search_rows('treatments')
+
+@app.route('/search/messages', methods=['GET'])
+def search_messages():
+    """Full-text search over patient messages
+    ---
+    parameters:
+      - name: q
+        in: query
+        type: string
+        required: true
+        description: Text to find (at least 3 characters, English or Persian)
+      - name: patient_id
+        in: query
+        type: integer
+        required: false
+        description: Only search this patient's messages
+      - name: limit
+        in: query
+        type: integer
+        required: false
+        description: Number of results (default 20, max 200)
+    responses:
+      200:
+        description: Messages containing the text, newest first (match "exact"); when there are none, messages with a close spelling, best first (match "fuzzy")
+      400:
+        description: Query shorter than 3 characters
+    """
+    return search_rows('messages')
+
+# Cohort filter from the query string: (gender, age_min, age_max)
+def cohort_filter():
+    age_min = request.args.get('age_min', type=float)
+    age_max = request.args.get('age_max', type=float)
+    return request.args.get('gender') or None, age_min, age_max
+
+@app.errorhandler(UnknownMetric)
+def unknown_metric(e):
+    return jsonify({"error": str(e), "metrics": list(METRICS)}), 400
+
+@app.errorhandler(UnknownPatient)
+def unknown_patient(e):
+    return jsonify({"error": str(e)}), 404
+
+@app.route('/analytics/distribution/<metric>', methods=['GET'])
+def get_distribution(metric):
+    """Histogram and summary statistics of a metric over a cohort
+    ---
+    parameters:
+      - name: metric
+        in: path
+        type: string
+        required: true
+        description: Column of patients_analysis, e.g. restingBP, serum_cholesterol, maxheartrate
+      - name: gender
+        in: query
+        type: string
+        required: false
+      - name: age_min
+        in: query
+        type: number
+        required: false
+      - name: age_max
+        in: query
+        type: number
+        required: false
+      - name: bins
+        in: query
+        type: integer
+        required: false
+        description: Number of histogram bins (default 20, max 200)
+    responses:
+      200:
+        description: Bin edges and counts plus count, mean, std, min and max of the cohort
+      400:
+        description: Unknown metric or invalid bins
+    """
+    bins = request.args.get('bins', 20, type=int)
+    if not 1 <= bins <= MAX_BINS:
+        return jsonify({"error": f"bins must be between 1 and {MAX_BINS}"}), 400
+    gender, age_min, age_max = cohort_filter()
+    return jsonify(analytics.distribution(metric, gender, age_min, age_max, bins))
+
+@app.route('/analytics/percentiles/<metric>', methods=['GET'])
+def get_percentiles(metric):
+    """Percentiles of a metric over a cohort
+    ---
+    parameters:
+      - name: metric
+        in: path
+        type: string
+        required: true
+      - name: q
+        in: query
+        type: string
+        required: false
+        description: Comma-separated percentiles between 0 and 100 (default 5,25,50,75,95)
+      - name: gender
+        in: query
+        type: string
+        required: false
+      - name: age_min
+        in: query
+        type: number
+        required: false
+      - name: age_max
+        in: query
+        type: number
+        required: false
+    responses:
+      200:
+        description: Cohort size and the requested percentiles
+      400:
+        description: Unknown metric or invalid percentiles
+    """
+    try:
+        q = tuple(float(p) for p in request.args['q'].split(',')) if request.args.get('q') else PERCENTILES
+    except ValueError:
+        return jsonify({"error": "q must be comma-separated numbers"}), 400
+    if not all(0 <= p <= 100 for p in q):
+        return jsonify({"error": "percentiles must be between 0 and 100"}), 400
+    gender, age_min, age_max = cohort_filter()
+    return jsonify(analytics.percentiles(metric, q, gender, age_min, age_max))
+
+@app.route('/analytics/patients/<int:patient_id>/percentile/<metric>', methods=['GET'])
+def get_patient_percentile(patient_id, metric):
+    """A patient's percentile for a metric within their gender and age group
     ---
     parameters:
       - name: patient_id
+        in: path
+        type: integer
+        required: true
+      - name: metric
         in: path
         type: string
         required: true
+      - name: age_band
+        in: query
+        type: integer
+        required: false
+        description: Width of the age group in years (default 10)
+    responses:
+      200:
+        description: The patient's value, its percentile (null when the value is missing) and the cohort it was compared against
+      400:
+        description: Unknown metric or invalid age_band
+      404:
+        description: No analysis record for the patient
+    """
+    age_band = request.args.get('age_band', 10, type=int)
+    if age_band < 1:
+        return jsonify({"error": "age_band must be positive"}), 400
+    return jsonify(analytics.patient_percentile(patient_id, metric, age_band))
+
+@app.route('/analytics/stats', methods=['GET'])
+def get_analytics_stats():
+    """Analytics store metrics
+    ---
+    responses:
+      200:
+        description: Rows loaded, memory used by the columns and hits/misses of the per-cohort cache
+    """
+    return jsonify(analytics.stats())
+
+@app.route('/db/stats', methods=['GET'])
+def get_db_stats():
+    """Connection pool metrics
+    ---
     responses:
       200:
-        description: A list of treatments
+        description: Pool checkouts served from idle connections (hits), new connections (misses), waits for a free connection and total wait time in seconds
     """
-    conn = get_db_connection()
-    treatments = conn.execute('SELECT * FROM patients_treatment WHERE patient_id = ?', (patient_id,)).fetchall()
-    conn.close()
-    return jsonify([dict(t) for t in treatments])
+    return jsonify(pool.stats())
+
+# The Flask app also runs without main.py (the Dockerfile starts it on the
+# committed database), so it initializes the database itself, which gives
+# messages the id primary key threads are keyed on. The inbox and search
+# indexes are built even when EHOSPITAL_INIT_MODE=skip turns init_db off.
+def build_schema():
+    from utils import init_db
+    init_db()
+    with file_lock(f"{pool.path}.init-lock"), pool.connection() as conn:
+        inbox.build_inbox(conn)
+        build_search_index(conn)
+
+# Served from a database nobody has built the schema of yet
+@app.errorhandler(sqlite3.OperationalError)
+def schema_missing(e):
+    if 'no such table' not in str(e):
+        raise e
+    return jsonify({"error": "database is not initialized"}), 503
 
 if __name__ == '__main__':
+    build_schema()
     app.run(debug=True)
@@ -0,0 +1,92 @@
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+from utils import verify_patient
+from response_cache import resource_version
+from metrics import timed
+
+# Seconds a successful / failed credential check is remembered
+POSITIVE_TTL = 300
+NEGATIVE_TTL = 30
+
+# Seconds between checks of the patients version counter; any write to
+# patients (including a CSV import or bulk load in another process) bumps it
+# and empties the cache, so a changed password stops working within this
+VERSION_CHECK_INTERVAL = 1.0
+
+# Small LRU cache of credential checks so repeated logins and chat messages that
+# still carry email/password skip the patients query. Keys are a hash of the
+# credentials, so passwords are never kept in memory.
+class CredentialCache:
+    def __init__(self, max_entries=4096, positive_ttl=POSITIVE_TTL, negative_ttl=NEGATIVE_TTL,
+                 version_check_interval=VERSION_CHECK_INTERVAL):
+        self.max_entries = max_entries
+        self.positive_ttl = positive_ttl
+        self.negative_ttl = negative_ttl
+        self.version_check_interval = version_check_interval
+        self._version = None
+        self._checked_at = None
+        self._entries = OrderedDict()  # key -> (expires_at, email, patient or None)
+        self._lock = threading.Lock()
+        self.stats = {"hits": 0, "negative_hits": 0, "misses": 0, "invalidations": 0}
+
+    @staticmethod
+    def _key(email, password):
+        return hashlib.sha256(f"{email}\0{password}".encode("utf-8")).digest()
+
+    # Empty the cache if the patients table changed since the last check
+    def _check_version(self, now):
+        if self._checked_at is not None and now - self._checked_at < self.version_check_interval:
+            return
+        self._checked_at = now
+        version = resource_version("patients")
+        if version != self._version:
+            if self._version is not None:
+                self.clear()
+            self._version = version
+
+    def lookup(self, email, password):
+        key = self._key(email, password)
+        now = time.monotonic()
+        self._check_version(now)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] > now:
+                self._entries.move_to_end(key)
+                self.stats["hits" if entry[2] else "negative_hits"] += 1
+                return True, entry[2]
+            self.stats["misses"] += 1
+        return False, None
+
+    def store(self, email, password, patient):
+        ttl = self.positive_ttl if patient else self.negative_ttl
+        with self._lock:
+            self._entries[self._key(email, password)] = (time.monotonic() + ttl, email, patient)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    # Forget every cached check for an email (e.g. after a password change)
+    def invalidate(self, email):
+        with self._lock:
+            stale = [key for key, entry in self._entries.items() if entry[1] == email]
+            for key in stale:
+                del self._entries[key]
+            self.stats["invalidations"] += len(stale)
+
+    def clear(self):
+        with self._lock:
+            self.stats["invalidations"] += len(self._entries)
+            self._entries.clear()
+
+credential_cache = CredentialCache()
+
+# verify_patient behind the credential cache; returns (id, FName) or None
+@timed("authenticate")
+def authenticate(email, password):
+    found, patient = credential_cache.lookup(email, password)
+    if found:
+        return patient
+    patient = verify_patient(email, password)
+    credential_cache.store(email, password, patient)
+    return patient
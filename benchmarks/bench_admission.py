@@ -0,0 +1,182 @@
+# Benchmark: /chat latency of well-behaved patients while one client floods the server
+#
+# Starts serve.py (one worker) on a temporary database with the remote
+# tables served by benchmarks/stub_api.py, once with admission control off
+# and once with the default limits. Quiet patients each send a message every
+# --pace seconds from 127.0.0.1, while a flood client on 127.0.0.2 sends
+# /chat from one logged-in session over many connections and another on
+# 127.0.0.3 sends cookie-less /chat with credentials, both as fast as they
+# are answered. Reports the quiet patients' latency and the flood's answers
+# by status code.
+#
+# Usage: python benchmarks/bench_admission.py [--quiet 8] [--flood 128] [--seconds 10] [--output results.json]
+import argparse
+import asyncio
+import json
+import multiprocessing
+import os
+import platform
+import shutil
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+from collections import Counter
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO = os.path.dirname(BENCH_DIR)
+sys.path.insert(0, REPO)
+
+from stub_api import StubAPI, heart_disease_rows, blood_sugar_rows
+from bench_workers import free_port, wait_ready, percentile
+
+MESSAGES = ["hello", "good", "what is my heart rate", "blood pressure", "show my treatment", "my bmi"]
+
+def client(base_url, address):
+    import httpx
+    transport = httpx.AsyncHTTPTransport(local_address=address)
+    return httpx.AsyncClient(base_url=base_url, transport=transport, timeout=30)
+
+# Quiet patients: log in, then one message every pace seconds; returns latencies and non-200 statuses
+def run_quiet(base_url, patients, pace, start_at, seconds):
+    async def patient(i, latencies, statuses):
+        email, password = patients[i % len(patients)]
+        async with client(base_url, "127.0.0.1") as http:
+            await http.post("/login", json={"email": email, "password": password})
+            n = 0
+            while time.time() < start_at + seconds:
+                begun = time.time()
+                response = await http.post("/chat", json={"message": MESSAGES[n % len(MESSAGES)]})
+                latencies.append(time.time() - begun)
+                statuses[response.status_code] += 1
+                n += 1
+                await asyncio.sleep(max(0.0, pace - (time.time() - begun)))
+
+    async def main(count):
+        latencies, statuses = [], Counter()
+        await asyncio.sleep(max(0.0, start_at - time.time()))
+        await asyncio.gather(*(patient(i, latencies, statuses) for i in range(count)))
+        return latencies, dict(statuses)
+
+    return asyncio.run(main(len(patients)))
+
+# Flood: connections loops of back-to-back /chat, half from one logged-in
+# session on 127.0.0.2 and half cookie-less with credentials on 127.0.0.3
+def run_flood(base_url, credentials, connections, start_at, seconds):
+    async def loop(http, body, statuses):
+        while time.time() < start_at + seconds:
+            try:
+                response = await http.post("/chat", json=body)
+                statuses[response.status_code] += 1
+            except Exception:
+                statuses["error"] += 1
+
+    async def main():
+        statuses = Counter()
+        email, password = credentials
+        async with client(base_url, "127.0.0.2") as session, client(base_url, "127.0.0.3") as anonymous:
+            await session.post("/login", json={"email": email, "password": password})
+            await asyncio.sleep(max(0.0, start_at - time.time()))
+            loops = [loop(session, {"message": "what is my heart rate"}, statuses) for _ in range(connections // 2)]
+            loops += [loop(anonymous, {"message": "blood pressure", "email": email, "password": password}, statuses)
+                      for _ in range(connections - connections // 2)]
+            await asyncio.gather(*loops)
+        return {str(status): count for status, count in statuses.items()}
+
+    return asyncio.run(main())
+
+def run_mode(name, env, args, patients):
+    import httpx
+    port = free_port()
+    base_url = f"http://127.0.0.1:{port}"
+    process = subprocess.Popen([sys.executable, os.path.join(REPO, "serve.py"), "--workers", "1",
+                                "--host", "0.0.0.0", "--port", str(port)],
+                               cwd=REPO, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        wait_ready(base_url, process)
+        start_at = time.time() + 1.0
+        context = multiprocessing.get_context("spawn")
+        with context.Pool(2) as pool:
+            quiet = pool.apply_async(run_quiet, (base_url, patients[1:args.quiet + 1], args.pace, start_at, args.seconds))
+            flood = pool.apply_async(run_flood, (base_url, patients[0], args.flood, start_at, args.seconds))
+            latencies, quiet_statuses = quiet.get()
+            flood_statuses = flood.get()
+        stats = httpx.get(base_url + "/admission/stats").json()
+    finally:
+        process.terminate()
+        try:
+            process.wait(30)
+        except subprocess.TimeoutExpired:
+            process.kill()
+    latencies.sort()
+    result = {
+        "mode": name,
+        "quiet_requests": len(latencies),
+        "quiet_statuses": quiet_statuses,
+        "quiet_latency_ms": {key: percentile(latencies, fraction) * 1e3
+                             for key, fraction in (("p50", 0.5), ("p95", 0.95), ("p99", 0.99))},
+        "flood_statuses": flood_statuses,
+        "admission": stats,
+    }
+    latency = result["quiet_latency_ms"]
+    print(f"{name:<14} quiet: {len(latencies):5d} requests, p50 {latency['p50']:7.1f}  p95 {latency['p95']:7.1f}  "
+          f"p99 {latency['p99']:7.1f} ms, statuses {quiet_statuses}")
+    print(f"{'':<14} flood: {flood_statuses}")
+    print(f"{'':<14} admission: admitted {stats['admitted']}, queued {stats['queued']}, "
+          f"shed session {stats['shed_session_rate']} / ip {stats['shed_ip_rate']} / overload {stats['shed_overload']}")
+    return result
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--quiet", type=int, default=8, help="well-behaved patients")
+    parser.add_argument("--pace", type=float, default=1.5, help="seconds between a quiet patient's messages")
+    parser.add_argument("--flood", type=int, default=128, help="flood connections")
+    parser.add_argument("--seconds", type=float, default=10.0)
+    parser.add_argument("--output", default=os.path.join(BENCH_DIR, "results", "bench_admission.json"))
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix="bench_admission_")
+    results = []
+    try:
+        env = dict(
+            os.environ,
+            EHOSPITAL_DB=os.path.join(workdir, "database.db"),
+            EHOSPITAL_SESSION_BACKEND="sqlite",
+            EHOSPITAL_SESSION_DB=os.path.join(workdir, "sessions.db"),
+            EHOSPITAL_AUDIO_DIR=os.path.join(workdir, "audio"),
+            EHOSPITAL_SYNC_INTERVAL="0",
+        )
+        subprocess.run([sys.executable, "-c", "from utils import init_db; init_db()"],
+                       cwd=REPO, env=env, check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        conn = sqlite3.connect(env["EHOSPITAL_DB"])
+        patients = conn.execute("SELECT EmailId, password FROM patients ORDER BY id").fetchall()
+        patient_count = conn.execute("SELECT MAX(id) FROM patients").fetchone()[0]
+        conn.close()
+
+        tables = {"heart_disease_test": heart_disease_rows(patient_count),
+                  "blood_sugar_analysis": blood_sugar_rows(patient_count)}
+        print(f"{os.cpu_count()} CPUs, {args.quiet} quiet patients every {args.pace} s, "
+              f"{args.flood} flood connections, {args.seconds:.0f} s per mode")
+        with StubAPI(tables, delay=0.01) as stub:
+            env["EHOSPITAL_API"] = stub.base_url
+            off = dict(env, EHOSPITAL_SESSION_RATE="0", EHOSPITAL_IP_RATE="0", EHOSPITAL_MAX_ACTIVE_CHATS="0")
+            results.append(run_mode("no admission", off, args, patients))
+            results.append(run_mode("admission", env, args, patients))
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    report = {
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": platform.python_version(),
+        "cpus": os.cpu_count(),
+        "config": vars(args),
+        "modes": results,
+    }
+    os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+    with open(args.output, "w", encoding="utf-8") as f:
+        json.dump(report, f, indent=2, ensure_ascii=False)
+    print(f"results written to {args.output}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,104 @@
+# Benchmark: cohort analytics over a synthetic patients_analysis table
+#
+# Generates N rows, writes them as CSV, loads them through PatientAnalytics and
+# times distribution / percentile / patient-percentile queries cold and cached.
+# A per-row Python loop stands in for answering the same question without the
+# column store.
+#
+# Usage: python benchmarks/bench_analytics.py [--rows 1000000]
+import argparse
+import os
+import sys
+import tempfile
+import time
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from analytics import PatientAnalytics, METRICS, read_analysis_csv
+
+def synthetic_frame(rows, seed=0):
+    rng = np.random.default_rng(seed)
+    frame = pd.DataFrame({
+        "patient_id": np.arange(1, rows + 1),
+        "gender": rng.choice(["Female", "Male"], rows),
+        "age": rng.integers(18, 90, rows),
+        "height": rng.integers(150, 200, rows),
+        "weight": rng.integers(45, 130, rows),
+        "chestpain": rng.integers(0, 4, rows).astype(float),
+        "restingBP": rng.normal(130, 18, rows).round(),
+        "serum_cholesterol": rng.normal(240, 50, rows).round(),
+        "fastingbloodsugar": rng.integers(0, 2, rows).astype(float),
+        "restingrelectro": rng.integers(0, 3, rows).astype(float),
+        "maxheartrate": rng.normal(150, 22, rows).round(),
+        "exerciseangia": rng.integers(0, 2, rows).astype(float),
+        "oldpeak": rng.gamma(1.2, 0.9, rows).round(1),
+        "slope": rng.integers(1, 4, rows).astype(float),
+        "noofmajorvessels": rng.integers(0, 4, rows).astype(float),
+        "target": rng.integers(0, 2, rows).astype(float),
+    })
+    # Gaps like the real export, where many measurements are blank
+    for column in ("serum_cholesterol", "fastingbloodsugar", "noofmajorvessels", "target"):
+        frame.loc[rng.random(rows) < 0.1, column] = np.nan
+    return frame
+
+def timed(label, func, repeat=1):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        result = func()
+    elapsed = (time.perf_counter() - start) / repeat
+    print(f"  {label:<44} {elapsed * 1000:10.3f} ms")
+    return result
+
+# Patient percentile the way it would be done with rows as Python objects
+def loop_percentile(records, patient_id, metric, age_band=10):
+    patient = next(r for r in records if r["patient_id"] == patient_id)
+    low = patient["age"] // age_band * age_band
+    below = equal = total = 0
+    for r in records:
+        if r["gender"] == patient["gender"] and low <= r["age"] < low + age_band and r[metric] == r[metric]:
+            total += 1
+            below += r[metric] < patient[metric]
+            equal += r[metric] == patient[metric]
+    return (below + equal / 2) / total * 100
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rows", type=int, default=1_000_000)
+    args = parser.parse_args()
+
+    frame = synthetic_frame(args.rows)
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "patients_analysis.csv")
+        frame.to_csv(path, index=False)
+        print(f"{args.rows} rows, CSV {os.path.getsize(path) / 1e6:.1f} MB")
+
+        print("load")
+        default = timed("pandas read_csv, default dtypes", lambda: pd.read_csv(path, usecols=["patient_id", "gender", *METRICS]))
+        store = PatientAnalytics(paths=(path,))
+        timed("PatientAnalytics load (downcast)", store.refresh)
+        print(f"  memory: default dtypes {default.memory_usage(deep=True).sum() / 1e6:.1f} MB, "
+              f"downcast {store.frame.memory_usage(deep=True).sum() / 1e6:.1f} MB")
+
+        print("queries")
+        timed("distribution restingBP, Female 50-59 (cold)", lambda: store.distribution("restingBP", "Female", 50, 59))
+        timed("distribution restingBP, Female 50-59 (cached)", lambda: store.distribution("restingBP", "Female", 50, 59), 1000)
+        timed("percentiles serum_cholesterol, all (cold)", lambda: store.percentiles("serum_cholesterol"))
+        timed("percentiles serum_cholesterol, all (cached)", lambda: store.percentiles("serum_cholesterol"), 100)
+        sample = min(args.rows, 100_000)
+        patient_id = sample // 2
+        result = timed("patient percentile maxheartrate (cold cohort)", lambda: store.patient_percentile(patient_id, "maxheartrate"))
+        timed("patient percentile maxheartrate (cached cohort)", lambda: store.patient_percentile(patient_id, "maxheartrate"), 1000)
+        timed("percentile of 1000 patients (shared cohorts)",
+              lambda: [store.patient_percentile(p, "maxheartrate") for p in range(1, 1001)])
+
+        print("baseline")
+        records = read_analysis_csv(path).head(sample).to_dict("records")
+        timed(f"python loop, one patient over {sample} rows", lambda: loop_percentile(records, patient_id, "maxheartrate"))
+        print(f"  (scales linearly: ~{args.rows / sample:.0f}x that for the full table)")
+        print(f"patient {patient_id}: value {result['value']}, percentile {result['percentile']:.1f} "
+              f"in cohort of {result['cohort']['count']}")
+
+if __name__ == "__main__":
+    main()
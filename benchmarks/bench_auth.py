@@ -0,0 +1,100 @@
+# Benchmark: per-message /chat latency with credentials checked on every message
+# vs. the credential cache vs. a logged-in session
+#
+# Usage: python benchmarks/bench_auth.py [--messages N] [--patients N]
+import argparse
+import os
+import shutil
+import sqlite3
+import statistics
+import sys
+import tempfile
+import time
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+WORKDIR = tempfile.mkdtemp(prefix="bench_auth_")
+os.environ["EHOSPITAL_DB"] = os.path.join(WORKDIR, "database.db")
+os.environ["EHOSPITAL_AUDIO_DIR"] = os.path.join(WORKDIR, "audio")
+sys.path.insert(0, REPO)
+os.chdir(REPO)
+
+from fastapi.testclient import TestClient
+import main
+from auth import authenticate, credential_cache
+from utils import init_db, verify_patient
+
+EMAIL, PASSWORD = "pat0@test.com", "PAT-000"
+
+# Pad the patients table so the credential query has realistic work to do
+def add_patients(count):
+    conn = sqlite3.connect(os.environ["EHOSPITAL_DB"])
+    conn.executemany(
+        "INSERT OR IGNORE INTO patients (id, uuid, Age, Gender, FName, LName, EmailId, password) VALUES (?, ?, 40, 'Female', 'Test', 'Patient', ?, ?)",
+        ((1000000 + i, f"PAT-{i}", f"bench{i}@test.com", f"PAT-{i}") for i in range(count))
+    )
+    conn.commit()
+    conn.close()
+
+def run(client, messages, body, before=None):
+    latencies = []
+    for _ in range(messages):
+        if before:
+            before()
+        start = time.perf_counter()
+        client.post("/chat", json=body)
+        latencies.append(time.perf_counter() - start)
+    return latencies
+
+def report(name, latencies):
+    latencies = sorted(latencies)
+    p95 = latencies[int(len(latencies) * 0.95) - 1]
+    print(f"{name:36s} mean {statistics.mean(latencies) * 1e3:7.3f} ms   p95 {p95 * 1e3:7.3f} ms")
+
+# Cost of the auth step alone, in microseconds per call
+def auth_step(func, rounds=2000):
+    start = time.perf_counter()
+    for _ in range(rounds):
+        func()
+    return (time.perf_counter() - start) / rounds * 1e6
+
+def main_():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--messages", type=int, default=500)
+    parser.add_argument("--patients", type=int, default=100000)
+    args = parser.parse_args()
+
+    init_db()
+    add_patients(args.patients)
+    body = {"message": "what can you do", "email": EMAIL, "password": PASSWORD}
+    with TestClient(main.app) as client:
+        run(client, 20, body)  # warm-up
+        every_message = run(client, args.messages, body, before=credential_cache.clear)
+        cached = run(client, args.messages, body)
+        client.post("/login", json={"email": EMAIL, "password": PASSWORD})
+        session = run(client, args.messages, {"message": "what can you do"})
+
+    session_data = {"patient_id": 25, "patient_name": "Emma"}
+    indexed = auth_step(lambda: verify_patient(EMAIL, PASSWORD))
+    cache_hit = auth_step(lambda: authenticate(EMAIL, PASSWORD))
+    bound = auth_step(lambda: (session_data["patient_id"], session_data["patient_name"]))
+    conn = sqlite3.connect(os.environ["EHOSPITAL_DB"])
+    conn.execute("DROP INDEX idx_patients_email")
+    conn.close()
+    unindexed = auth_step(lambda: verify_patient(EMAIL, PASSWORD), rounds=200)
+
+    print(f"\npatients: {args.patients + 100}")
+    print("auth step alone:")
+    print(f"  verify_patient, no EmailId index  {unindexed:9.1f} us")
+    print(f"  verify_patient, indexed           {indexed:9.1f} us")
+    print(f"  credential cache hit              {cache_hit:9.1f} us")
+    print(f"  logged-in session                 {bound:9.1f} us")
+    print(f"end-to-end /chat, {args.messages} messages per mode (in-process client):")
+    report("  credentials verified every message", every_message)
+    report("  credential cache", cached)
+    report("  logged-in session", session)
+
+if __name__ == "__main__":
+    try:
+        main_()
+    finally:
+        shutil.rmtree(WORKDIR)
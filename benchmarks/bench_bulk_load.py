@@ -0,0 +1,173 @@
+# Benchmark: loading a large patients_treatment export
+#
+# Generates a CSV of --rows treatments and loads it into a fresh copy of an
+# initialized database, each mode in its own process so peak RSS is its own:
+#   - pandas read_csv of the whole file (memory only, nothing written),
+#   - the startup import (csv_import.upsert_csv) through indexes and triggers,
+#   - bulk_load.py keeping the indexes and triggers,
+#   - bulk_load.py dropping them and rebuilding afterwards, and
+#   - bulk_load.py killed part way through, then run again with --resume.
+# Reports rows/s and peak RSS, and checks every mode stored every row and
+# indexed it for search.
+#
+# Usage: python benchmarks/bench_bulk_load.py [--rows 2000000] [--output results.json]
+import argparse
+import csv
+import json
+import os
+import platform
+import random
+import resource
+import shutil
+import signal
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO = os.path.dirname(BENCH_DIR)
+sys.path.insert(0, REPO)
+
+TREATMENTS = ["Insulin {} units, twice daily", "Metformin {} mg with meals", "Blood test in {} days",
+              "Lisinopril {} mg for blood pressure", "Physiotherapy, {} sessions", "Rest and fluids for {} days"]
+DISEASES = ["Diabetes", "Hypertension", "Heart disease", "Asthma", "Influenza"]
+
+def generate(path, rows, seed=0):
+    rng = random.Random(seed)
+    with open(path, "w", newline="", encoding="utf-8") as f:
+        writer = csv.writer(f)
+        writer.writerow(["id", "patient_id", "doctor_id", "treatment", "RecordDate", "disease_type", "disease_id"])
+        for i in range(1, rows + 1):
+            disease = rng.randrange(len(DISEASES))
+            writer.writerow([i, rng.randrange(1, rows // 20 + 2), rng.randrange(1, 500),
+                             rng.choice(TREATMENTS).format(rng.randrange(1, 60)),
+                             f"20{rng.randrange(10, 25)}-{rng.randrange(1, 13):02d}-{rng.randrange(1, 29):02d}",
+                             DISEASES[disease], disease + 1])
+
+# Runs in a child process: one mode against database, printing a JSON report
+def worker(mode, database, path):
+    start = time.perf_counter()
+    report = {"mode": mode}
+    if mode == "pandas":
+        import pandas as pd
+        report["rows"] = len(pd.read_csv(path))
+    elif mode == "startup import":
+        from csv_import import upsert_csv
+        conn = sqlite3.connect(database)
+        with conn:
+            report["rows"] = upsert_csv(conn, "patients_treatment", path)
+        conn.close()
+    else:
+        import bulk_load
+        conn = bulk_load.connect(database)
+        report.update(bulk_load.bulk_load(conn, "patients_treatment", path, resume=(mode == "bulk load, resumed"),
+                                          drop_indexes=(mode != "bulk load, keeping indexes")))
+        conn.close()
+    report["seconds"] = time.perf_counter() - start
+    report["peak_rss"] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+    print(json.dumps(report))
+
+def run_worker(mode, database, path, kill_after=None):
+    process = subprocess.Popen([sys.executable, os.path.abspath(__file__), "--worker", mode, database, path],
+                               cwd=REPO, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True)
+    if kill_after:
+        time.sleep(kill_after)
+        process.send_signal(signal.SIGKILL)
+        process.wait()
+        return None
+    out, _ = process.communicate()
+    if process.returncode:
+        raise RuntimeError(f"{mode} failed with exit code {process.returncode}")
+    return json.loads(out.strip().splitlines()[-1])
+
+def check(database, rows):
+    conn = sqlite3.connect(database)
+    stored = conn.execute("SELECT count(*) FROM patients_treatment WHERE id BETWEEN 1 AND ?", (rows,)).fetchone()[0]
+    searchable = conn.execute("SELECT count(*) FROM treatments_fts WHERE treatments_fts MATCH 'physiotherapy'").fetchone()[0]
+    expected = conn.execute("SELECT count(*) FROM patients_treatment WHERE treatment LIKE '%physiotherapy%'").fetchone()[0]
+    indexes = conn.execute("SELECT count(*) FROM sqlite_master WHERE tbl_name = 'patients_treatment'").fetchone()[0]
+    conn.close()
+    return stored == rows and searchable == expected, indexes
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rows", type=int, default=2_000_000)
+    parser.add_argument("--kill-after", type=float, default=None,
+                        help="seconds before the interrupted load is killed (default: half way through the bulk load's writes)")
+    parser.add_argument("--output", default=os.path.join(BENCH_DIR, "results", "bench_bulk_load.json"))
+    parser.add_argument("--worker", nargs=3, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.worker:
+        worker(*args.worker)
+        return
+
+    workdir = tempfile.mkdtemp(prefix="bench_bulk_load_")
+    results = []
+    try:
+        template = os.path.join(workdir, "template.db")
+        env = dict(os.environ, EHOSPITAL_DB=template)
+        subprocess.run([sys.executable, "-c", "from utils import init_db; init_db()"],
+                       cwd=REPO, env=env, check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        path = os.path.join(workdir, "treatments.csv")
+        start = time.perf_counter()
+        generate(path, args.rows)
+        print(f"{args.rows} rows, {os.path.getsize(path) / 1e6:.0f} MB CSV generated in "
+              f"{time.perf_counter() - start:.1f} s")
+
+        def fresh():
+            database = os.path.join(workdir, "database.db")
+            for suffix in ("", "-wal", "-shm"):
+                if os.path.exists(database + suffix):
+                    os.remove(database + suffix)
+            shutil.copy(template, database)
+            return database
+
+        kill_after = args.kill_after
+        for mode in ("pandas", "startup import", "bulk load, keeping indexes", "bulk load", "bulk load, resumed"):
+            database = fresh()
+            if mode == "bulk load, resumed":
+                run_worker(mode, database, path, kill_after=kill_after)
+                conn = sqlite3.connect(database)
+                committed = conn.execute("SELECT rows FROM bulk_loads WHERE table_name = 'patients_treatment'").fetchone()
+                conn.close()
+                print(f"  killed after {kill_after:.1f} s with {committed[0] if committed else 0} rows committed")
+            start = time.perf_counter()
+            result = run_worker(mode, database, path)
+            startup = time.perf_counter() - start - result["seconds"]
+            if mode != "pandas":
+                result["complete"], result["schema_entries"] = check(database, args.rows)
+            else:
+                result["complete"] = None
+            written = result["rows"] - result.get("resumed_from", 0)
+            result["overall_rows_per_second"] = written / result["seconds"]
+            if mode == "bulk load" and kill_after is None:
+                kill_after = startup + result["load_seconds"] / 2
+            results.append(result)
+            line = f"  {mode:<28} {result['seconds']:7.1f} s {result['overall_rows_per_second']:9.0f} rows/s " \
+                   f"peak RSS {result['peak_rss'] / 1e6:6.0f} MB"
+            if "rebuild_seconds" in result:
+                line += f"  (load {result['load_seconds']:.1f} s, rebuild {result['rebuild_seconds']:.1f} s)"
+            if result.get("resumed_from"):
+                line += f"  resumed after {result['resumed_from']} rows"
+            if result["complete"] is False:
+                line += "  INCOMPLETE"
+            print(line, flush=True)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    report = {
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": platform.python_version(),
+        "sqlite": sqlite3.sqlite_version,
+        "config": {"rows": args.rows},
+        "modes": results,
+    }
+    os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+    with open(args.output, "w", encoding="utf-8") as f:
+        json.dump(report, f, indent=2, ensure_ascii=False)
+    print(f"results written to {args.output}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,124 @@
+# Benchmark: repeat reads of /patients, /messages/<id> and /treatments/<id>
+#
+# Fills a temporary database with patients and with messages and treatments
+# for a sample of patients, serves app_with_swagger over HTTP on a local
+# port and, for each endpoint, times pages read:
+#   - uncompressed (what every read cost before),
+#   - with gzip and with brotli negotiated,
+#   - again with the ETag of the previous response (304, no rows read), and
+#   - again after a write to the patient, so the ETag no longer matches.
+# Reports the mean latency and the body bytes transferred per request.
+#
+# Usage: python benchmarks/bench_conditional.py [--patients 5000] [--rows 1000] [--requests 200]
+import argparse
+import logging
+import os
+import random
+import shutil
+import sqlite3
+import statistics
+import sys
+import tempfile
+import threading
+import time
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+WORKDIR = tempfile.mkdtemp(prefix="bench_conditional_")
+os.environ["EHOSPITAL_DB"] = os.path.join(WORKDIR, "database.db")
+sys.path.insert(0, REPO)
+os.chdir(REPO)
+
+import httpx
+from werkzeug.serving import make_server
+from utils import init_db
+from db import DATABASE
+
+def fill(patients, rows, sample):
+    rng = random.Random(0)
+    conn = sqlite3.connect(DATABASE)
+    with conn:
+        conn.executemany("INSERT OR REPLACE INTO patients (id, uuid, Age, Gender, FName, LName, EmailId, password) "
+                         "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                         [(i, f"uuid-{i}", rng.randrange(18, 90), rng.choice("MF"), f"First{i}", f"Last{i}",
+                           f"patient{i}@example.com", "secret") for i in range(1, patients + 1)])
+        for patient in sample:
+            conn.executemany("INSERT INTO messages (patient_id, doctor_id, patient_FName, patient_LName, message, time_stamp) "
+                             "VALUES (?, ?, ?, ?, ?, datetime('now'))",
+                             [(patient, rng.randrange(1, 50), "Pat", "Ient",
+                               f"Hello doctor, my blood pressure was {rng.randrange(90, 180)} this morning")
+                              for _ in range(rows)])
+            conn.executemany("INSERT INTO patients_treatment (patient_id, doctor_id, treatment, RecordDate, disease_type) "
+                             "VALUES (?, ?, ?, ?, ?)",
+                             [(patient, rng.randrange(1, 50), f"Insulin {rng.randrange(5, 40)} units, twice daily",
+                               f"2024-{rng.randrange(1, 13):02d}-{rng.randrange(1, 29):02d}", "Diabetes")
+                              for _ in range(rows)])
+    conn.close()
+
+# Mean latency and body bytes of n GETs of url with the given headers
+def measure(client, url, headers, n, expect):
+    latencies, sizes = [], []
+    for _ in range(n):
+        start = time.perf_counter()
+        response = client.get(url, headers=headers)
+        latencies.append(time.perf_counter() - start)
+        assert response.status_code == expect, (url, response.status_code)
+        sizes.append(response.num_bytes_downloaded)
+    return statistics.mean(latencies), statistics.mean(sizes), response
+
+def report(label, latency, size):
+    print(f"  {label:<44} {latency * 1000:8.2f} ms {size:10.0f} bytes")
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--patients", type=int, default=5000)
+    parser.add_argument("--rows", type=int, default=1000, help="messages and treatments per sampled patient")
+    parser.add_argument("--requests", type=int, default=200, help="requests per measurement")
+    args = parser.parse_args()
+
+    init_db()
+    sample = [1, 2, 3]
+    fill(args.patients, args.rows, sample)
+    import app_with_swagger
+    logging.getLogger("werkzeug").setLevel(logging.WARNING)
+    server = make_server("127.0.0.1", 0, app_with_swagger.app, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    base_url = f"http://127.0.0.1:{server.server_port}"
+    print(f"{args.patients} patients, {args.rows} messages and treatments per patient, "
+          f"mean of {args.requests} requests over local HTTP")
+
+    endpoints = (
+        ("/patients?limit=1000", None),
+        (f"/messages/{sample[0]}?limit=1000", ("messages", sample[0])),
+        (f"/treatments/{sample[0]}?limit=1000", ("treatments", sample[0])),
+    )
+    try:
+        with httpx.Client(base_url=base_url) as client:
+            for url, written in endpoints:
+                print(url)
+                n = args.requests
+                plain = measure(client, url, {"Accept-Encoding": "identity"}, n, 200)
+                report("full response, uncompressed", *plain[:2])
+                report("full response, gzip", *measure(client, url, {"Accept-Encoding": "gzip"}, n, 200)[:2])
+                report("full response, brotli", *measure(client, url, {"Accept-Encoding": "br"}, n, 200)[:2])
+                etag = plain[2].headers["ETag"]
+                cached = {"If-None-Match": etag, "Accept-Encoding": "br, gzip"}
+                report("repeat with If-None-Match: 304", *measure(client, url, cached, n, 304)[:2])
+                if written:
+                    conn = sqlite3.connect(DATABASE)
+                    with conn:
+                        if written[0] == "messages":
+                            conn.execute("INSERT INTO messages (patient_id, doctor_id, message) VALUES (?, 1, 'new')",
+                                         (written[1],))
+                        else:
+                            conn.execute("INSERT INTO patients_treatment (patient_id, doctor_id, treatment) "
+                                         "VALUES (?, 1, 'new')", (written[1],))
+                    conn.close()
+                    report("after a write, old ETag: 200", *measure(client, url, cached, 1, 200)[:2])
+    finally:
+        server.shutdown()
+
+if __name__ == "__main__":
+    try:
+        main()
+    finally:
+        shutil.rmtree(WORKDIR, ignore_errors=True)
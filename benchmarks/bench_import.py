@@ -0,0 +1,117 @@
+# Benchmark and startup budget: import time of the FastAPI and Flask apps
+#
+# Imports each app in fresh interpreters under `python -X importtime`,
+# reports the median total and the slowest modules and packages of the
+# median run, and checks two budgets:
+#   - the median import time stays under BUDGETS_MS (times --budget-scale,
+#     for slower machines), and
+#   - none of the DEFERRED modules is loaded by importing the app; they
+#     belong to subsystems that load them on first use.
+# Exits with status 1 when a budget is exceeded, so it can gate a build.
+#
+# Usage: python benchmarks/bench_import.py [--runs 7] [--budget-scale 1.0] [--output results.json]
+import argparse
+import json
+import os
+import platform
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO = os.path.dirname(BENCH_DIR)
+
+# Median import time allowed per app, measured with headroom on a 1-CPU VM
+BUDGETS_MS = {"main": 900, "app_with_swagger": 700}
+
+# Loaded on first use: CSV import (init_db), speech recognition, speech
+# synthesis, the remote API client, cohort analytics
+DEFERRED = (
+    "csv_import", "speech_recognition", "multiprocessing", "concurrent.futures.process",
+    "pyttsx3", "httpx", "pandas", "numpy",
+)
+
+# One `python -X importtime` run: {module: (self_us, cumulative_us)} and the modules loaded
+def profile(module, env):
+    check = f"import sys, json; import {module}; print(json.dumps(sorted(sys.modules)))"
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", check],
+                            cwd=REPO, env=env, capture_output=True, text=True, check=True)
+    timings = {}
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        self_us, cumulative_us, name = line[len("import time:"):].split("|")
+        timings[name.strip()] = (int(self_us), int(cumulative_us))
+    return timings, json.loads(result.stdout.splitlines()[-1])
+
+def by_package(timings):
+    packages = {}
+    for name, (self_us, _) in timings.items():
+        package = name.split(".")[0]
+        packages[package] = packages.get(package, 0) + self_us
+    return packages
+
+def measure(module, budget, env, args):
+    profile(module, env)  # compile bytecode and warm the page cache
+    runs = [profile(module, env) for _ in range(args.runs)]
+    totals = [timings[module][1] / 1000 for timings, _ in runs]
+    median = statistics.median(totals)
+    timings, loaded = min(runs, key=lambda run: abs(run[0][module][1] / 1000 - median))
+    deferred = [name for name in DEFERRED if name in loaded]
+
+    print(f"{module}: median {median:.1f} ms (min {min(totals):.1f}, max {max(totals):.1f}), "
+          f"budget {budget:.0f} ms, {len(loaded)} modules loaded")
+    print("  slowest modules (cumulative ms):")
+    slowest = sorted(timings.items(), key=lambda item: -item[1][1])
+    for name, (_, cumulative_us) in [item for item in slowest if item[0] != module][:args.top]:
+        print(f"    {name:<44} {cumulative_us / 1000:8.1f}")
+    packages = sorted(by_package(timings).items(), key=lambda item: -item[1])
+    print("  packages (self ms): " + ", ".join(f"{name} {us / 1000:.1f}" for name, us in packages[:args.top]))
+
+    problems = []
+    if median > budget:
+        problems.append(f"{module} imports in {median:.1f} ms, over its {budget:.0f} ms budget")
+    if deferred:
+        problems.append(f"{module} loads {', '.join(deferred)} at import")
+    result = {
+        "median_ms": median, "runs_ms": totals, "budget_ms": budget, "modules_loaded": len(loaded),
+        "deferred_loaded": deferred,
+        "modules": {name: {"self_ms": s / 1000, "cumulative_ms": c / 1000} for name, (s, c) in slowest},
+    }
+    return module, result, problems
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--runs", type=int, default=7)
+    parser.add_argument("--top", type=int, default=12)
+    parser.add_argument("--budget-scale", type=float, default=1.0)
+    parser.add_argument("--output", default=os.path.join(BENCH_DIR, "results", "bench_import.json"))
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix="bench_import_")
+    env = dict(os.environ, EHOSPITAL_DB=os.path.join(workdir, "database.db"),
+               EHOSPITAL_SESSION_DB=os.path.join(workdir, "sessions.db"), PYTHONWARNINGS="ignore")
+    report = {"timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"), "python": platform.python_version(),
+              "cpus": os.cpu_count(), "apps": {}}
+    failures = []
+    try:
+        results = [measure(module, budget * args.budget_scale, env, args) for module, budget in BUDGETS_MS.items()]
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+    for module, result, problems in results:
+        report["apps"][module] = result
+        failures += problems
+
+    os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+    with open(args.output, "w", encoding="utf-8") as f:
+        json.dump(report, f, indent=2)
+    print(f"results written to {args.output}")
+    for failure in failures:
+        print(f"FAIL: {failure}")
+    return 1 if failures else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
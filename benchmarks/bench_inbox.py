@@ -0,0 +1,161 @@
+# Benchmark: doctor inbox reads against re-reading and counting messages
+#
+# Fills a temporary database with N messages spread over doctors and
+# patients, then times, for a sample of doctors:
+#   - "what's new" with a recent cursor and with cursor 0 through
+#     inbox.messages_since, against re-reading the doctor's messages (a full
+#     scan before the doctor index existed),
+#   - unread totals and inbox pages from the maintained message_threads
+#     counts, against counting and grouping messages per request,
+#   - the cost of the thread triggers on batched inserts, and
+#   - how soon a long-poll waiter wakes after the message writer commits.
+#
+# Usage: python benchmarks/bench_inbox.py [--messages 1000000] [--doctors 500] [--patients 20000]
+import argparse
+import os
+import random
+import shutil
+import sqlite3
+import statistics
+import sys
+import tempfile
+import threading
+import time
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+WORKDIR = tempfile.mkdtemp(prefix="bench_inbox_")
+os.environ["EHOSPITAL_DB"] = os.path.join(WORKDIR, "database.db")
+sys.path.insert(0, REPO)
+
+from utils import TABLE_SCHEMAS, INDEXES
+from db import DATABASE, query_all, query_one
+from message_queue import MessageWriter, insert_messages_sql
+import inbox
+
+COLUMNS = ", ".join(inbox.MESSAGE_COLUMNS)
+BATCH = 500
+
+def message_rows(count, doctors, patients, seed=0):
+    rng = random.Random(seed)
+    # Each patient writes to one or two doctors, like patient_doctor assignments
+    assigned = {p: rng.sample(range(1, doctors + 1), rng.choice((1, 1, 2))) for p in range(1, patients + 1)}
+    for _ in range(count):
+        patient = rng.randrange(1, patients + 1)
+        yield (patient, rng.choice(assigned[patient]), "Pat", "Ient", f"message {rng.randrange(10 ** 6)}")
+
+def insert(conn, rows):
+    for i in range(0, len(rows), BATCH):
+        batch = rows[i:i + BATCH]
+        conn.execute(insert_messages_sql(len(batch)), [value for row in batch for value in row])
+    conn.commit()
+
+# Time func once; per divides the time among the items it handled
+def timed(label, func, per=1):
+    start = time.perf_counter()
+    result = func()
+    elapsed = (time.perf_counter() - start) / per
+    print(f"  {label:<64} {elapsed * 1000:10.3f} ms")
+    return result
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--messages", type=int, default=1_000_000)
+    parser.add_argument("--doctors", type=int, default=500)
+    parser.add_argument("--patients", type=int, default=20_000)
+    parser.add_argument("--sample", type=int, default=20, help="doctors timed per read")
+    args = parser.parse_args()
+
+    conn = sqlite3.connect(DATABASE)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute(TABLE_SCHEMAS["messages"])
+    print(f"{args.messages} messages, {args.doctors} doctors, {args.patients} patients")
+
+    print("build")
+    rows = list(message_rows(args.messages, args.doctors, args.patients))
+    timed("insert messages", lambda: insert(conn, rows))
+    timed("create (patient_id, time_stamp), (doctor_id, time_stamp) indexes", lambda: (
+        [conn.execute(statement) for statement in INDEXES if "messages" in statement], conn.commit()))
+    built = timed("build_inbox (backfill message_threads)", lambda: inbox.build_inbox(conn))
+    threads = conn.execute("SELECT count(*) FROM message_threads").fetchone()[0]
+    print(f"    {threads} threads, backfill {built * 1000:.0f} ms")
+
+    extra = list(message_rows(10_000, args.doctors, args.patients, seed=1))
+    timed("insert 10000 messages, thread triggers", lambda: insert(conn, extra))
+    for name in ("trg_threads_insert", "trg_threads_delete", "trg_threads_move"):
+        conn.execute(f"DROP TRIGGER {name}")
+    timed("insert 10000 messages, no thread triggers", lambda: insert(conn, extra))
+    conn.execute("DELETE FROM messages WHERE id > ?", (args.messages + len(extra),))
+    conn.commit()
+    for statement in inbox.THREADS_TRIGGERS:
+        conn.execute(statement)
+    # The last 10000 messages are unread
+    conn.execute("UPDATE message_threads SET read_through_id = ?", (args.messages,))
+    conn.execute("""UPDATE message_threads SET unread_count = (SELECT count(*) FROM messages m
+        WHERE m.doctor_id = message_threads.doctor_id AND m.patient_id = message_threads.patient_id AND m.id > ?)""",
+                 (args.messages,))
+    conn.commit()
+    conn.close()
+
+    doctors = random.Random(2).sample(range(1, args.doctors + 1), args.sample)
+    latest = query_one("SELECT max(id) FROM messages")[0]
+    recent = latest - 1000
+    n = len(doctors)
+
+    print(f"what's new, per doctor (mean of {n})")
+    timed("re-read the doctor's messages, no doctor index (before)", lambda: [query_all(
+        f"SELECT {COLUMNS} FROM messages WHERE +doctor_id = ? ORDER BY id", (d,)) for d in doctors], n)
+    timed("re-read the doctor's messages, doctor index", lambda: [query_all(
+        f"SELECT {COLUMNS} FROM messages WHERE doctor_id = ? ORDER BY id", (d,)) for d in doctors], n)
+    timed("messages_since(recent cursor): rowid range", lambda: [
+        inbox.messages_since(d, recent) for d in doctors], n)
+    timed("  same cursor through the doctor index instead", lambda: [query_all(
+        f"SELECT {COLUMNS} FROM messages WHERE doctor_id = ? AND id > ? ORDER BY id LIMIT ?",
+        (d, recent, inbox.FEED_LIMIT)) for d in doctors], n)
+    timed("messages_since(0): doctor index", lambda: [inbox.messages_since(d, 0) for d in doctors], n)
+    timed("  cursor 0 through the rowid range instead", lambda: [query_all(
+        f"SELECT {COLUMNS} FROM messages WHERE +doctor_id = ? AND id > ? ORDER BY id LIMIT ?",
+        (d, 0, inbox.FEED_LIMIT)) for d in doctors], n)
+    timed("messages_since(latest): nothing new", lambda: [inbox.messages_since(d, latest) for d in doctors], n)
+
+    print(f"unread counts and inbox page, per doctor (mean of {n})")
+    timed("count unread messages per request", lambda: [query_one(
+        "SELECT count(*) FROM messages WHERE doctor_id = ? AND id > ?", (d, args.messages)) for d in doctors], n)
+    timed("unread() from message_threads", lambda: [inbox.unread(d) for d in doctors], n)
+    timed("group the doctor's messages into threads per request", lambda: [query_all(
+        "SELECT patient_id, count(*), max(id), sum(id > ?) FROM messages WHERE doctor_id = ? "
+        "GROUP BY patient_id ORDER BY max(id) DESC LIMIT 50", (args.messages, d)) for d in doctors], n)
+    timed("threads() page of 50", lambda: [inbox.threads(d) for d in doctors], n)
+    timed("mark_read on a thread", lambda: [inbox.mark_read(
+        d, inbox.threads(d, limit=1)[0]["patient_id"]) for d in doctors], n)
+
+    print("long poll")
+    writer = MessageWriter(DATABASE)
+    writer.listeners.append(inbox.feed.publish)
+    doctor = doctors[0]
+    delays = []
+    for _ in range(50):
+        since = query_one("SELECT max(id) FROM messages")[0]
+        woken = threading.Event()
+
+        def waiter():
+            if inbox.feed.poll(doctor, since, timeout=5):
+                woken.set()
+        thread = threading.Thread(target=waiter)
+        thread.start()
+        time.sleep(0.01)  # let the waiter block
+        start = time.perf_counter()
+        writer.submit((1, doctor, "Pat", "Ient", "ping")).result(5)
+        woken.wait(5)
+        delays.append(time.perf_counter() - start)
+        thread.join()
+    writer.stop()
+    delays.sort()
+    print(f"  submit -> waiter has the message: median {statistics.median(delays) * 1000:.2f} ms, "
+          f"max {delays[-1] * 1000:.2f} ms (polling every {inbox.FEED_RECHECK:.0f} s would average "
+          f"{inbox.FEED_RECHECK / 2 * 1000:.0f} ms)")
+
+if __name__ == "__main__":
+    try:
+        main()
+    finally:
+        shutil.rmtree(WORKDIR, ignore_errors=True)
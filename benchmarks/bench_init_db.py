@@ -0,0 +1,84 @@
+# Benchmark: startup database import, legacy pandas replace vs incremental upsert
+#
+# Usage: python benchmarks/bench_init_db.py [--scale N]
+# --scale repeats every CSV N times (with shifted ids) to simulate larger exports.
+import argparse
+import csv
+import os
+import shutil
+import sqlite3
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import utils
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+def make_data_dir(target, scale):
+    os.makedirs(target)
+    for _, name, _ in utils.CSV_TABLES:
+        source = os.path.join(REPO, "data", name)
+        with open(source, newline="", encoding="utf-8-sig") as f:
+            reader = csv.reader(f)
+            header = next(reader)
+            rows = list(reader)
+        offset = max(int(row[0]) for row in rows) + 1
+        with open(os.path.join(target, name), "w", newline="", encoding="utf-8") as f:
+            writer = csv.writer(f)
+            writer.writerow(header)
+            for k in range(scale):
+                for row in rows:
+                    writer.writerow([int(row[0]) + k * offset] + row[1:])
+
+# What init_db did before: pandas read_csv + to_sql(if_exists="replace") for every file
+def legacy_init(database, data_dir):
+    import pandas as pd
+    conn = sqlite3.connect(database)
+    for table, name, columns in utils.CSV_TABLES:
+        df = pd.read_csv(os.path.join(data_dir, name))
+        (df[columns] if columns else df).to_sql(table, conn, if_exists="replace", index=False)
+    conn.commit()
+    conn.close()
+
+def timed(func, *args, **kwargs):
+    start = time.perf_counter()
+    func(*args, **kwargs)
+    return time.perf_counter() - start
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--scale", type=int, default=1)
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix="bench_init_db_")
+    try:
+        data_dir = os.path.join(workdir, "data")
+        make_data_dir(data_dir, args.scale)
+        start = time.perf_counter()
+        import pandas  # noqa: F401  (counted in the legacy startup cost)
+        pandas_import = time.perf_counter() - start
+
+        legacy = timed(legacy_init, os.path.join(workdir, "legacy.db"), data_dir)
+        database = os.path.join(workdir, "incremental.db")
+        cold = timed(utils.init_db, database=database, data_dir=data_dir)
+        warm = timed(utils.init_db, database=database, data_dir=data_dir)
+        os.utime(os.path.join(data_dir, utils.CSV_TABLES[-1][1]))
+        touched = timed(utils.init_db, database=database, data_dir=data_dir)
+        with open(os.path.join(data_dir, utils.CSV_TABLES[-1][1]), "a", encoding="utf-8") as f:
+            f.write("999999999,1,1,Appended row,2025-01-01T00:00:00.000Z,,\n")
+        one_changed = timed(utils.init_db, database=database, data_dir=data_dir)
+    finally:
+        shutil.rmtree(workdir)
+
+    print(f"\nscale: {args.scale}x")
+    print(f"legacy pandas replace     : {(legacy + pandas_import) * 1000:9.1f} ms (incl. {pandas_import * 1000:.0f} ms pandas import)")
+    print(f"incremental, cold start   : {cold * 1000:9.1f} ms")
+    print(f"incremental, warm start   : {warm * 1000:9.1f} ms")
+    print(f"warm, one file touched    : {touched * 1000:9.1f} ms")
+    print(f"warm, one file changed    : {one_changed * 1000:9.1f} ms")
+
+if __name__ == "__main__":
+    main()
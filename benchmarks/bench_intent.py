@@ -0,0 +1,88 @@
+# Microbenchmark: legacy match_keyword cascade vs the precompiled IntentMatcher
+#
+# Usage: python benchmarks/bench_intent.py [--rounds N]
+import argparse
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from utils import clean_text, match_keyword
+from intent import FIELD_KEYWORDS, TOPIC_KEYWORDS, field_matcher, topic_matcher
+
+MESSAGES = [
+    "what is my heart rate", "show me my bmi please", "blood pressure", "my blod presure",
+    "latest blood sugar", "treatment history", "hello", "hi there", "how is my glucose",
+    "total cholesterol level", "am i a current smoker", "tell me about my diabetes",
+    "ضربان قلب من چنده", "فشار خون", "قند خون من", "درمان", "سلام", "آزمایش خون",
+    "i feel good today", "what is the weather like", "other test", "systolic bp and diastolic bp",
+]
+
+# Reference implementation: the loops routes.chat used before IntentMatcher
+def legacy_match(message):
+    for field, keywords in FIELD_KEYWORDS.items():
+        for word in clean_text(message).split():
+            if match_keyword(word, keywords):
+                return field
+    for topic, keywords in TOPIC_KEYWORDS.items():
+        if match_keyword(message, keywords):
+            return topic
+    return None
+
+def clear_caches():
+    field_matcher._score_term.cache_clear()
+    topic_matcher._score_term.cache_clear()
+
+def indexed_match(message):
+    field, _ = field_matcher.match(message)
+    if field:
+        return field
+    topic, _ = topic_matcher.match(message)
+    return topic
+
+# Random typos so the corpus also covers near misses around the threshold
+def make_corpus(size, seed=7):
+    rng = random.Random(seed)
+    corpus = []
+    for _ in range(size):
+        chars = list(rng.choice(MESSAGES))
+        for _ in range(rng.randint(0, 3)):
+            position = rng.randrange(len(chars))
+            chars[position] = rng.choice("abcdefghijklmnopqrstuvwxyz ")
+        corpus.append("".join(chars).lower())
+    return corpus
+
+def timed(func, corpus, rounds):
+    start = time.perf_counter()
+    for _ in range(rounds):
+        for message in corpus:
+            func(message)
+    return time.perf_counter() - start
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rounds", type=int, default=3)
+    parser.add_argument("--size", type=int, default=500)
+    args = parser.parse_args()
+
+    corpus = make_corpus(args.size)
+    mismatches = [m for m in corpus if legacy_match(m) != indexed_match(m)]
+    if mismatches:
+        print(f"Result mismatch on {len(mismatches)} messages, e.g. {mismatches[:3]}")
+        sys.exit(1)
+
+    legacy = timed(legacy_match, corpus, args.rounds)
+    # Cold: the per-term cache is cleared before every message
+    cold = timed(lambda message: (clear_caches(), indexed_match(message)), corpus, args.rounds)
+    clear_caches()
+    warm = timed(indexed_match, corpus, args.rounds)
+    total = len(corpus) * args.rounds
+    print(f"messages: {total}, identical results: yes")
+    print(f"legacy cascade        : {legacy / total * 1e6:9.1f} us/message")
+    print(f"intent matcher (cold) : {cold / total * 1e6:9.1f} us/message  ({legacy / cold:.1f}x)")
+    print(f"intent matcher (warm) : {warm / total * 1e6:9.1f} us/message  ({legacy / warm:.1f}x)")
+
+if __name__ == "__main__":
+    main()
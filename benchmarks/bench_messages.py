@@ -0,0 +1,67 @@
+# Benchmark: message inserts per second, one commit per message vs group commit
+#
+# Usage: python benchmarks/bench_messages.py [--threads N] [--messages N]
+import argparse
+import os
+import shutil
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from message_queue import MessageWriter, INSERT_MESSAGE
+from utils import init_db
+
+ROW = (132, 81, "Kate", "Evans", "Kate : benchmark message")
+
+# What send_message did before: connect, insert, commit, close for every message
+def legacy_insert(path):
+    conn = sqlite3.connect(path, timeout=30)
+    conn.execute(INSERT_MESSAGE, ROW)
+    conn.commit()
+    conn.close()
+
+def run_threads(threads, per_thread, send):
+    def worker():
+        for _ in range(per_thread):
+            send()
+    pool = [threading.Thread(target=worker) for _ in range(threads)]
+    start = time.perf_counter()
+    for t in pool:
+        t.start()
+    for t in pool:
+        t.join()
+    return threads * per_thread / (time.perf_counter() - start)
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--threads", type=int, default=16)
+    parser.add_argument("--messages", type=int, default=200, help="messages per thread")
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix="bench_messages_")
+    try:
+        path = os.path.join(workdir, "database.db")
+        init_db(database=path)
+        conn = sqlite3.connect(path)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.close()
+        results = [("one commit per message", run_threads(args.threads, args.messages, lambda: legacy_insert(path)), "")]
+        for window_ms in (0, 1, 2, 5, 10):
+            writer = MessageWriter(path, window=window_ms / 1000)
+            rate = run_threads(args.threads, args.messages, lambda: writer.submit(ROW).result())
+            writer.stop()
+            batch = writer.stats["messages"] / writer.stats["commits"]
+            results.append((f"group commit, {window_ms:>2} ms window", rate, f"avg batch {batch:.1f}"))
+    finally:
+        shutil.rmtree(workdir)
+
+    print(f"\n{args.threads} threads x {args.messages} messages, synchronous=FULL")
+    for name, rate, note in results:
+        print(f"{name:28s} {rate:9.0f} msg/s  {note}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,63 @@
+# Benchmark: blocking full-table download per question vs the cached async client
+#
+# Usage: python benchmarks/bench_remote.py [--patients N] [--questions N] [--delay S]
+import argparse
+import asyncio
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import requests
+from remote import RemoteClient
+from stub_api import StubAPI, heart_disease_rows
+
+# What get_heart_disease_data did before: download everything, scan for one patient
+def legacy_lookup(base_url, patient_id):
+    data = requests.get(f"{base_url}/table/heart_disease_test").json()
+    records = [record for record in data if record.get("patient_id") == patient_id]
+    return records[-1] if records else None
+
+async def cached_lookups(base_url, patient_ids, concurrency):
+    client = RemoteClient(base_url, ttl=0.05)
+    table = client.table("heart_disease_test")
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def lookup(patient_id):
+        async with semaphore:
+            return await table.get(patient_id)
+
+    try:
+        start = time.perf_counter()
+        results = await asyncio.gather(*(lookup(p) for p in patient_ids))
+        elapsed = time.perf_counter() - start
+    finally:
+        await client.aclose()
+    return results, elapsed, table.stats
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--patients", type=int, default=5000)
+    parser.add_argument("--questions", type=int, default=200)
+    parser.add_argument("--concurrency", type=int, default=50)
+    parser.add_argument("--delay", type=float, default=0.02, help="simulated server latency (s)")
+    args = parser.parse_args()
+
+    patient_ids = [(i * 37) % args.patients + 1 for i in range(args.questions)]
+    with StubAPI({"heart_disease_test": heart_disease_rows(args.patients)}, delay=args.delay) as stub:
+        start = time.perf_counter()
+        expected = [legacy_lookup(stub.base_url, p) for p in patient_ids]
+        legacy = time.perf_counter() - start
+        legacy_requests = stub.requests
+
+        results, cached, stats = asyncio.run(cached_lookups(stub.base_url, patient_ids, args.concurrency))
+        assert results == expected, "cached client returned different records"
+
+    print(f"questions: {args.questions}, table rows: {args.patients}, server delay: {args.delay}s")
+    print(f"blocking requests.get : {legacy:8.3f} s  ({legacy_requests} full downloads)")
+    print(f"cached async client   : {cached:8.3f} s  (stats: {stats})")
+    print(f"speedup               : {legacy / cached:8.1f}x")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,151 @@
+# Benchmark: FTS5 search against LIKE scans on a synthetic patients_treatment table
+#
+# Generates N treatments (English and Persian) and messages in a temporary
+# database, builds the trigram search indexes and times common, selective,
+# Persian, missing and misspelled queries through search.search and through
+# the LIKE '%...%' scan it replaces. Also measures the index build, its size,
+# the trigger cost on inserts and the per-patient lookup of the chat helpers.
+#
+# Usage: python benchmarks/bench_search.py [--rows 1000000] [--messages 200000]
+import argparse
+import os
+import random
+import shutil
+import sqlite3
+import sys
+import tempfile
+import time
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+WORKDIR = tempfile.mkdtemp(prefix="bench_search_")
+os.environ["EHOSPITAL_DB"] = os.path.join(WORKDIR, "database.db")
+sys.path.insert(0, REPO)
+
+from utils import TABLE_SCHEMAS, INDEXES, PATIENT_TREATMENTS_SQL
+from search import search, build_search_index, latest_matching, exact_query
+from db import DATABASE, query_all, query_one
+from csv_import import STATEMENT_ROWS
+
+TREATMENTS = (
+    "Blood Pressure: {}/{}", "Blood Test: hemoglobin {}.{}", "Physiotherapy session {} of {}",
+    "Insulin {} units, {} times daily", "فشار خون {}/{}", "آزمایش خون: هموگلوبین {}.{}",
+    "Antibiotics course, {} mg for {} days", "MRI scan, follow-up in {} weeks ({})",
+)
+DISEASES = ("Hypertension", "Diabetes", "Asthma", "Influenza", "دیابت", "میگرن", "Migraine", "Arthritis")
+MESSAGES = (
+    "Hello doctor, my blood pressure was {} this morning", "Can I take the medicine after {} pm?",
+    "سلام دکتر، قند خونم {} بود", "Thank you, see you on day {}", "I still have headaches since {} days",
+)
+
+QUERIES = (
+    ("common", "blood pressure"),
+    ("selective", "hemoglobin 123.4"),
+    ("persian", "فشار خون 120"),
+    ("disease type", "migraine"),
+    ("no match", "chemotherapy"),
+    ("misspelled", "physioterapy"),
+)
+
+def treatment_rows(count, patients, seed=0):
+    rng = random.Random(seed)
+    for i in range(1, count + 1):
+        text = rng.choice(TREATMENTS).format(rng.randrange(90, 180), rng.randrange(1, 100))
+        date = f"20{rng.randrange(15, 25)}-{rng.randrange(1, 13):02d}-{rng.randrange(1, 29):02d}"
+        yield (i, rng.randrange(1, patients + 1), rng.randrange(1, 200), text, date, rng.choice(DISEASES), 1)
+
+def message_rows(count, patients, seed=1):
+    rng = random.Random(seed)
+    for i in range(1, count + 1):
+        text = rng.choice(MESSAGES).format(rng.randrange(1, 200))
+        yield (i, rng.randrange(1, patients + 1), rng.randrange(1, 200), "Dr", "Who", "Pat", "Ient", text, "", "")
+
+def timed(label, func, repeat=1):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        result = func()
+    elapsed = (time.perf_counter() - start) / repeat
+    print(f"  {label:<56} {elapsed * 1000:10.3f} ms")
+    return result
+
+# Several rows per INSERT, the way csv_import and the message writer write
+def insert_many(conn, rows):
+    values = ", ".join(["(?, ?, ?, ?, ?, ?, ?)"] * len(rows))
+    conn.execute(f"INSERT INTO patients_treatment VALUES {values}", [value for row in rows for value in row])
+
+def like_scan(text, limit=20):
+    pattern = f"%{text}%"
+    return query_all("SELECT id FROM patients_treatment WHERE treatment LIKE ? OR disease_type LIKE ? "
+                     "ORDER BY id DESC LIMIT ?", (pattern, pattern, limit))
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rows", type=int, default=1_000_000)
+    parser.add_argument("--messages", type=int, default=200_000)
+    parser.add_argument("--patients", type=int, default=20_000)
+    args = parser.parse_args()
+
+    conn = sqlite3.connect(DATABASE)
+    conn.execute("PRAGMA journal_mode=WAL")
+    for table in ("patients_treatment", "messages"):
+        conn.execute(TABLE_SCHEMAS[table])
+    for statement in INDEXES[1:]:
+        conn.execute(statement)
+    print(f"{args.rows} treatments, {args.messages} messages, {args.patients} patients")
+
+    print("build")
+    timed("insert treatments + messages", lambda: (
+        conn.executemany("INSERT INTO patients_treatment VALUES (?, ?, ?, ?, ?, ?, ?)",
+                         treatment_rows(args.rows, args.patients)),
+        conn.executemany("INSERT INTO messages VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                         message_rows(args.messages, args.patients)),
+        conn.commit(),
+    ))
+    conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+    size = os.path.getsize(DATABASE)
+    built = timed("build search indexes", lambda: build_search_index(conn))
+    for index, seconds in built:
+        print(f"    {index}: {seconds * 1000:.0f} ms")
+    conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+    print(f"  database size: {size / 1e6:.1f} MB without indexes, {os.path.getsize(DATABASE) / 1e6:.1f} MB with")
+
+    extra = list(treatment_rows(10_000, args.patients, seed=2))
+    extra = [(args.rows + i + 1, *row[1:]) for i, row in enumerate(extra)]
+    timed("insert 10000 treatments, one row per statement", lambda: (
+        conn.executemany("INSERT INTO patients_treatment VALUES (?, ?, ?, ?, ?, ?, ?)", extra), conn.commit()))
+    conn.execute("DELETE FROM patients_treatment WHERE id > ?", (args.rows,))
+    conn.commit()
+    timed(f"insert 10000 treatments, {STATEMENT_ROWS} rows per statement", lambda: (
+        [insert_many(conn, extra[i:i + STATEMENT_ROWS]) for i in range(0, len(extra), STATEMENT_ROWS)], conn.commit()))
+    conn.execute("DELETE FROM patients_treatment WHERE id > ?", (args.rows,))
+    conn.commit()
+    conn.execute("DROP TRIGGER trg_treatments_fts_insert")
+    timed("insert 10000 treatments, one row per statement, no index", lambda: (
+        conn.executemany("INSERT INTO patients_treatment VALUES (?, ?, ?, ?, ?, ?, ?)", extra), conn.commit()))
+    conn.close()
+
+    print("whole-table search (20 newest matches)")
+    for name, text in QUERIES:
+        repeat = 20
+        like = timed(f"{name}: LIKE scan", lambda: like_scan(text), repeat)
+        found = timed(f"{name}: search ({exact_query(text)[:24]})", lambda: search("treatments", text), repeat)
+        print(f"    LIKE {len(like)} rows, search {len(found['results'])} rows ({found['match']})")
+    found = timed("messages: search 'blood pressure'", lambda: search("messages", "blood pressure"), 20)
+    print(f"    {len(found['results'])} rows ({found['match']})")
+
+    print("one patient (chat helpers)")
+    patients = range(1, 1001)
+    timed("LIKE on the patient index, 1000 patients", lambda: [query_one(
+        "SELECT treatment, RecordDate FROM patients_treatment WHERE patient_id = ? AND treatment LIKE ? "
+        "ORDER BY RecordDate DESC LIMIT 1", (p, "%blood pressure%")) for p in patients])
+    timed("history + latest_matching (en + fa), 1000 patients", lambda: [latest_matching(
+        query_all(PATIENT_TREATMENTS_SQL, (p,)), "blood pressure") for p in patients])
+    timed("FTS match joined to the patient, 20 patients", lambda: [query_one(
+        "SELECT t.treatment, t.RecordDate FROM patients_treatment t JOIN treatments_fts ON treatments_fts.rowid = t.id "
+        "WHERE treatments_fts MATCH ? AND t.patient_id = ? ORDER BY t.RecordDate DESC LIMIT 1",
+        (exact_query("blood pressure"), p)) for p in range(1, 21)])
+
+if __name__ == "__main__":
+    try:
+        main()
+    finally:
+        shutil.rmtree(WORKDIR, ignore_errors=True)
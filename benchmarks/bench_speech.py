@@ -0,0 +1,111 @@
+# Benchmark: speech-to-text throughput of the recognizer process pool
+#
+# Decodes a set of WAV files inline (one after another on the event loop, as
+# /chat used to) and through SpeechRecognizerPool with several worker counts,
+# and reports files/s, audio seconds decoded per second and the worst event
+# loop stall seen while decoding.
+#
+# Usage: python benchmarks/bench_speech.py [--wav-dir DIR] [--files N] [--workers 1,2,4]
+#                                          [--backend sphinx]
+import argparse
+import asyncio
+import glob
+import math
+import os
+import random
+import struct
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from speech_input import SpeechRecognizerPool, MemorySpeechJobs, transcribe, pcm_to_wav, wav_seconds
+
+# Speech-like test signal: a gliding voiced tone with syllable-rate amplitude
+# changes and background noise, 16 kHz mono
+def synthetic_wav(seconds, seed):
+    rng = random.Random(seed)
+    rate = 16000
+    pitch = rng.uniform(100, 220)
+    samples = []
+    for i in range(int(seconds * rate)):
+        t = i / rate
+        envelope = max(0.0, math.sin(2 * math.pi * 3.5 * t))
+        tone = math.sin(2 * math.pi * pitch * (1 + 0.1 * math.sin(2 * math.pi * 0.7 * t)) * t)
+        samples.append(int(9000 * envelope * tone + rng.gauss(0, 300)))
+    return pcm_to_wav(struct.pack(f"<{len(samples)}h", *samples), rate)
+
+# Runs work() and returns (result, seconds, largest delay of a 10 ms ticker)
+async def with_loop_lag(work):
+    lag = 0.0
+    done = False
+
+    async def ticker():
+        nonlocal lag
+        while not done:
+            start = time.perf_counter()
+            await asyncio.sleep(0.01)
+            lag = max(lag, time.perf_counter() - start - 0.01)
+
+    task = asyncio.create_task(ticker())
+    await asyncio.sleep(0)
+    start = time.perf_counter()
+    result = await work()
+    elapsed = time.perf_counter() - start
+    done = True
+    await task
+    return result, elapsed, lag
+
+async def run_inline(backend, files):
+    async def work():
+        return [transcribe(backend, wav) for wav in files]
+    return await with_loop_lag(work)
+
+async def transcripts(pool, jobs, timeout=600):
+    await asyncio.gather(*(pool.wait(job, timeout) for job in jobs))
+    return [pool.result(job).get("transcript") for job in jobs]
+
+async def run_pool(backend, files, workers):
+    pool = SpeechRecognizerPool(backend, workers, max_pending=len(files), jobs=MemorySpeechJobs())
+    pool.start()
+    # Warm the workers so process start-up is not counted
+    await transcripts(pool, [pool.submit_wav(files[0]) for _ in range(workers)])
+
+    async def work():
+        return await transcripts(pool, [pool.submit_wav(wav) for wav in files])
+    try:
+        return await with_loop_lag(work)
+    finally:
+        pool.stop()
+
+def report(label, files, audio_seconds, elapsed, lag):
+    print(f"{label:<12} {len(files) / elapsed:7.2f} files/s  {audio_seconds / elapsed:7.2f} audio s/s  "
+          f"max loop stall {lag * 1000:8.1f} ms")
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--wav-dir", help="directory of WAV files to decode instead of generated ones")
+    parser.add_argument("--files", type=int, default=16)
+    parser.add_argument("--seconds", type=float, default=3.0, help="length of generated files")
+    parser.add_argument("--workers", default="1,2,4")
+    parser.add_argument("--backend", default="sphinx")
+    args = parser.parse_args()
+
+    if args.wav_dir:
+        paths = sorted(glob.glob(os.path.join(args.wav_dir, "*.wav")))[:args.files]
+        files = [open(path, "rb").read() for path in paths]
+    else:
+        files = [synthetic_wav(args.seconds, seed) for seed in range(args.files)]
+    audio_seconds = sum(wav_seconds(wav) for wav in files)
+    print(f"{len(files)} files, {audio_seconds:.1f} s of audio, backend {args.backend}, {os.cpu_count()} CPUs")
+
+    transcribe(args.backend, files[0])  # load the recognizer model once
+    _, elapsed, lag = asyncio.run(run_inline(args.backend, files))
+    report("inline", files, audio_seconds, elapsed, lag)
+
+    for workers in [int(w) for w in args.workers.split(",")]:
+        _, elapsed, lag = asyncio.run(run_pool(args.backend, files, workers))
+        report(f"pool x{workers}", files, audio_seconds, elapsed, lag)
+
+if __name__ == "__main__":
+    main()
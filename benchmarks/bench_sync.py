@@ -0,0 +1,165 @@
+# Benchmark: mirroring remote tables with sync.TableSync
+#
+# Serves fixture tables from benchmarks/stub_api.py (with a per-request
+# delay standing in for the remote API's latency) and times, on a temporary
+# database:
+#   - a first sync of every table with one download at a time and with
+#     several at once,
+#   - a re-sync when nothing changed (304s) and when 1% of one table's rows
+#     changed, against rewriting the whole table,
+#   - peak Python memory while parsing a large table as it streams in,
+#     against loading the whole response with json.loads, and
+#   - a chat lookup from the mirror against the cached remote client.
+#
+# Usage: python benchmarks/bench_sync.py [--tables 8] [--rows 20000] [--large 200000] [--delay 0.2]
+import argparse
+import asyncio
+import json
+import os
+import shutil
+import sqlite3
+import sys
+import tempfile
+import time
+import tracemalloc
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+WORKDIR = tempfile.mkdtemp(prefix="bench_sync_")
+os.environ["EHOSPITAL_DB"] = os.path.join(WORKDIR, "database.db")
+sys.path.insert(0, REPO)
+
+from stub_api import StubAPI, heart_disease_rows
+from remote import RemoteClient
+from sync import TableSync, JSONArrayParser, build_mirror, local_record, _hash, DATABASE
+
+def table_names(count):
+    return ["heart_disease_test"] + [f"clinical_table_{i}" for i in range(1, count)]
+
+def report(label, seconds, results=None):
+    line = f"  {label:<58} {seconds * 1000:10.3f} ms"
+    if results:
+        totals = {key: sum(r.get(key, 0) for r in results) for key in ("rows", "inserted", "updated", "deleted")}
+        statuses = sorted({r["status"] for r in results})
+        line += f"  {'/'.join(statuses)}: {totals['rows']} rows, +{totals['inserted']} ~{totals['updated']} -{totals['deleted']}"
+    print(line)
+
+def timed_sync(sync, tables=None):
+    start = time.perf_counter()
+    results = asyncio.run(sync.sync_once(tables))
+    return time.perf_counter() - start, results
+
+# What a sync without hashes would do once the response is in: parse it and
+# replace all of the table's rows
+def rewrite_table(name, rows):
+    body = json.dumps(rows)
+    conn = sqlite3.connect(DATABASE)
+    start = time.perf_counter()
+    parser = JSONArrayParser(raw=True)
+    with conn:
+        conn.execute("DELETE FROM remote_rows WHERE table_name = ?", (name,))
+        for i in range(0, len(body), 65536):
+            conn.executemany("INSERT INTO remote_rows (table_name, row_key, patient_id, hash, data) VALUES (?, ?, ?, ?, ?)",
+                             [(name, row["patient_id"], row["patient_id"], _hash(data), data)
+                              for row, data in parser.feed(body[i:i + 65536])])
+    conn.close()
+    return time.perf_counter() - start
+
+def peak_memory(func):
+    tracemalloc.start()
+    func()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return peak
+
+def stream_parse(body, chunk=65536):
+    parser = JSONArrayParser()
+    count = 0
+    for i in range(0, len(body), chunk):
+        count += len(parser.feed(body[i:i + chunk]))
+    parser.close()
+    return count
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--tables", type=int, default=8)
+    parser.add_argument("--rows", type=int, default=20_000, help="rows per table")
+    parser.add_argument("--large", type=int, default=200_000, help="rows of the table parsed for memory")
+    parser.add_argument("--delay", type=float, default=0.2, help="stub server latency (s)")
+    parser.add_argument("--concurrency", type=int, default=4)
+    args = parser.parse_args()
+
+    conn = sqlite3.connect(DATABASE)
+    build_mirror(conn)
+    conn.close()
+    names = table_names(args.tables)
+    tables = {name: heart_disease_rows(args.rows, seed=i) for i, name in enumerate(names)}
+    print(f"{args.tables} tables x {args.rows} rows, {args.delay * 1000:.0f} ms remote latency")
+
+    with StubAPI(tables, delay=args.delay) as stub:
+        print("first sync")
+        serial = TableSync(names, stub.base_url, concurrency=1, database=DATABASE)
+        seconds, results = timed_sync(serial)
+        report("one download at a time", seconds, results)
+        for result in results:
+            print(f"    {result['table']:<20} {result['seconds'] * 1000:8.1f} ms, {result['bytes'] / 1e6:.1f} MB")
+        conn = sqlite3.connect(DATABASE)
+        with conn:
+            conn.execute("DELETE FROM remote_rows")
+            conn.execute("DELETE FROM sync_state")
+        conn.close()
+        concurrent = TableSync(names, stub.base_url, concurrency=args.concurrency, database=DATABASE)
+        seconds, results = timed_sync(concurrent)
+        report(f"{args.concurrency} downloads at once", seconds, results)
+
+        print("re-sync")
+        seconds, results = timed_sync(concurrent)
+        report("nothing changed (conditional requests)", seconds, results)
+        name = names[0]
+        changed = [dict(row, sysBP=row["sysBP"] + 1) if row["patient_id"] % 100 == 0 else row for row in tables[name]]
+        stub.set_table(name, changed)
+        seconds, results = timed_sync(concurrent, [name])
+        report(f"1% of {name} changed, hashed upsert", seconds, results)
+        stub.delay = 0
+        report(f"  parsing and rewriting all {args.rows} rows instead", rewrite_table(name, changed))
+        stub.set_table(name, tables[name])
+        seconds, results = timed_sync(concurrent, [name])
+        report("  same change, hashed upsert, no remote latency", seconds, results)
+
+        print(f"parse {args.large} rows")
+        body = json.dumps(heart_disease_rows(args.large))
+        print(f"  {'response size':<58} {len(body) / 1e6:10.1f} MB")
+        del tables
+        parsed = peak_memory(lambda: stream_parse(body))
+        loaded = peak_memory(lambda: json.loads(body))
+        print(f"  {'peak memory, JSONArrayParser in 64 KB chunks':<58} {parsed / 1e6:10.1f} MB")
+        print(f"  {'peak memory, json.loads of the whole response':<58} {loaded / 1e6:10.1f} MB")
+
+        print("chat lookup of one patient's record (mean of 1000)")
+        patients = range(1, 1001)
+        start = time.perf_counter()
+        for patient_id in patients:
+            local_record(name, patient_id)
+        report("from the mirror", (time.perf_counter() - start) / len(patients))
+
+        async def remote_lookups():
+            client = RemoteClient(stub.base_url)
+            try:
+                start = time.perf_counter()
+                await client.table(name).get(1)
+                first = time.perf_counter() - start
+                start = time.perf_counter()
+                for patient_id in patients:
+                    await client.table(name).get(patient_id)
+                return first, (time.perf_counter() - start) / len(patients)
+            finally:
+                await client.aclose()
+        stub.delay = args.delay
+        first, warm = asyncio.run(remote_lookups())
+        report("remote client, first lookup (downloads the table)", first)
+        report("remote client, cached", warm)
+
+if __name__ == "__main__":
+    try:
+        main()
+    finally:
+        shutil.rmtree(WORKDIR, ignore_errors=True)
@@ -0,0 +1,204 @@
+# Benchmark: /chat throughput against the number of serve.py worker processes
+#
+# Starts serve.py with 1, 2, 4... workers on a temporary database, session
+# store and audio directory, with the remote e-hospital tables served by
+# benchmarks/stub_api.py. Several client processes each run many virtual
+# users over real HTTP connections, logging in and playing scripted English
+# and Persian conversations for a fixed time. Requests completed during the
+# warm-up are not counted.
+#
+# The clients share the machine with the server, so scaling flattens once
+# workers plus clients use every core; the report records the CPU count.
+# Text-to-speech runs as in production: on hosts with eSpeak it renders
+# each new reply in the worker that answered it.
+#
+# Usage: python benchmarks/bench_workers.py [--workers 1,2,4] [--clients 2] [--users 16]
+#                                           [--seconds 10] [--output results.json]
+import argparse
+import asyncio
+import json
+import multiprocessing
+import os
+import platform
+import shutil
+import socket
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO = os.path.dirname(BENCH_DIR)
+sys.path.insert(0, REPO)
+
+from stub_api import StubAPI, heart_disease_rows, blood_sugar_rows
+
+SCRIPTS = {
+    "english": ["hello", "good", "what is my heart rate", "blood pressure", "show my treatment",
+                "blood sugar", "my bmi", "blood test", "thanks"],
+    "persian": ["سلام", "خوب", "ضربان قلب", "فشار خون", "درمان", "قند خون", "گلوکز"],
+}
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, max(0, int(round(fraction * len(sorted_values))) - 1))
+    return sorted_values[index]
+
+def wait_ready(base_url, process, timeout=60):
+    import httpx
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"serve.py exited with {process.returncode}")
+        try:
+            if httpx.get(base_url + "/sessions/stats", timeout=1).status_code == 200:
+                return
+        except httpx.HTTPError:
+            pass
+        time.sleep(0.2)
+    raise RuntimeError("serve.py did not start in time")
+
+# One client process: `users` virtual users in a loop until the deadline.
+# Returns the latencies of requests that finished after warm-up, and errors.
+def run_client(base_url, patients, users, start_at, warmup, seconds, offset):
+    import httpx
+
+    async def user(i, latencies, errors):
+        email, password = patients[(offset + i) % len(patients)]
+        script = SCRIPTS[list(SCRIPTS)[(offset + i) % len(SCRIPTS)]]
+        async with httpx.AsyncClient(base_url=base_url, timeout=30) as client:
+            while time.time() < start_at + warmup + seconds:
+                for message in ["login"] + script:
+                    begun = time.time()
+                    try:
+                        if message == "login":
+                            response = await client.post("/login", json={"email": email, "password": password})
+                        else:
+                            response = await client.post("/chat", json={"message": message})
+                        response.raise_for_status()
+                    except httpx.HTTPError:
+                        errors.append(1)
+                        continue
+                    finished = time.time()
+                    if start_at + warmup <= finished <= start_at + warmup + seconds:
+                        latencies.append(finished - begun)
+
+    async def main():
+        latencies, errors = [], []
+        await asyncio.sleep(max(0.0, start_at - time.time()))
+        await asyncio.gather(*(user(i, latencies, errors) for i in range(users)))
+        return latencies, len(errors)
+
+    return asyncio.run(main())
+
+def run_level(workers, args, env, patients):
+    port = free_port()
+    base_url = f"http://127.0.0.1:{port}"
+    process = subprocess.Popen(
+        [sys.executable, os.path.join(REPO, "serve.py"), "--workers", str(workers),
+         "--host", "127.0.0.1", "--port", str(port)],
+        cwd=REPO, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+    )
+    try:
+        wait_ready(base_url, process)
+        start_at = time.time() + 1.0
+        context = multiprocessing.get_context("spawn")
+        with context.Pool(args.clients) as clients:
+            results = clients.starmap(run_client, [
+                (base_url, patients, args.users, start_at, args.warmup, args.seconds, client * args.users)
+                for client in range(args.clients)
+            ])
+    finally:
+        process.terminate()
+        try:
+            process.wait(30)
+        except subprocess.TimeoutExpired:
+            process.kill()
+    latencies = sorted(latency for client_latencies, _ in results for latency in client_latencies)
+    return {
+        "workers": workers,
+        "requests": len(latencies),
+        "errors": sum(errors for _, errors in results),
+        "throughput_rps": len(latencies) / args.seconds,
+        "latency_ms": {
+            "p50": percentile(latencies, 0.50) * 1e3,
+            "p95": percentile(latencies, 0.95) * 1e3,
+            "p99": percentile(latencies, 0.99) * 1e3,
+        },
+    }
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--workers", default="1,2,4")
+    parser.add_argument("--clients", type=int, default=2, help="load generator processes")
+    parser.add_argument("--users", type=int, default=16, help="virtual users per client process")
+    parser.add_argument("--seconds", type=float, default=10.0)
+    parser.add_argument("--warmup", type=float, default=2.0)
+    parser.add_argument("--remote-delay", type=float, default=0.01, help="stub server latency (s)")
+    parser.add_argument("--output", default=os.path.join(BENCH_DIR, "results", "bench_workers.json"))
+    args = parser.parse_args()
+    levels = [int(w) for w in args.workers.split(",")]
+
+    workdir = tempfile.mkdtemp(prefix="bench_workers_")
+    try:
+        env = dict(
+            os.environ,
+            EHOSPITAL_DB=os.path.join(workdir, "database.db"),
+            EHOSPITAL_SESSION_BACKEND="sqlite",
+            EHOSPITAL_SESSION_DB=os.path.join(workdir, "sessions.db"),
+            EHOSPITAL_AUDIO_DIR=os.path.join(workdir, "audio"),
+            EHOSPITAL_STT_WORKERS="1",
+            # Every virtual user chats from 127.0.0.1 as fast as it can; measure capacity, not limits
+            EHOSPITAL_SESSION_RATE="0",
+            EHOSPITAL_IP_RATE="0",
+            EHOSPITAL_MAX_ACTIVE_CHATS="0",
+        )
+        subprocess.run([sys.executable, "-c", "from utils import init_db; init_db()"],
+                       cwd=REPO, env=env, check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        conn = sqlite3.connect(env["EHOSPITAL_DB"])
+        patients = conn.execute("SELECT EmailId, password FROM patients ORDER BY id").fetchall()
+        patient_count = conn.execute("SELECT MAX(id) FROM patients").fetchone()[0]
+        conn.close()
+
+        tables = {
+            "heart_disease_test": heart_disease_rows(patient_count),
+            "blood_sugar_analysis": blood_sugar_rows(patient_count),
+        }
+        print(f"{os.cpu_count()} CPUs, {args.clients} client processes x {args.users} users, "
+              f"{args.seconds:.0f} s per level")
+        results = []
+        with StubAPI(tables, delay=args.remote_delay) as stub:
+            env["EHOSPITAL_API"] = stub.base_url
+            for workers in levels:
+                result = run_level(workers, args, env, patients)
+                results.append(result)
+                latency = result["latency_ms"]
+                speedup = result["throughput_rps"] / results[0]["throughput_rps"] if results[0]["throughput_rps"] else 0
+                print(f"workers {workers:>2}: {result['throughput_rps']:8.1f} req/s ({speedup:4.2f}x)  "
+                      f"p50 {latency['p50']:7.2f}  p95 {latency['p95']:7.2f}  p99 {latency['p99']:7.2f} ms  "
+                      f"errors {result['errors']}")
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    report = {
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": platform.python_version(),
+        "cpus": os.cpu_count(),
+        "config": {"clients": args.clients, "users_per_client": args.users, "seconds": args.seconds,
+                   "warmup_s": args.warmup, "remote_delay_s": args.remote_delay},
+        "levels": results,
+    }
+    os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+    with open(args.output, "w", encoding="utf-8") as f:
+        json.dump(report, f, indent=2, ensure_ascii=False)
+    print(f"results written to {args.output}")
+
+if __name__ == "__main__":
+    main()
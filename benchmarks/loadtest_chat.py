@@ -0,0 +1,209 @@
+# Load test for the /chat conversation flow, run in-process against the FastAPI app
+#
+# Virtual users log in and play scripted English and Persian conversations
+# (initial -> asked_how_are_you -> ready_to_assist, then data questions).
+# Text-to-speech is replaced with a local fake and the remote e-hospital
+# tables are served by benchmarks/stub_api.py.
+#
+# Usage: python benchmarks/loadtest_chat.py [--concurrency 1,4,16] [--conversations N]
+#                                           [--remote-delay S] [--output results.json]
+import argparse
+import asyncio
+import contextlib
+import json
+import os
+import platform
+import shutil
+import sqlite3
+import sys
+import tempfile
+import time
+from collections import defaultdict
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO = os.path.dirname(BENCH_DIR)
+WORKDIR = tempfile.mkdtemp(prefix="loadtest_chat_")
+os.environ["EHOSPITAL_DB"] = os.path.join(WORKDIR, "database.db")
+os.environ["EHOSPITAL_AUDIO_DIR"] = os.path.join(WORKDIR, "audio")
+# Measure the chat itself: every user shares one client address, so admission limits stay off
+for name in ("EHOSPITAL_SESSION_RATE", "EHOSPITAL_IP_RATE", "EHOSPITAL_MAX_ACTIVE_CHATS"):
+    os.environ.setdefault(name, "0")
+sys.path.insert(0, REPO)
+os.chdir(REPO)
+
+from stub_api import StubAPI, heart_disease_rows, blood_sugar_rows
+
+SCRIPTS = {
+    "english": ["hello", "good", "what is my heart rate", "blood pressure", "show my treatment",
+                "blood sugar", "my bmi", "blood test", "thanks"],
+    "persian": ["سلام", "خوب", "ضربان قلب", "فشار خون", "درمان", "قند خون", "گلوکز"],
+}
+
+# Functions timed per stage; names are attributes of the routes module
+STAGES = {
+    "auth": ["authenticate"],
+    "intent": ["field_matcher", "topic_matcher", "greeting_matcher", "mood_matcher"],
+    "db": ["get_treatment_info", "get_test_results", "get_blood_pressure"],
+    "remote": ["get_heart_disease_data", "get_latest_blood_sugar"],
+    "tts": ["text_to_speech"],
+}
+
+stage_times = defaultdict(list)
+
+def timed(stage, func):
+    if asyncio.iscoroutinefunction(func):
+        async def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return await func(*args, **kwargs)
+            finally:
+                stage_times[stage].append(time.perf_counter() - start)
+    else:
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                stage_times[stage].append(time.perf_counter() - start)
+    return wrapper
+
+# Swap text-to-speech for a fake and wrap every stage with a timer
+def instrument(routes):
+    from tts import audio_id_for
+    routes.text_to_speech = audio_id_for  # hashing stands in for queueing a render
+    for stage, names in STAGES.items():
+        for name in names:
+            target = getattr(routes, name)
+            if hasattr(target, "match"):
+                target.match = timed(stage, target.match)
+            else:
+                setattr(routes, name, timed(stage, target))
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, max(0, int(round(fraction * len(sorted_values))) - 1))
+    return sorted_values[index]
+
+async def conversation(app, credentials, script, latencies):
+    import httpx
+    transport = httpx.ASGITransport(app=app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://loadtest") as client:
+        response = await client.post("/login", json=credentials)
+        response.raise_for_status()
+        for message in script:
+            start = time.perf_counter()
+            response = await client.post("/chat", json={"message": message})
+            latencies.append(time.perf_counter() - start)
+            response.raise_for_status()
+
+async def run_level(app, patients, concurrency, conversations):
+    latencies = []
+    semaphore = asyncio.Semaphore(concurrency)
+    languages = list(SCRIPTS)
+
+    async def user(i):
+        async with semaphore:
+            email, password = patients[i % len(patients)]
+            script = SCRIPTS[languages[i % len(languages)]]
+            await conversation(app, {"email": email, "password": password}, script, latencies)
+
+    stage_times.clear()
+    start = time.perf_counter()
+    await asyncio.gather(*(user(i) for i in range(conversations)))
+    elapsed = time.perf_counter() - start
+    latencies.sort()
+    requests = len(latencies)
+    return {
+        "concurrency": concurrency,
+        "conversations": conversations,
+        "requests": requests,
+        "seconds": elapsed,
+        "throughput_rps": requests / elapsed,
+        "latency_ms": {
+            "mean": sum(latencies) / requests * 1e3,
+            "p50": percentile(latencies, 0.50) * 1e3,
+            "p95": percentile(latencies, 0.95) * 1e3,
+            "p99": percentile(latencies, 0.99) * 1e3,
+            "max": latencies[-1] * 1e3,
+        },
+        "stages_ms": {
+            stage: {
+                "calls": len(times),
+                "total": sum(times) * 1e3,
+                "per_request": sum(times) / requests * 1e3,
+            }
+            for stage, times in sorted(stage_times.items())
+        },
+    }
+
+def print_level(result):
+    latency = result["latency_ms"]
+    print(f"concurrency {result['concurrency']:>3}: {result['throughput_rps']:8.1f} req/s  "
+          f"p50 {latency['p50']:7.2f}  p95 {latency['p95']:7.2f}  p99 {latency['p99']:7.2f} ms")
+    stages = ", ".join(f"{stage} {data['per_request']:.3f}" for stage, data in result["stages_ms"].items())
+    print(f"    per-request stage time (ms): {stages}")
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--concurrency", default="1,4,16,64")
+    parser.add_argument("--conversations", type=int, default=200, help="conversations per concurrency level")
+    parser.add_argument("--remote-delay", type=float, default=0.01, help="stub server latency (s)")
+    parser.add_argument("--output", default=os.path.join(BENCH_DIR, "results", "loadtest_chat.json"))
+    args = parser.parse_args()
+    levels = [int(c) for c in args.concurrency.split(",")]
+
+    from utils import init_db
+    init_db()
+    conn = sqlite3.connect(os.environ["EHOSPITAL_DB"])
+    patients = conn.execute("SELECT EmailId, password FROM patients ORDER BY id").fetchall()
+    patient_count = conn.execute("SELECT MAX(id) FROM patients").fetchone()[0]
+    conn.close()
+
+    tables = {
+        "heart_disease_test": heart_disease_rows(patient_count),
+        "blood_sugar_analysis": blood_sugar_rows(patient_count),
+    }
+    with StubAPI(tables, delay=args.remote_delay) as stub:
+        import remote
+        remote.remote.base_url = stub.base_url
+        import main as app_main
+        import routes
+        instrument(routes)
+
+        async def run_all():
+            results = []
+            for concurrency in levels:
+                results.append(await run_level(app_main.app, patients, concurrency, args.conversations))
+                print_level(results[-1])
+            await remote.remote.aclose()
+            return results
+
+        # The routes still print debug lines; keep them out of the report
+        with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+            results = asyncio.run(run_all())
+        for result in results:
+            print_level(result)
+        stub_requests = stub.requests
+
+    report = {
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": platform.python_version(),
+        "config": {
+            "conversations_per_level": args.conversations,
+            "remote_delay_s": args.remote_delay,
+            "scripts": SCRIPTS,
+        },
+        "remote_requests": stub_requests,
+        "levels": results,
+    }
+    os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+    with open(args.output, "w", encoding="utf-8") as f:
+        json.dump(report, f, indent=2, ensure_ascii=False)
+    print(f"results written to {args.output}")
+
+if __name__ == "__main__":
+    try:
+        main()
+    finally:
+        shutil.rmtree(WORKDIR, ignore_errors=True)
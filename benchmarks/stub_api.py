@@ -0,0 +1,92 @@
+# Local stand-in for the e-hospital /table/<name> API, serving fixture JSON
+#
+# Supports ETag/If-None-Match so conditional refreshes can be exercised, an
+# optional per-request delay, and counts the requests it served.
+import hashlib
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+class StubAPI:
+    def __init__(self, tables, delay=0.0):
+        self.tables = {}
+        self.delay = delay
+        self.requests = 0
+        self.full_responses = 0
+        for name, rows in tables.items():
+            self.set_table(name, rows)
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), self._handler())
+        self.server.daemon_threads = True
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    @property
+    def base_url(self):
+        host, port = self.server.server_address
+        return f"http://{host}:{port}"
+
+    def set_table(self, name, rows):
+        body = json.dumps(rows).encode()
+        self.tables[name] = (body, '"%s"' % hashlib.sha1(body).hexdigest())
+
+    def _handler(self):
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def do_GET(self):
+                stub.requests += 1
+                if stub.delay:
+                    time.sleep(stub.delay)
+                name = self.path.rsplit("/", 1)[-1]
+                if not self.path.startswith("/table/") or name not in stub.tables:
+                    self.send_response(404)
+                    self.send_header("Content-Length", "0")
+                    self.end_headers()
+                    return
+                body, etag = stub.tables[name]
+                if self.headers.get("If-None-Match") == etag:
+                    self.send_response(304)
+                    self.send_header("ETag", etag)
+                    self.send_header("Content-Length", "0")
+                    self.end_headers()
+                    return
+                stub.full_responses += 1
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("ETag", etag)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.server.shutdown()
+        self.server.server_close()
+
+# Fixture rows shaped like the real heart_disease_test and blood_sugar_analysis tables
+def heart_disease_rows(patients, seed=1):
+    import random
+    rng = random.Random(seed)
+    return [{
+        "patient_id": patient_id, "education": rng.randint(1, 4), "currentSmoker": rng.randint(0, 1),
+        "cigsPerDay": rng.randint(0, 30), "BPMeds": 0, "prevalentStroke": 0, "prevalentHyp": rng.randint(0, 1),
+        "diabetes": rng.randint(0, 1), "BMI": round(rng.uniform(18, 35), 2), "totChol": rng.randint(150, 300),
+        "sysBP": rng.randint(100, 180), "diaBP": rng.randint(60, 110), "heartRate": rng.randint(55, 100),
+        "glucose": rng.randint(70, 160), "test_time": "2024-04-07T00:00:00.000Z", "CHD": rng.randint(0, 1),
+    } for patient_id in range(1, patients + 1)]
+
+def blood_sugar_rows(patients, seed=2):
+    import random
+    rng = random.Random(seed)
+    return [{"patient_id": patient_id, "blood_sugar": rng.randint(70, 180), "date": "2024-04-07"}
+            for patient_id in range(1, patients + 1)]
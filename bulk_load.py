@@ -0,0 +1,274 @@
+import argparse
+import csv
+import json
+import os
+import sqlite3
+import time
+from itertools import islice
+from csv_import import IMPORT_LOG_SCHEMA, plan_upsert, file_digest, record_import
+from db import DATABASE, file_lock
+from inbox import rebuild_threads
+from search import rebuild_search_index
+from utils import TABLE_SCHEMAS, CSV_TABLES, bump_versions
+
+# Rows parsed and written with one executemany
+CHUNK_ROWS = 10_000
+
+# Rows written per transaction; the offset reached is committed with them,
+# so an interrupted load resumes from the last of these
+TRANSACTION_ROWS = 250_000
+
+# Page cache of the loading connection, mostly for rebuilding indexes
+CACHE_KB = 65536
+
+# One row per table being (or last) bulk loaded: the file, how far the last
+# committed transaction got, and the index and trigger statements dropped
+# for the load as a JSON list of [type, name, sql], restored when it finishes
+LOAD_STATE_SCHEMA = """CREATE TABLE IF NOT EXISTS bulk_loads (
+    table_name TEXT PRIMARY KEY,
+    path TEXT,
+    size INTEGER,
+    mtime_ns INTEGER,
+    byte_offset INTEGER,
+    rows INTEGER,
+    dropped TEXT,
+    started_at TEXT,
+    updated_at TEXT,
+    finished_at TEXT
+)"""
+
+class LoadError(ValueError):
+    pass
+
+# Lines of a file opened in binary mode, decoded, counting the bytes read.
+# The csv reader takes lines only as it needs them, so once it returns a
+# record, offset is where the next record starts.
+class _Lines:
+    def __init__(self, f):
+        self.f = f
+        self.offset = f.tell()
+        self.encoding = "utf-8-sig" if self.offset == 0 else "utf-8"
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        line = next(self.f)
+        self.offset += len(line)
+        text = line.decode(self.encoding)
+        self.encoding = "utf-8"
+        return text
+
+    def seek(self, offset):
+        self.f.seek(offset)
+        self.offset = offset
+
+# Values are bound with the type their column declares (SQLite's affinity
+# rules); cells that do not parse are stored as text, as SQLite would
+def _cast(declared):
+    if "INT" in declared:
+        convert = int
+    elif any(name in declared for name in ("REAL", "FLOA", "DOUB")):
+        convert = float
+    else:
+        return str
+
+    def cast(value):
+        try:
+            return convert(value)
+        except ValueError:
+            return value
+    return cast
+
+def _secondary(conn, table):
+    return [list(row) for row in conn.execute(
+        "SELECT type, name, sql FROM sqlite_master WHERE tbl_name = ? AND type IN ('index', 'trigger') "
+        "AND sql IS NOT NULL ORDER BY type, name", (table,))]
+
+def _checkpoint(conn, table, offset, rows):
+    conn.execute("UPDATE bulk_loads SET byte_offset = ?, rows = ?, updated_at = datetime('now') WHERE table_name = ?",
+                 (offset, rows, table))
+
+# Recreate the dropped indexes and triggers a table is missing, indexes
+# first so the rebuilds can use them, and if triggers were dropped rebuild
+# what they maintain. Returns the names of what was rebuilt.
+def _restore(conn, table, dropped):
+    existing = {name for _, name, _ in _secondary(conn, table)}
+    for kind, name, statement in sorted(dropped, key=lambda row: row[0] != "index"):
+        if name not in existing:
+            conn.execute(statement)
+    rebuilt = []
+    if any(kind == "trigger" for kind, _, _ in dropped):
+        rebuilt += rebuild_search_index(conn, table)
+        if table == "messages" and rebuild_threads(conn):
+            rebuilt.append("message_threads")
+        bump_versions(conn, table)
+    return rebuilt
+
+# Interrupted loads leave their tables without the indexes and triggers
+# they dropped, and the search indexes, inbox threads and version counters
+# those triggers maintain missing the rows loaded so far. Restores and
+# rebuilds them; the load stays unfinished, so it can still be resumed, but
+# forgets what it dropped, so this is done once. Returns (table, rows,
+# rebuilt) for each load repaired.
+def repair_interrupted(conn):
+    if not conn.execute("SELECT 1 FROM sqlite_master WHERE name = 'bulk_loads'").fetchone():
+        return []
+    repaired = []
+    with conn:
+        for table, rows, dropped in conn.execute("SELECT table_name, rows, dropped FROM bulk_loads "
+                                                 "WHERE finished_at IS NULL AND dropped != '[]'").fetchall():
+            repaired.append((table, rows, _restore(conn, table, json.loads(dropped))))
+            conn.execute("UPDATE bulk_loads SET dropped = '[]' WHERE table_name = ?", (table,))
+    return repaired
+
+# Peak resident memory of this process in bytes (ru_maxrss is in KB on Linux).
+# resource is Unix only and imported here, since init_db imports this module.
+def peak_rss():
+    import resource
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+# Stream the CSV at path into table, chunk_rows rows per executemany and
+# transaction_rows per transaction, upserting by primary key like the
+# startup import. With drop_indexes the table's indexes and triggers are
+# dropped for the load, then recreated, and what the triggers maintain
+# (search indexes, inbox threads, version counters) is rebuilt in one pass.
+# With resume, an interrupted load of the same unchanged file continues
+# from its last committed transaction. Returns a report dict.
+def bulk_load(conn, table, path, columns=None, chunk_rows=CHUNK_ROWS, transaction_rows=TRANSACTION_ROWS,
+              resume=False, drop_indexes=True, progress=None):
+    start = time.perf_counter()
+    conn.execute(IMPORT_LOG_SCHEMA)
+    conn.execute(LOAD_STATE_SCHEMA)
+    if table in TABLE_SCHEMAS:
+        conn.execute(TABLE_SCHEMAS[table])
+    stat = os.stat(path)
+    state = conn.execute("SELECT path, size, mtime_ns, byte_offset, rows, dropped FROM bulk_loads "
+                         "WHERE table_name = ? AND finished_at IS NULL", (table,)).fetchone()
+    # Statements an interrupted load dropped are restored whether or not it is resumed
+    dropped = json.loads(state[5]) if state else []
+    offset = rows = 0
+    if resume and state:
+        if tuple(state[:3]) != (path, stat.st_size, stat.st_mtime_ns):
+            raise LoadError(f"{path} is not the file the interrupted load of {table} was reading, or it has changed; "
+                            "load it without resume to start over")
+        offset, rows = state[3], state[4]
+    resumed_from = rows
+    if drop_indexes:
+        names = {name for _, name, _ in dropped}
+        dropped += [row for row in _secondary(conn, table) if row[1] not in names]
+
+    with open(path, "rb") as f:
+        # Checked before anything is dropped, so a wrong file leaves the table as it was
+        lines = _Lines(f)
+        header = next(csv.reader(lines), None)
+        if header is None:
+            raise LoadError(f"{path} is empty")
+        positions, names, types, insert = plan_upsert(conn, table, header, columns)
+        if not names:
+            raise LoadError(f"{path} has none of the columns of {table}")
+
+        with conn:
+            conn.execute("INSERT INTO bulk_loads (table_name, path, size, mtime_ns, byte_offset, rows, dropped, "
+                         "started_at, updated_at, finished_at) VALUES (?, ?, ?, ?, ?, ?, ?, datetime('now'), "
+                         "datetime('now'), NULL) ON CONFLICT(table_name) DO UPDATE SET path = excluded.path, "
+                         "size = excluded.size, mtime_ns = excluded.mtime_ns, byte_offset = excluded.byte_offset, "
+                         "rows = excluded.rows, dropped = excluded.dropped, updated_at = excluded.updated_at, "
+                         "finished_at = NULL, "
+                         "started_at = CASE WHEN ? THEN bulk_loads.started_at ELSE excluded.started_at END",
+                         (table, path, stat.st_size, stat.st_mtime_ns, offset, rows, json.dumps(dropped), bool(offset)))
+            for kind, name, _ in dropped:
+                conn.execute(f"DROP {kind.upper()} IF EXISTS {name}")
+
+        sql = insert(1)
+        casts = list(zip(positions, [_cast(declared) for declared in types]))
+        if offset:
+            lines.seek(offset)
+        reader = csv.reader(lines)
+        pending = 0
+        while True:
+            chunk = [[None if record[i] == "" else cast(record[i]) for i, cast in casts]
+                     for record in islice(reader, chunk_rows)]
+            if not chunk:
+                break
+            conn.executemany(sql, chunk)
+            rows += len(chunk)
+            pending += len(chunk)
+            if pending >= transaction_rows:
+                _checkpoint(conn, table, lines.offset, rows)
+                conn.commit()
+                pending = 0
+                if progress:
+                    progress(rows, (rows - resumed_from) / (time.perf_counter() - start))
+        _checkpoint(conn, table, lines.offset, rows)
+        conn.commit()
+    loaded = time.perf_counter()
+
+    with conn:
+        rebuilt = _restore(conn, table, dropped)
+        # Lets init_db skip a CSV it would import itself
+        record_import(conn, table, path, (stat.st_size, stat.st_mtime_ns, file_digest(path)), rows)
+        conn.execute("UPDATE bulk_loads SET finished_at = datetime('now') WHERE table_name = ?", (table,))
+    done = time.perf_counter()
+    written = rows - resumed_from
+    return {
+        "table": table,
+        "rows": rows,
+        "resumed_from": resumed_from,
+        "load_seconds": loaded - start,
+        "rows_per_second": written / (loaded - start) if loaded > start else 0.0,
+        "rebuild_seconds": done - loaded,
+        "rebuilt": [name for kind, name, _ in dropped if kind == "index"] + rebuilt,
+        "peak_rss": peak_rss(),
+    }
+
+def connect(database=DATABASE):
+    conn = sqlite3.connect(database)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute(f"PRAGMA cache_size=-{CACHE_KB}")
+    return conn
+
+def main():
+    parser = argparse.ArgumentParser(description="Bulk load large CSV exports into the local database")
+    parser.add_argument("table", nargs="?", choices=sorted(TABLE_SCHEMAS))
+    parser.add_argument("path", nargs="?", help="CSV file with a header row")
+    parser.add_argument("--all", action="store_true", help="every CSV export the startup import reads from --data-dir")
+    parser.add_argument("--data-dir", default="data")
+    parser.add_argument("--columns", help="comma-separated columns to load (default: every column of the table)")
+    parser.add_argument("--chunk", type=int, default=CHUNK_ROWS, help="rows per executemany")
+    parser.add_argument("--transaction", type=int, default=TRANSACTION_ROWS, help="rows per transaction")
+    parser.add_argument("--resume", action="store_true", help="continue an interrupted load of the same file")
+    parser.add_argument("--keep-indexes", action="store_true", help="write through the indexes and triggers")
+    parser.add_argument("--database", default=DATABASE)
+    args = parser.parse_args()
+    if args.all:
+        loads = [(table, os.path.join(args.data_dir, name), columns) for table, name, columns in CSV_TABLES]
+    elif args.table and args.path:
+        loads = [(args.table, args.path, args.columns.split(",") if args.columns else None)]
+    else:
+        parser.error("give a table and a CSV file, or --all")
+
+    def progress(rows, rate):
+        print(f"  {rows} rows, {rate:.0f} rows/s, peak RSS {peak_rss() / 1e6:.0f} MB", flush=True)
+
+    # The same lock as init_db, so servers starting meanwhile wait for the load
+    with file_lock(f"{args.database}.init-lock"):
+        conn = connect(args.database)
+        try:
+            for table, path, columns in loads:
+                print(f"{table}: loading {path}", flush=True)
+                try:
+                    report = bulk_load(conn, table, path, columns, args.chunk, args.transaction,
+                                       resume=args.resume, drop_indexes=not args.keep_indexes, progress=progress)
+                except LoadError as e:
+                    parser.exit(1, f"{table}: {e}\n")
+                resumed = f" (resumed after {report['resumed_from']})" if report["resumed_from"] else ""
+                print(f"{table}: {report['rows']} rows{resumed} in {report['load_seconds']:.1f} s, "
+                      f"{report['rows_per_second']:.0f} rows/s; rebuilt {', '.join(report['rebuilt']) or 'nothing'} "
+                      f"in {report['rebuild_seconds']:.1f} s; peak RSS {report['peak_rss'] / 1e6:.0f} MB")
+        finally:
+            conn.close()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,146 @@
+import csv
+import hashlib
+import os
+import time
+from metrics import logger
+
+# Rows read from the CSV before they are written
+BATCH_SIZE = 5000
+
+# Rows per INSERT statement. Tables with search index triggers flush the
+# full-text index once per statement, so rows are written many to a statement.
+STATEMENT_ROWS = 500
+
+# Tables written at runtime (MessageWriter, POST /message), whose ids can
+# collide with new rows of a re-imported CSV. Rows already stored are kept.
+INSERT_ONLY_TABLES = {"messages"}
+
+# Remembers which version of each CSV was last imported into which table
+IMPORT_LOG_SCHEMA = """CREATE TABLE IF NOT EXISTS csv_imports (
+    table_name TEXT PRIMARY KEY,
+    path TEXT,
+    size INTEGER,
+    mtime_ns INTEGER,
+    sha256 TEXT,
+    rows INTEGER,
+    imported_at TEXT
+)"""
+
+# SHA-256 of a file, read in 1 MB blocks
+def file_digest(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+# Compares a CSV with the import log and returns (state, (size, mtime_ns, sha256)).
+# state is "unchanged", "touched" (new mtime, same contents) or "changed".
+# Size and mtime are checked first so unchanged files are never hashed.
+def check_csv(conn, table, path):
+    stat = os.stat(path)
+    logged = conn.execute(
+        "SELECT path, size, mtime_ns, sha256 FROM csv_imports WHERE table_name = ?", (table,)
+    ).fetchone()
+    if logged and tuple(logged[:3]) == (path, stat.st_size, stat.st_mtime_ns):
+        return "unchanged", tuple(logged[1:])
+    fingerprint = (stat.st_size, stat.st_mtime_ns, file_digest(path))
+    if logged and logged[0] == path and logged[3] == fingerprint[2]:
+        return "touched", fingerprint
+    return "changed", fingerprint
+
+def record_import(conn, table, path, fingerprint, rows):
+    size, mtime_ns, sha256 = fingerprint
+    conn.execute(
+        "INSERT INTO csv_imports (table_name, path, size, mtime_ns, sha256, rows, imported_at) "
+        "VALUES (?, ?, ?, ?, ?, ?, datetime('now')) "
+        "ON CONFLICT(table_name) DO UPDATE SET path = excluded.path, size = excluded.size, "
+        "mtime_ns = excluded.mtime_ns, sha256 = excluded.sha256, "
+        "rows = COALESCE(excluded.rows, csv_imports.rows), imported_at = excluded.imported_at",
+        (table, path, size, mtime_ns, sha256, rows)
+    )
+
+# Plans the upsert of CSV rows into table by the table's primary key. Only
+# CSV columns that exist in the table (and in columns, if given) are loaded.
+# Returns (positions, names, types, insert) where positions index the CSV
+# header, names and types are the matching table columns and their declared
+# types, and insert(n) is the statement writing n rows. Rows of
+# INSERT_ONLY_TABLES whose key is already stored are skipped, not updated.
+def plan_upsert(conn, table, header, columns=None):
+    info = conn.execute(f"PRAGMA table_info({table})").fetchall()
+    table_columns = {row[1].lower(): (row[1], row[2].upper()) for row in info}
+    keys = [row[1] for row in sorted(info, key=lambda row: row[5]) if row[5]]
+    wanted = {c.lower() for c in columns} if columns else set(table_columns)
+    positions = [i for i, name in enumerate(header) if name.lower() in table_columns and name.lower() in wanted]
+    names = [table_columns[header[i].lower()][0] for i in positions]
+    types = [table_columns[header[i].lower()][1] for i in positions]
+    placeholders = "(" + ", ".join("?" for _ in names) + ")"
+    conflict = ""
+    updates = [name for name in names if name not in keys]
+    if keys and updates and table not in INSERT_ONLY_TABLES:
+        assignments = ", ".join(f"{name} = excluded.{name}" for name in updates)
+        conflict = f" ON CONFLICT({', '.join(keys)}) DO UPDATE SET {assignments}"
+    elif keys:
+        conflict = f" ON CONFLICT({', '.join(keys)}) DO NOTHING"
+
+    def insert(n):
+        return f"INSERT INTO {table} ({', '.join(names)}) VALUES {', '.join([placeholders] * n)}{conflict}"
+    return positions, names, types, insert
+
+# Insert or update every CSV row by the table's primary key. Only CSV columns
+# that exist in the table are loaded; empty cells become NULL.
+def upsert_csv(conn, table, path, columns=None):
+    with open(path, newline="", encoding="utf-8-sig") as f:
+        reader = csv.reader(f)
+        header = next(reader)
+        positions, names, types, insert = plan_upsert(conn, table, header, columns)
+
+        def write(batch):
+            for start in range(0, len(batch), STATEMENT_ROWS):
+                chunk = batch[start:start + STATEMENT_ROWS]
+                conn.execute(insert(len(chunk)), [value for row in chunk for value in row])
+
+        # Rows with fewer cells than the header get NULL for the missing ones
+        width = max(positions) + 1 if positions else 0
+        rows = short = 0
+        batch = []
+        for record in reader:
+            if not record:
+                continue
+            if len(record) < width:
+                short += 1
+                record += [""] * (width - len(record))
+            batch.append([record[i] if record[i] != "" else None for i in positions])
+            if len(batch) >= BATCH_SIZE:
+                write(batch)
+                rows += len(batch)
+                batch = []
+        if batch:
+            write(batch)
+            rows += len(batch)
+    if short:
+        logger.warning("%s: %s rows have fewer cells than the header; their missing cells were stored as NULL",
+                       path, short)
+    return rows
+
+# Import each (table, path, columns) whose CSV changed since the last import.
+# Returns [(table, status, rows, seconds)] where status is "imported" or "unchanged".
+def import_changed_csvs(conn, tables, force=False):
+    conn.execute(IMPORT_LOG_SCHEMA)
+    report = []
+    for table, path, columns in tables:
+        start = time.perf_counter()
+        state, fingerprint = check_csv(conn, table, path)
+        rows = 0
+        if state == "changed" or force:
+            with conn:
+                rows = upsert_csv(conn, table, path, columns)
+                record_import(conn, table, path, fingerprint, rows)
+            status = "imported"
+        else:
+            if state == "touched":
+                with conn:
+                    record_import(conn, table, path, fingerprint, None)
+            status = "unchanged"
+        report.append((table, status, rows, time.perf_counter() - start))
+    return report
@@ -0,0 +1,148 @@
+import os
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+
+DATABASE = os.environ.get("EHOSPITAL_DB", "database.db")
+
+# Pragmas applied to every pooled connection
+PRAGMAS = (
+    "PRAGMA journal_mode=WAL",
+    "PRAGMA synchronous=NORMAL",
+    "PRAGMA mmap_size=268435456",  # 256 MB
+    "PRAGMA cache_size=-16000",  # 16 MB
+    "PRAGMA temp_store=MEMORY",
+    "PRAGMA busy_timeout=5000",
+)
+
+# Number of prepared statements each connection keeps compiled
+STATEMENT_CACHE_SIZE = 256
+
+# Bounded pool of SQLite connections shared by the FastAPI and Flask apps.
+#
+# A connection is checked out for the duration of a `with pool.connection()`
+# block and bound to the calling thread, so nested blocks on the same thread
+# reuse it. When all connections are busy, callers wait up to `timeout`.
+class ConnectionPool:
+    def __init__(self, path=DATABASE, max_connections=8, timeout=10.0):
+        self.path = path
+        self.max_connections = max_connections
+        self.timeout = timeout
+        self._idle = []
+        self._opened = 0
+        self._condition = threading.Condition()
+        self._local = threading.local()
+        self._stats = {"hits": 0, "misses": 0, "waits": 0, "wait_time": 0.0}
+
+    def _open(self):
+        conn = sqlite3.connect(
+            self.path, timeout=self.timeout, check_same_thread=False,
+            cached_statements=STATEMENT_CACHE_SIZE
+        )
+        conn.row_factory = sqlite3.Row
+        for pragma in PRAGMAS:
+            conn.execute(pragma)
+        return conn
+
+    def _acquire(self):
+        with self._condition:
+            if self._idle:
+                self._stats["hits"] += 1
+                return self._idle.pop()
+            if self._opened < self.max_connections:
+                self._opened += 1
+                self._stats["misses"] += 1
+            else:
+                self._stats["waits"] += 1
+                start = time.perf_counter()
+                if not self._condition.wait_for(lambda: self._idle, timeout=self.timeout):
+                    raise TimeoutError(f"No database connection available after {self.timeout}s")
+                self._stats["wait_time"] += time.perf_counter() - start
+                return self._idle.pop()
+        try:
+            return self._open()
+        except Exception:
+            with self._condition:
+                self._opened -= 1
+                self._condition.notify()
+            raise
+
+    def _release(self, conn):
+        if conn.in_transaction:
+            conn.rollback()
+        with self._condition:
+            self._idle.append(conn)
+            self._condition.notify()
+
+    @contextmanager
+    def connection(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is not None:
+            yield conn
+            return
+        conn = self._acquire()
+        self._local.conn = conn
+        try:
+            yield conn
+        finally:
+            self._local.conn = None
+            self._release(conn)
+
+    def stats(self):
+        with self._condition:
+            stats = dict(self._stats)
+            stats["open"] = self._opened
+            stats["idle"] = len(self._idle)
+            stats["max_connections"] = self.max_connections
+        checkouts = stats["hits"] + stats["misses"] + stats["waits"]
+        stats["hit_ratio"] = stats["hits"] / checkouts if checkouts else 0.0
+        return stats
+
+    def close(self):
+        with self._condition:
+            while self._idle:
+                self._idle.pop().close()
+                self._opened -= 1
+
+pool = ConnectionPool()
+
+# Hold an exclusive lock on path (created if missing) for the duration of the
+# block, so work guarded by it runs in one process at a time. fcntl locks are
+# released by the OS if the holder dies; where fcntl is missing (Windows) the
+# block runs unguarded, which is fine for the single-process main.py.
+# With blocking=False the block runs at once and is given False if another
+# process holds the lock, True otherwise.
+@contextmanager
+def file_lock(path, blocking=True):
+    try:
+        import fcntl
+    except ImportError:
+        yield True
+        return
+    with open(path, "a") as f:
+        try:
+            fcntl.flock(f, fcntl.LOCK_EX if blocking else fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            yield False
+            return
+        try:
+            yield True
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+# Run a query and return the first row, or None
+def query_one(sql, params=()):
+    with pool.connection() as conn:
+        return conn.execute(sql, params).fetchone()
+
+# Run a query and return all rows
+def query_all(sql, params=()):
+    with pool.connection() as conn:
+        return conn.execute(sql, params).fetchall()
+
+# Run a write statement in its own transaction and return the cursor
+def execute(sql, params=()):
+    with pool.connection() as conn:
+        with conn:
+            return conn.execute(sql, params)
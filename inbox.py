@@ -0,0 +1,209 @@
+import threading
+import time
+from db import pool, query_all, query_one
+from message_queue import message_writer
+
+# Default and maximum number of threads per inbox page
+INBOX_PAGE = 50
+MAX_INBOX_PAGE = 500
+
+# Default and maximum number of messages per change feed response
+FEED_LIMIT = 100
+MAX_FEED_LIMIT = 1000
+
+# Longest a long-poll request waits for a new message
+MAX_WAIT = 30
+
+# While waiting, the database is re-checked this often (seconds) for
+# messages written by another process, which do not wake this one
+FEED_RECHECK = 2.0
+
+MESSAGE_COLUMNS = ("id", "patient_id", "doctor_id", "patient_FName", "patient_LName", "message", "time_stamp")
+
+# One row per (doctor, patient) conversation, kept current by triggers on
+# messages: the message and unread counts change by one per insert or
+# delete, so an inbox never counts messages. Messages with an id above
+# read_through_id are unread.
+THREADS_SCHEMA = """CREATE TABLE IF NOT EXISTS message_threads (
+    doctor_id INTEGER NOT NULL,
+    patient_id INTEGER NOT NULL,
+    message_count INTEGER NOT NULL DEFAULT 0,
+    unread_count INTEGER NOT NULL DEFAULT 0,
+    read_through_id INTEGER NOT NULL DEFAULT 0,
+    last_message_id INTEGER,
+    last_time_stamp TEXT,
+    PRIMARY KEY (doctor_id, patient_id)
+)"""
+
+THREADS_INDEX = "CREATE INDEX IF NOT EXISTS idx_threads_doctor_last ON message_threads (doctor_id, last_message_id)"
+
+def _count_in(row):
+    return f"""INSERT INTO message_threads (doctor_id, patient_id, message_count, unread_count, last_message_id, last_time_stamp)
+        SELECT {row}.doctor_id, {row}.patient_id, 1, 1, {row}.id, {row}.time_stamp
+        WHERE {row}.doctor_id IS NOT NULL AND {row}.patient_id IS NOT NULL
+        ON CONFLICT(doctor_id, patient_id) DO UPDATE SET
+            message_count = message_count + 1,
+            unread_count = unread_count + ({row}.id > read_through_id),
+            last_time_stamp = CASE WHEN {row}.id >= last_message_id THEN {row}.time_stamp ELSE last_time_stamp END,
+            last_message_id = max(last_message_id, {row}.id);"""
+
+def _count_out(row):
+    thread = f"doctor_id = {row}.doctor_id AND patient_id = {row}.patient_id"
+    return f"""UPDATE message_threads SET
+            message_count = message_count - 1,
+            unread_count = unread_count - ({row}.id > read_through_id),
+            last_message_id = (SELECT max(id) FROM messages WHERE {thread}),
+            last_time_stamp = (SELECT time_stamp FROM messages WHERE {thread} ORDER BY id DESC LIMIT 1)
+        WHERE {thread};
+        DELETE FROM message_threads WHERE {thread} AND message_count <= 0;"""
+
+THREADS_TRIGGERS = (
+    f"""CREATE TRIGGER IF NOT EXISTS trg_threads_insert AFTER INSERT ON messages BEGIN
+        {_count_in("NEW")}
+    END""",
+    f"""CREATE TRIGGER IF NOT EXISTS trg_threads_delete AFTER DELETE ON messages BEGIN
+        {_count_out("OLD")}
+    END""",
+    # Upserts by the CSV import rewrite doctor_id and patient_id unchanged; only a real move counts
+    f"""CREATE TRIGGER IF NOT EXISTS trg_threads_move AFTER UPDATE OF doctor_id, patient_id ON messages
+    WHEN OLD.doctor_id IS NOT NEW.doctor_id OR OLD.patient_id IS NOT NEW.patient_id BEGIN
+        {_count_out("OLD")}
+        {_count_in("NEW")}
+    END""",
+)
+
+# Create the thread table and its triggers. A new table is filled from the
+# messages already stored, which count as read: they predate the inbox.
+# (With max(), SQLite takes the bare time_stamp from the row holding the max.)
+# Returns the seconds spent filling it, or None if it existed.
+def build_inbox(conn):
+    exists = conn.execute("SELECT 1 FROM sqlite_master WHERE name = 'message_threads'").fetchone()
+    built = None
+    if not exists:
+        start = time.perf_counter()
+        conn.execute(THREADS_SCHEMA)
+        conn.execute("""INSERT INTO message_threads
+            (doctor_id, patient_id, message_count, unread_count, read_through_id, last_message_id, last_time_stamp)
+            SELECT doctor_id, patient_id, count(*), 0, max(id), max(id), time_stamp
+            FROM messages WHERE doctor_id IS NOT NULL AND patient_id IS NOT NULL
+            GROUP BY doctor_id, patient_id""")
+        built = time.perf_counter() - start
+    conn.execute(THREADS_INDEX)
+    for statement in THREADS_TRIGGERS:
+        conn.execute(statement)
+    conn.commit()
+    return built
+
+# Recount every thread from messages, for writes that bypassed the triggers
+# (see bulk_load.py). Each thread keeps its read_through_id, so messages
+# loaded above it count as unread, as they would have through the triggers.
+# Returns False if the thread table does not exist yet.
+def rebuild_threads(conn):
+    if not conn.execute("SELECT 1 FROM sqlite_master WHERE name = 'message_threads'").fetchone():
+        return False
+    conn.execute("""INSERT INTO message_threads
+        (doctor_id, patient_id, message_count, unread_count, read_through_id, last_message_id, last_time_stamp)
+        SELECT m.doctor_id, m.patient_id, count(*), sum(m.id > coalesce(t.read_through_id, 0)),
+            coalesce(t.read_through_id, 0), max(m.id), m.time_stamp
+        FROM messages m LEFT JOIN message_threads t ON t.doctor_id = m.doctor_id AND t.patient_id = m.patient_id
+        WHERE m.doctor_id IS NOT NULL AND m.patient_id IS NOT NULL
+        GROUP BY m.doctor_id, m.patient_id
+        ON CONFLICT(doctor_id, patient_id) DO UPDATE SET
+            message_count = excluded.message_count, unread_count = excluded.unread_count,
+            last_message_id = excluded.last_message_id, last_time_stamp = excluded.last_time_stamp""")
+    conn.execute("""DELETE FROM message_threads WHERE NOT EXISTS (SELECT 1 FROM messages m
+        WHERE m.doctor_id = message_threads.doctor_id AND m.patient_id = message_threads.patient_id)""")
+    return True
+
+# A doctor's conversations, most recent first, with their unread counts and
+# last message. before is the last_message_id the previous page ended at.
+def threads(doctor_id, before=None, limit=INBOX_PAGE, unread_only=False):
+    sql = """SELECT t.patient_id, m.patient_FName, m.patient_LName, t.message_count, t.unread_count,
+               t.read_through_id, t.last_message_id, t.last_time_stamp, m.message AS last_message
+        FROM message_threads t LEFT JOIN messages m ON m.id = t.last_message_id
+        WHERE t.doctor_id = ? AND t.last_message_id < ?"""
+    if unread_only:
+        sql += " AND t.unread_count > 0"
+    sql += " ORDER BY t.last_message_id DESC LIMIT ?"
+    limit = max(1, min(limit, MAX_INBOX_PAGE))
+    rows = query_all(sql, (doctor_id, before if before is not None else 2 ** 63 - 1, limit))
+    return [dict(row) for row in rows]
+
+# Unread messages and conversations of a doctor: a sum over the maintained thread counts
+def unread(doctor_id):
+    row = query_one("SELECT coalesce(sum(unread_count), 0), count(*) FROM message_threads WHERE doctor_id = ?",
+                    (doctor_id,))
+    return {"unread": row[0], "threads": row[1]}
+
+# Mark a conversation read through a message id (default: its last
+# message). Never moves the read marker back. Returns the thread or None.
+def mark_read(doctor_id, patient_id, through_id=None):
+    with pool.connection() as conn:
+        # One statement, so a message committed meanwhile is either counted or covered
+        row = conn.execute("""UPDATE message_threads SET
+                read_through_id = max(read_through_id, min(coalesce(?1, last_message_id), last_message_id)),
+                unread_count = (SELECT count(*) FROM messages m
+                    WHERE m.patient_id = message_threads.patient_id AND m.doctor_id = message_threads.doctor_id
+                    AND m.id > max(message_threads.read_through_id,
+                                   min(coalesce(?1, message_threads.last_message_id), message_threads.last_message_id)))
+            WHERE doctor_id = ?2 AND patient_id = ?3
+            RETURNING patient_id, message_count, unread_count, read_through_id, last_message_id, last_time_stamp""",
+            (through_id, doctor_id, patient_id)).fetchone()
+        conn.commit()
+    return dict(row) if row else None
+
+# A doctor's messages with an id above since, oldest first. Ids only grow,
+# so the last id returned is the cursor for the next call. The cheaper of
+# two walks is used: the messages newer than since (a rowid range, short
+# for a client that keeps up) or all of the doctor's messages through the
+# (doctor_id, time_stamp) index (short for a doctor with few messages).
+def messages_since(doctor_id, since=0, limit=FEED_LIMIT):
+    latest = query_one("SELECT max(id) FROM messages")[0] or 0
+    if since >= latest:
+        return []
+    total = query_one("SELECT coalesce(sum(message_count), 0) FROM message_threads WHERE doctor_id = ?",
+                      (doctor_id,))[0]
+    where = "+doctor_id = ?" if latest - since <= total else "doctor_id = ?"  # + keeps the planner off the index
+    sql = f"SELECT {', '.join(MESSAGE_COLUMNS)} FROM messages WHERE {where} AND id > ? ORDER BY id LIMIT ?"
+    limit = max(1, min(limit, MAX_FEED_LIMIT))
+    return [dict(row) for row in query_all(sql, (doctor_id, since, limit))]
+
+# Wakes waiting feed requests when the message writer commits a message
+# for their doctor, instead of having them poll the table.
+class ChangeFeed:
+    def __init__(self):
+        self._condition = threading.Condition()
+        self._latest = {}  # doctor id (as text) -> newest committed message id
+        self.stats = {"published": 0, "waits": 0, "wakeups": 0, "timeouts": 0}
+
+    # Called by the message writer with (id, row) pairs after each commit
+    def publish(self, messages):
+        with self._condition:
+            for message_id, row in messages:
+                key = str(row[1])
+                self._latest[key] = max(self._latest.get(key, 0), message_id)
+            self.stats["published"] += len(messages)
+            self._condition.notify_all()
+
+    # Block until a message newer than since is committed for the doctor,
+    # or timeout seconds pass. Returns True if woken by one.
+    def wait(self, doctor_id, since, timeout):
+        key = str(doctor_id)
+        with self._condition:
+            self.stats["waits"] += 1
+            woken = self._condition.wait_for(lambda: self._latest.get(key, 0) > since, timeout)
+            self.stats["wakeups" if woken else "timeouts"] += 1
+            return woken
+
+    # messages_since, waiting up to timeout seconds for the first message
+    def poll(self, doctor_id, since=0, limit=FEED_LIMIT, timeout=0):
+        deadline = time.monotonic() + max(0.0, min(timeout, MAX_WAIT))
+        while True:
+            rows = messages_since(doctor_id, since, limit)
+            remaining = deadline - time.monotonic()
+            if rows or remaining <= 0:
+                return rows
+            self.wait(doctor_id, since, min(remaining, FEED_RECHECK))
+
+feed = ChangeFeed()
+message_writer.listeners.append(feed.publish)
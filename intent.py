@@ -0,0 +1,114 @@
+from collections import Counter, defaultdict
+from functools import lru_cache
+from fuzzywuzzy import fuzz
+from utils import clean_text
+from metrics import timed
+
+# Keywords for fields of the heart_disease_test table (English, Persian)
+FIELD_KEYWORDS = {
+    'patient_id': ['patient id', 'شناسه بیمار'],
+    'education': ['education', 'تحصیلات'],
+    'currentSmoker': ['current smoker', 'سیگاری فعلی'],
+    'cigsPerDay': ['cigs per day', 'سیگار در روز'],
+    'BPMeds': ['bp meds', 'داروی فشار خون'],
+    'prevalentStroke': ['prevalent stroke', 'سکته قبلی'],
+    'prevalentHyp': ['prevalent hyp', 'فشار خون بالا'],
+    'diabetes': ['diabetes', 'دیابت'],
+    'BMI': ['bmi', 'شاخص توده بدنی'],
+    'totChol': ['total cholesterol', 'کلسترول کل'],
+    'sysBP': ['systolic bp', 'فشار سیستولیک'],
+    'diaBP': ['diastolic bp', 'فشار دیاستولیک'],
+    'heartRate': ['heart rate', 'ضربان قلب'],
+    'glucose': ['glucose', 'گلوکز'],
+    'test_time': ['test time', 'زمان تست'],
+    'CHD': ['chd', 'بیماری قلبی']
+}
+
+# Keywords for the other requests, checked in this order
+TOPIC_KEYWORDS = {
+    'blood_test': ['blood test', 'آزمایش خون'],
+    'blood_pressure': ['blood pressure', 'فشار خون'],
+    'blood_sugar': ['blood sugar', 'قند خون'],
+    'treatment': ['treatment', 'درمان'],
+    'other_test': ['other test', 'تست دیگر']
+}
+
+GREETING_KEYWORDS = {
+    'greeting': ['hello', 'hi', 'سلام']
+}
+
+MOOD_KEYWORDS = {
+    'mood': ['good', 'fine', 'great', 'okay', 'bad', 'خوب', 'بد']
+}
+
+# Precompiled fuzzy matcher over a table of intents and their keywords.
+#
+# Gives the same answers as running utils.match_keyword over the intents in
+# order, but keywords are cleaned once and a character n-gram index is used to
+# skip keywords that cannot reach the threshold. fuzz.ratio is 2*M/T where M
+# is at most the number of characters both strings share, so the shared
+# character count from the index is an upper bound on the score.
+class IntentMatcher:
+    def __init__(self, intents, threshold=60, match_whole_text=True, name="intent"):
+        self.name = name
+        self.threshold = threshold
+        self.match_whole_text = match_whole_text
+        self.intents = list(intents)
+        self._keywords = []  # (intent rank, cleaned keyword)
+        self._postings = defaultdict(list)  # character -> [(keyword index, count)]
+        for rank, keywords in enumerate(intents.values()):
+            for keyword in keywords:
+                keyword = clean_text(keyword)
+                index = len(self._keywords)
+                self._keywords.append((rank, keyword))
+                for gram, count in Counter(keyword).items():
+                    self._postings[gram].append((index, count))
+        self._score_term = lru_cache(maxsize=4096)(self._score_term_uncached)
+        # match() is timed as the match_<name> stage
+        self.match = timed(f"match_{name}")(self._match)
+
+    # Keyword indexes whose score against term could reach the threshold
+    def _candidates(self, term):
+        shared = defaultdict(int)
+        for gram, count in Counter(term).items():
+            for index, keyword_count in self._postings.get(gram, ()):
+                shared[index] += min(count, keyword_count)
+        # fuzz.ratio rounds, so anything at or above threshold - 0.5 may still pass
+        cutoff = self.threshold - 0.5
+        for index, common in shared.items():
+            keyword = self._keywords[index][1]
+            if 200 * common >= cutoff * (len(term) + len(keyword)):
+                yield index
+
+    # Best passing score per intent rank for one term
+    def _score_term_uncached(self, term):
+        best = {}
+        for index in self._candidates(term):
+            rank, keyword = self._keywords[index]
+            score = fuzz.ratio(term, keyword)
+            if score >= self.threshold and score > best.get(rank, 0):
+                best[rank] = score
+        return tuple(best.items())
+
+    # Returns (intent, score) for the first intent in table order that matches,
+    # or (None, 0) if nothing reaches the threshold
+    def _match(self, text):
+        text = clean_text(text)
+        terms = text.split()
+        if self.match_whole_text:
+            terms.insert(0, text)
+        best = {}
+        for term in dict.fromkeys(terms):
+            for rank, score in self._score_term(term):
+                if score > best.get(rank, 0):
+                    best[rank] = score
+        if not best:
+            return None, 0
+        rank = min(best)
+        return self.intents[rank], best[rank]
+
+# Matchers are built once at import time and shared by all requests
+field_matcher = IntentMatcher(FIELD_KEYWORDS, match_whole_text=False, name="field")
+topic_matcher = IntentMatcher(TOPIC_KEYWORDS, name="topic")
+greeting_matcher = IntentMatcher(GREETING_KEYWORDS, name="greeting")
+mood_matcher = IntentMatcher(MOOD_KEYWORDS, name="mood")
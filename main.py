@@ -2,18 +2,43 @@ from fastapi import FastAPI
 from fastapi.templating import Jinja2Templates
 from routes import router
 from utils import init_db
+from db import pool
+from remote import remote
+from sync import table_sync
+from tts import speech_worker
+from speech_input import speech_pool
+from session_store import session_store
+from snapshot import snapshots
+from metrics import TimingMiddleware
+from admission import AdmissionMiddleware
 from contextlib import asynccontextmanager
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     # Startup event
     init_db()  # Note: init_db is synchronous, but we can call it directly since it doesn't need to be awaited
+    speech_worker.start()
+    speech_pool.start()
+    table_sync.start()
     yield
-    # Shutdown event (if needed)
-    # Add cleanup code here if necessary
+    # Shutdown event: stop the TTS worker, speech recognizers and table sync, close the session store, pooled database connections and the HTTP session
+    speech_worker.stop()
+    speech_pool.close()
+    table_sync.stop()
+    await snapshots.drain()
+    session_store.close()
+    pool.close()
+    await remote.aclose()
 
 app = FastAPI(lifespan=lifespan)
 
+# Rate limits and the chat concurrency limit, ahead of the router
+app.add_middleware(AdmissionMiddleware)
+
+# Per-route latency, per-stage timings for /metrics and the optional Server-Timing header.
+# Added last, so it is the outermost middleware and shed requests are timed too.
+app.add_middleware(TimingMiddleware)
+
 # Setup for templates
 templates = Jinja2Templates(directory="templates")
 
@@ -0,0 +1,147 @@
+import os
+import queue
+import sqlite3
+import threading
+import time
+from concurrent.futures import Future
+from db import DATABASE
+from metrics import logger
+
+# How long the writer waits for more messages before committing a batch. With 0,
+# a batch is whatever queued up while the previous commit was running.
+GROUP_COMMIT_WINDOW = float(os.environ.get("EHOSPITAL_GROUP_COMMIT_MS", "0")) / 1000
+
+MAX_BATCH = 1000
+
+INSERT_INTO = "INSERT INTO messages (patient_id, doctor_id, patient_FName, patient_LName, message, time_stamp)"
+MESSAGE_VALUES = "(?, ?, ?, ?, ?, datetime('now'))"
+INSERT_MESSAGE = f"{INSERT_INTO} VALUES {MESSAGE_VALUES}"
+
+# One INSERT for a whole batch. The search index trigger on messages makes
+# SQLite flush the full-text index once per statement, so a batch written
+# row by row would flush once per row.
+def insert_messages_sql(count):
+    return f"{INSERT_INTO} VALUES {', '.join([MESSAGE_VALUES] * count)}"
+
+# Single writer thread that group-commits queued message inserts.
+#
+# Callers get a Future that resolves to the new message id once the
+# transaction holding their row has committed with synchronous=FULL, so one
+# fsync is shared by every message that arrived within the window. After
+# each commit, listeners are called with the batch's (id, row) pairs.
+class MessageWriter:
+    def __init__(self, path=DATABASE, window=GROUP_COMMIT_WINDOW, max_batch=MAX_BATCH):
+        self.path = path
+        self.window = window
+        self.max_batch = max_batch
+        self._queue = queue.Queue()
+        self._thread = None
+        self._lock = threading.Lock()
+        self.listeners = []
+        self.stats = {"messages": 0, "commits": 0, "failed": 0}
+
+    def start(self):
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="message-writer", daemon=True)
+                self._thread.start()
+
+    def stop(self, timeout=5.0):
+        with self._lock:
+            thread, self._thread = self._thread, None
+        if thread is not None:
+            self._queue.put(None)
+            thread.join(timeout)
+
+    # Queue one row (patient_id, doctor_id, patient_FName, patient_LName, message)
+    def submit(self, row):
+        future = Future()
+        self._queue.put((tuple(row), future))
+        if self._thread is None:
+            self.start()
+        return future
+
+    def submit_many(self, rows):
+        return [self.submit(row) for row in rows]
+
+    def _connect(self):
+        conn = sqlite3.connect(self.path, isolation_level=None, check_same_thread=False)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=FULL")
+        conn.execute("PRAGMA busy_timeout=5000")
+        return conn
+
+    def _run(self):
+        try:
+            conn = self._connect()
+        except Exception as e:
+            logger.exception("Message writer could not open the database")
+            self._fail_queued(e)
+            return
+        running = True
+        while running:
+            item = self._queue.get()
+            if item is None:
+                break
+            batch = [item]
+            deadline = time.monotonic() + self.window
+            while len(batch) < self.max_batch:
+                try:
+                    timeout = deadline - time.monotonic()
+                    item = self._queue.get(timeout=timeout) if timeout > 0 else self._queue.get_nowait()
+                except queue.Empty:
+                    break
+                if item is None:
+                    running = False
+                    break
+                batch.append(item)
+            self._write(conn, batch)
+        conn.close()
+
+    # The thread exits so the next submit starts another one, which tries to
+    # connect again; whatever was queued until then fails with the error
+    def _fail_queued(self, error):
+        with self._lock:
+            self._thread = None
+        while True:
+            try:
+                item = self._queue.get_nowait()
+            except queue.Empty:
+                return
+            if item is not None:
+                self.stats["failed"] += 1
+                item[1].set_exception(error)
+
+    def _write(self, conn, batch):
+        rows = [row for row, _ in batch]
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                conn.execute(insert_messages_sql(len(rows)), [value for row in rows for value in row])
+                # The write lock is held, so the batch got consecutive rowids
+                last_id = conn.execute("SELECT max(id) FROM messages").fetchone()[0]
+                conn.execute("COMMIT")
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+        except Exception as e:
+            # Write the rows one at a time, so a bad row fails only its own caller
+            if len(batch) > 1:
+                for item in batch:
+                    self._write(conn, [item])
+                return
+            self.stats["failed"] += 1
+            batch[0][1].set_exception(e)
+            return
+        self.stats["messages"] += len(batch)
+        self.stats["commits"] += 1
+        ids = range(last_id - len(batch) + 1, last_id + 1)
+        for message_id, (_, future) in zip(ids, batch):
+            future.set_result(message_id)
+        for listener in self.listeners:
+            try:
+                listener(list(zip(ids, rows)))
+            except Exception:
+                logger.exception("Message listener failed")
+
+message_writer = MessageWriter()
@@ -0,0 +1,184 @@
+import asyncio
+import bisect
+import contextvars
+import functools
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+# Debug logging is off unless EHOSPITAL_LOG_LEVEL=DEBUG; logger.debug() calls
+# with %-style arguments cost almost nothing when the level is disabled
+LOG_LEVEL = os.environ.get("EHOSPITAL_LOG_LEVEL", "WARNING").upper()
+
+logger = logging.getLogger("ehospital")
+logger.setLevel(LOG_LEVEL)
+if not logger.handlers:
+    _handler = logging.StreamHandler()
+    _handler.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(name)s: %(message)s"))
+    logger.addHandler(_handler)
+
+# Add a Server-Timing header with the per-stage durations to every response
+SERVER_TIMING = os.environ.get("EHOSPITAL_SERVER_TIMING", "0") == "1"
+
+# Histogram bucket upper bounds in seconds
+BUCKETS = (0.0001, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+# Stage durations of the request being handled, or None outside a request
+_request_timings = contextvars.ContextVar("request_timings", default=None)
+
+# Cumulative Prometheus-style histogram
+class Histogram:
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            self.counts[index] += 1
+            self.sum += value
+            self.count += 1
+
+    def snapshot(self):
+        with self._lock:
+            return list(self.counts), self.sum, self.count
+
+# Histograms of one metric family, keyed by a tuple of label values
+class HistogramFamily:
+    def __init__(self, name, help_text, label_names):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = label_names
+        self._histograms = {}
+        self._lock = threading.Lock()
+
+    def labels(self, *values):
+        histogram = self._histograms.get(values)
+        if histogram is None:
+            with self._lock:
+                histogram = self._histograms.setdefault(values, Histogram())
+        return histogram
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+        for values, histogram in sorted(self._histograms.items()):
+            counts, total, count = histogram.snapshot()
+            labels = ",".join(f'{name}="{value}"' for name, value in zip(self.label_names, values))
+            cumulative = 0
+            for bound, bucket_count in zip(histogram.buckets, counts):
+                cumulative += bucket_count
+                lines.append(f'{self.name}_bucket{{{labels},le="{bound}"}} {cumulative}')
+            lines.append(f'{self.name}_bucket{{{labels},le="+Inf"}} {count}')
+            lines.append(f"{self.name}_sum{{{labels}}} {total}")
+            lines.append(f"{self.name}_count{{{labels}}} {count}")
+        return lines
+
+stage_seconds = HistogramFamily(
+    "ehospital_stage_seconds", "Time spent in each request processing stage", ("stage",)
+)
+request_seconds = HistogramFamily(
+    "ehospital_request_seconds", "HTTP request latency", ("method", "route", "status")
+)
+
+def record(stage, seconds):
+    stage_seconds.labels(stage).observe(seconds)
+    timings = _request_timings.get()
+    if timings is not None:
+        timings[stage] = timings.get(stage, 0.0) + seconds
+
+# Time a block of code as a stage of the current request
+@contextmanager
+def span(stage):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record(stage, time.perf_counter() - start)
+
+# Decorator form of span() for plain and async functions
+def timed(stage):
+    def decorate(func):
+        if asyncio.iscoroutinefunction(func):
+            @functools.wraps(func)
+            async def async_wrapper(*args, **kwargs):
+                start = time.perf_counter()
+                try:
+                    return await func(*args, **kwargs)
+                finally:
+                    record(stage, time.perf_counter() - start)
+            return async_wrapper
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                record(stage, time.perf_counter() - start)
+        return wrapper
+    return decorate
+
+def server_timing_header(timings, total):
+    entries = [f"{stage};dur={seconds * 1000:.3f}" for stage, seconds in timings.items()]
+    entries.append(f"total;dur={total * 1000:.3f}")
+    return ", ".join(entries)
+
+# ASGI middleware that collects the stages of each request, records the
+# request latency by route and optionally reports the stages in Server-Timing
+class TimingMiddleware:
+    def __init__(self, app, server_timing=SERVER_TIMING):
+        self.app = app
+        self.server_timing = server_timing
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        timings = {}
+        token = _request_timings.set(timings)
+        start = time.perf_counter()
+        status = 500
+
+        async def send_with_timing(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+                if self.server_timing:
+                    header = server_timing_header(timings, time.perf_counter() - start)
+                    message = dict(message)
+                    message["headers"] = list(message.get("headers", [])) + [(b"server-timing", header.encode("latin-1"))]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_timing)
+        finally:
+            _request_timings.reset(token)
+            # Label by route template so /audio/{audio_id} stays one series
+            route = getattr(scope.get("route"), "path", "unmatched")
+            request_seconds.labels(scope["method"], route, str(status)).observe(time.perf_counter() - start)
+
+# Flatten a stats dict into untyped samples; non-numeric values are skipped
+def stats_lines(prefix, stats, labels=""):
+    lines = []
+    for key, value in stats.items():
+        if isinstance(value, bool) or not isinstance(value, (int, float)):
+            continue
+        lines.append(f"{prefix}_{key}{{{labels}}} {value}" if labels else f"{prefix}_{key} {value}")
+    return lines
+
+# Prometheus text exposition of the stage/request histograms plus the given
+# component stats: {"prefix": stats dict} or {"prefix": {label value: stats dict}}
+def render_metrics(components, label_name="table"):
+    lines = stage_seconds.render() + request_seconds.render()
+    for prefix, stats in components.items():
+        if stats and all(isinstance(value, dict) for value in stats.values()):
+            for label_value, nested in sorted(stats.items()):
+                lines += stats_lines(prefix, nested, f'{label_name}="{label_value}"')
+        else:
+            lines += stats_lines(prefix, stats)
+    return "\n".join(lines) + "\n"
@@ -0,0 +1,122 @@
+import asyncio
+import os
+import time
+
+BASE_URL = os.environ.get("EHOSPITAL_API", "https://e-react-node-backend-22ed6864d5f3.herokuapp.com")
+
+# Seconds a downloaded table is served before it is revalidated
+TABLE_TTL = float(os.environ.get("EHOSPITAL_REMOTE_TTL", "300"))
+
+# Read and connect timeouts for the remote API, in seconds
+TIMEOUT = (10.0, 5.0)
+
+# Raised when the remote API answers with an error status
+class RemoteTableError(Exception):
+    def __init__(self, status_code):
+        super().__init__(f"Server returned {status_code}")
+        self.status_code = status_code
+
+# Cached copy of one remote /table/<name> endpoint, indexed by patient_id.
+#
+# Only the latest record per patient is kept (the last one in table order),
+# which is what the chat helpers read. Refreshes are conditional when the
+# server sends an ETag or Last-Modified, and concurrent callers that find
+# the table stale share a single in-flight download.
+class RemoteTable:
+    def __init__(self, client, name, ttl=TABLE_TTL):
+        self.client = client
+        self.name = name
+        self.ttl = ttl
+        self.records = {}
+        self.fetched_at = None
+        self.etag = None
+        self.last_modified = None
+        self._refresh = None
+        self.stats = {"hits": 0, "fetches": 0, "not_modified": 0, "coalesced": 0}
+
+    def is_fresh(self):
+        return self.fetched_at is not None and time.monotonic() - self.fetched_at < self.ttl
+
+    async def _fetch(self):
+        headers = {}
+        if self.fetched_at is not None:
+            if self.etag:
+                headers["If-None-Match"] = self.etag
+            if self.last_modified:
+                headers["If-Modified-Since"] = self.last_modified
+        http = await self.client.session()
+        response = await http.get(f"/table/{self.name}", headers=headers)
+        if response.status_code == 304:
+            self.stats["not_modified"] += 1
+        elif response.status_code == 200:
+            self.stats["fetches"] += 1
+            records = {}
+            for record in response.json():
+                records[record.get("patient_id")] = record
+            self.records = records
+            self.etag = response.headers.get("ETag")
+            self.last_modified = response.headers.get("Last-Modified")
+        else:
+            raise RemoteTableError(response.status_code)
+        self.fetched_at = time.monotonic()
+
+    async def refresh(self):
+        if self._refresh is None:
+            self._refresh = asyncio.ensure_future(self._fetch())
+            self._refresh.add_done_callback(self._refresh_done)
+        else:
+            self.stats["coalesced"] += 1
+        # Shield so a cancelled caller does not cancel the shared download
+        await asyncio.shield(self._refresh)
+
+    def _refresh_done(self, task):
+        self._refresh = None
+        if not task.cancelled():
+            task.exception()  # Mark retrieved; callers re-raise it themselves
+
+    # Latest record for a patient, or None if the patient has no records
+    async def get(self, patient_id):
+        if self.is_fresh():
+            self.stats["hits"] += 1
+        else:
+            import httpx
+            try:
+                await self.refresh()
+            except (httpx.HTTPError, RemoteTableError):
+                # Serve the previous copy while the API is unavailable
+                if self.fetched_at is None:
+                    raise
+        return self.records.get(patient_id)
+
+# Keep-alive HTTP session plus the cached tables built on top of it
+class RemoteClient:
+    def __init__(self, base_url=BASE_URL, ttl=TABLE_TTL, timeout=TIMEOUT):
+        self.base_url = base_url
+        self.ttl = ttl
+        self.timeout = timeout
+        self.tables = {}
+        self._http = None
+
+    # The AsyncClient is created on first use so it binds to the running
+    # loop, and httpx is only imported by processes that fetch a table
+    async def session(self):
+        if self._http is None or self._http.is_closed:
+            import httpx
+            read, connect = self.timeout
+            self._http = httpx.AsyncClient(base_url=self.base_url, timeout=httpx.Timeout(read, connect=connect))
+        return self._http
+
+    def table(self, name):
+        if name not in self.tables:
+            self.tables[name] = RemoteTable(self, name, self.ttl)
+        return self.tables[name]
+
+    def stats(self):
+        return {name: dict(table.stats) for name, table in self.tables.items()}
+
+    async def aclose(self):
+        if self._http is not None:
+            await self._http.aclose()
+            self._http = None
+
+remote = RemoteClient()
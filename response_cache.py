@@ -0,0 +1,90 @@
+import functools
+import sqlite3
+import threading
+from collections import OrderedDict
+from db import query_one
+
+# Per-patient version counter kept up to date by triggers on patients_treatment,
+# so every process sees writes made by any other (see utils.TRIGGERS)
+VERSION_SQL = "SELECT version FROM treatment_versions WHERE patient_id = ?"
+
+# Returns None when the database predates the version table, which disables caching
+def treatment_version(patient_id):
+    try:
+        row = query_one(VERSION_SQL, (patient_id,))
+    except sqlite3.OperationalError:
+        return None
+    return row[0] if row else 0
+
+# (version, changed_at) of a read API resource from utils.RESOURCE_VERSIONS;
+# (0, None) before its first write, None when the database predates the table
+def resource_version(resource, scope=0):
+    try:
+        row = query_one("SELECT version, changed_at FROM resource_versions WHERE resource = ? AND scope = ?",
+                        (resource, scope))
+    except sqlite3.OperationalError:
+        return None
+    return (row[0], row[1]) if row else (0, None)
+
+# Size-bounded LRU of chat answers keyed by (patient_id, intent, arguments).
+# Each entry remembers the patient's treatment version it was built from and
+# is discarded as soon as that version moves on.
+class ResponseCache:
+    def __init__(self, max_entries=10000):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.stats_counts = {"hits": 0, "misses": 0, "stale": 0, "evictions": 0}
+
+    def get(self, key, version):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.stats_counts["misses"] += 1
+                return None
+            if entry[0] != version:
+                del self._entries[key]
+                self.stats_counts["stale"] += 1
+                return None
+            self._entries.move_to_end(key)
+            self.stats_counts["hits"] += 1
+            return entry[1]
+
+    def put(self, key, version, response):
+        with self._lock:
+            self._entries[key] = (version, response)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.stats_counts["evictions"] += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self.stats_counts)
+            stats["entries"] = len(self._entries)
+        lookups = stats["hits"] + stats["misses"] + stats["stale"]
+        stats["hit_ratio"] = stats["hits"] / lookups if lookups else 0.0
+        return stats
+
+response_cache = ResponseCache()
+
+# Decorator for helpers whose answer depends only on a patient's treatment rows
+def cached_by_patient(intent):
+    def decorate(func):
+        @functools.wraps(func)
+        def wrapper(patient_id, *args, **kwargs):
+            key = (patient_id, intent, args, tuple(sorted(kwargs.items())))
+            version = treatment_version(patient_id)
+            if version is None:
+                return func(patient_id, *args, **kwargs)
+            response = response_cache.get(key, version)
+            if response is None:
+                response = func(patient_id, *args, **kwargs)
+                response_cache.put(key, version, response)
+            return response
+        return wrapper
+    return decorate
@@ -1,198 +1,408 @@
-from fastapi import APIRouter, Request, Depends
-from fastapi.responses import JSONResponse
+import json
+import time
+from fastapi import APIRouter, Request, Depends, WebSocket, WebSocketDisconnect
+from fastapi.responses import JSONResponse, FileResponse, PlainTextResponse
 from fastapi.templating import Jinja2Templates
 from utils import (
-    verify_patient, get_treatment_info, get_test_results, get_blood_pressure,
-    get_latest_blood_sugar, get_heart_disease_data, recognize_speech, text_to_speech,
-    detect_language, clean_text, match_keyword
+    get_treatment_info, iter_treatment_info, get_test_results, get_blood_pressure,
+    get_latest_blood_sugar, get_heart_disease_data, text_to_speech, detect_language
 )
-import uuid
+from intent import field_matcher, topic_matcher, greeting_matcher, mood_matcher
+from tts import speech_worker
+from speech_input import speech_pool, SpeechBusy
+from session_store import session_store, new_session_id
+from auth import authenticate, credential_cache
+from response_cache import response_cache
+from snapshot import snapshots, answer_field, answer_topic, stream_treatments
+from db import pool
+from remote import remote
+from sync import sync_stats
+from metrics import logger, render_metrics, request_seconds
+from admission import admission, Rejected
 
 router = APIRouter()
 templates = Jinja2Templates(directory="templates")
 
-# Simple in-memory session storage
-sessions = {}
+# Close code for a chat socket opened without a live session cookie
+SOCKET_NO_SESSION = 4401
 
-# Dependency to get or create a session
+# Dependency to get or create a session; the session data is loaded into
+# request.state.session and only written to the store when saved.
+# request.state.new_session is True when the request had no live session.
 def get_session(request: Request):
     session_id = request.cookies.get("session_id")
-    if not session_id or session_id not in sessions:
-        session_id = str(uuid.uuid4())
-        sessions[session_id] = {}
+    session_data = session_store.get(session_id)
+    request.state.new_session = session_data is None
+    if session_data is None:
+        session_id = new_session_id()
+        session_data = {}
+    request.state.session = session_data
     return session_id
 
+# Reply with text right away; the spoken version is rendered in the background
+def reply(response):
+    audio_id = text_to_speech(response)
+    content = {"response": response}
+    if audio_id:
+        content["audio"] = f"/audio/{audio_id}"
+    return JSONResponse(content=content)
+
 # Homepage route
 @router.get("/")
 async def home(request: Request, session_id: str = Depends(get_session)):
     response = templates.TemplateResponse("index.html", {"request": request})
     response.set_cookie(key="session_id", value=session_id, httponly=True, max_age=3600)
-    sessions[session_id]["chat_state"] = None
+    request.state.session["chat_state"] = None
+    session_store.save(session_id, request.state.session)
     return response
 
-# Chat endpoint
-@router.post("/chat")
-async def chat(request: Request, session_id: str = Depends(get_session)):
+# Login: verify credentials once and bind the patient to the session
+@router.post("/login")
+async def login(request: Request, session_id: str = Depends(get_session)):
     data = await request.json()
+    patient = authenticate(data.get("email", ""), data.get("password", ""))
+    if not patient:
+        return JSONResponse(status_code=401, content={"response": "Invalid email or password."})
+    # Start a fresh session under a new id so a pre-login cookie cannot be reused
+    session_store.delete(session_id)
+    snapshots.discard(session_id)
+    session_id = new_session_id()
+    session_data = {"patient_id": patient[0], "patient_name": patient[1], "chat_state": "initial"}
+    session_store.save(session_id, session_data)
+    # Fetch the patient's records in the background while the chat page loads
+    snapshots.prefetch(session_id, patient[0])
+    response = JSONResponse(content={"patient_name": patient[1]})
+    response.set_cookie(key="session_id", value=session_id, httponly=True, max_age=3600)
+    return response
+
+# Logout: unbind the patient from the session
+@router.post("/logout")
+async def logout(request: Request, session_id: str = Depends(get_session)):
+    session_data = request.state.session
+    session_data.pop("patient_id", None)
+    session_data.pop("patient_name", None)
+    if not request.state.new_session:
+        session_store.save(session_id, session_data)
+    snapshots.discard(session_id)
+    return JSONResponse(content={"response": "Logged out."})
+
+# One chat turn for a session. Returns (chunks, speak): chunks is an iterable
+# of text pieces that together form the reply, and speak is False for replies
+# that are not voiced. With stream=True, long answers are produced by
+# generator formatters so they can be sent while the rest is formatted.
+# With persist=False the chat state is not saved.
+async def chat_turn(session_id, session_data, data, stream=False, persist=True):
     message = data.get("message", "").lower()
-    email = data.get("email", "")
-    password = data.get("password", "")
 
-    patient = verify_patient(email, password)
-    if not patient:
-        language = detect_language(message)
-        response = "Invalid email or password." if language == "english" else "Email or password is incorrect."
-        return JSONResponse(content={"response": response})
+    def save():
+        if persist:
+            session_store.save(session_id, session_data)
 
-    patient_id, patient_name = patient
+    # Logged-in sessions skip the credential check; otherwise the message must carry them
+    snapshot = None
+    if "patient_id" in session_data:
+        patient_id, patient_name = session_data["patient_id"], session_data["patient_name"]
+        snapshot = snapshots.get(session_id, session_data)
+    else:
+        patient = authenticate(data.get("email", ""), data.get("password", ""))
+        if not patient:
+            language = detect_language(message)
+            response = "Invalid email or password." if language == "english" else "Email or password is incorrect."
+            return [response], False
+        patient_id, patient_name = patient
 
-    session_data = sessions.get(session_id, {})
     if "chat_state" not in session_data:
         session_data["chat_state"] = "initial"
-        sessions[session_id] = session_data
+        save()
 
+    # Voice input is transcribed through /speech first, so an empty message means nothing was heard
     if not message or message.strip() == "":
-        message = recognize_speech()
-        if not message:
-            language = detect_language(message)
-            response = "No speech detected. Please try typing or speaking again." if language == "english" else "Speech not detected. Please speak or type again."
-            return JSONResponse(content={"response": response})
+        response = "No speech detected. Please try typing or speaking again."
+        return [response], False
 
     language = detect_language(message)
-    print(f"Received message: '{message}' (Language: {language})")  # Debug log
+    logger.debug("Chat message: %d characters (language: %s)", len(message), language)
 
     # Handle specific field requests from heart_disease_test with fuzzy matching
-    field_keywords = {
-        'patient_id': ['patient id', 'شناسه بیمار'],
-        'education': ['education', 'تحصیلات'],
-        'currentSmoker': ['current smoker', 'سیگاری فعلی'],
-        'cigsPerDay': ['cigs per day', 'سیگار در روز'],
-        'BPMeds': ['bp meds', 'داروی فشار خون'],
-        'prevalentStroke': ['prevalent stroke', 'سکته قبلی'],
-        'prevalentHyp': ['prevalent hyp', 'فشار خون بالا'],
-        'diabetes': ['diabetes', 'دیابت'],
-        'BMI': ['bmi', 'شاخص توده بدنی'],
-        'totChol': ['total cholesterol', 'کلسترول کل'],
-        'sysBP': ['systolic bp', 'فشار سیستولیک'],
-        'diaBP': ['diastolic bp', 'فشار دیاستولیک'],
-        'heartRate': ['heart rate', 'ضربان قلب'],
-        'glucose': ['glucose', 'گلوکز'],
-        'test_time': ['test time', 'زمان تست'],
-        'CHD': ['chd', 'بیماری قلبی']
-    }
-
-    for field, keywords in field_keywords.items():
-        message_words = clean_text(message).split()
-        print(f"Checking field: {field}, Keywords: {keywords}, Message words: {message_words}")  # Debug log
-        for word in message_words:
-            if match_keyword(word, keywords):
-                print(f"Matched field: {field} with word: {word}")  # Debug log
-                response = get_heart_disease_data(patient_id, field, language)
-                text_to_speech(response)
-                session_data["chat_state"] = "initial"
-                sessions[session_id] = session_data
-                return JSONResponse(content={"response": response})
+    field, score = field_matcher.match(message)
+    if field:
+        logger.debug("Matched field: %s (score: %s)", field, score)
+        response = answer_field(snapshot, field, language) or await get_heart_disease_data(patient_id, field, language)
+        session_data["chat_state"] = "initial"
+        save()
+        return [response], True
 
     # Handle other requests with fuzzy matching
-    if match_keyword(message, ['blood test', 'آزمایش خون']):
-        print("Matched: blood test")  # Debug log
-        response = get_test_results(patient_id, 'blood test', language)
-        text_to_speech(response)
-        session_data["chat_state"] = "initial"
-        sessions[session_id] = session_data
-        return JSONResponse(content={"response": response})
-    elif match_keyword(message, ['blood pressure', 'فشار خون']):
-        print("Matched: blood pressure")  # Debug log
-        response = get_blood_pressure(patient_id, language)
-        text_to_speech(response)
-        session_data["chat_state"] = "initial"
-        sessions[session_id] = session_data
-        return JSONResponse(content={"response": response})
-    elif match_keyword(message, ['blood sugar', 'قند خون']):
-        print("Matched: blood sugar")  # Debug log
-        response = get_latest_blood_sugar(patient_id, language)
-        text_to_speech(response)
-        session_data["chat_state"] = "initial"
-        sessions[session_id] = session_data
-        return JSONResponse(content={"response": response})
-    elif match_keyword(message, ['treatment', 'درمان']):
-        print("Matched: treatment")  # Debug log
-        response = get_treatment_info(patient_id, language)
-        text_to_speech(response)
-        session_data["chat_state"] = "initial"
-        sessions[session_id] = session_data
-        return JSONResponse(content={"response": response})
-    elif match_keyword(message, ['other test', 'تست دیگر']):
-        print("Matched: other test")  # Debug log
-        response = "test hesam" if language == "english" else "تست حسام"
-        text_to_speech(response)
+    topic, score = topic_matcher.match(message)
+    if topic:
+        logger.debug("Matched topic: %s (score: %s)", topic, score)
         session_data["chat_state"] = "initial"
-        sessions[session_id] = session_data
-        return JSONResponse(content={"response": response})
+        save()
+        # The treatment history can be long; streamed replies send it line by line
+        if topic == "treatment" and stream:
+            return stream_treatments(snapshot, language) or iter_treatment_info(patient_id, language), True
+        # Answered from the login snapshot when it has the data, else from the live helpers
+        response = answer_topic(snapshot, topic, language)
+        if response is None:
+            if topic == "blood_test":
+                response = get_test_results(patient_id, 'blood test', language)
+            elif topic == "blood_pressure":
+                response = get_blood_pressure(patient_id, language)
+            elif topic == "blood_sugar":
+                response = await get_latest_blood_sugar(patient_id, language)
+            elif topic == "treatment":
+                response = get_treatment_info(patient_id, language)
+            else:
+                response = "test hesam" if language == "english" else "تست حسام"
+        return [response], True
 
+    is_greeting = greeting_matcher.match(message)[0] is not None
     chat_state = session_data["chat_state"]
-    if chat_state == "initial" and match_keyword(message, ['hello', 'hi', 'سلام']):
-        print("Matched: hello/hi/سلام")  # Debug log
+    if chat_state == "initial" and is_greeting:
+        logger.debug("Matched greeting")
         session_data["chat_state"] = "asked_how_are_you"
         response = f"Hi {patient_name}, how are you today?" if language == "english" else f"سلام {patient_name}، امروز چطور هستید؟"
-        text_to_speech(response)
-        sessions[session_id] = session_data
-        return JSONResponse(content={"response": response})
+        save()
+        return [response], True
 
     elif chat_state == "asked_how_are_you":
-        if any(match_keyword(message, [keyword]) for keyword in ['good', 'fine', 'great', 'okay', 'bad', 'خوب', 'بد']):
-            print("Matched: response to how are you")  # Debug log
+        if mood_matcher.match(message)[0]:
+            logger.debug("Matched response to how are you")
             session_data["chat_state"] = "ready_to_assist"
             response = f"Great {patient_name}! How can I assist you today?" if language == "english" else f"عالیه {patient_name}! چطور می‌تونم بهتون کمک کنم؟"
-            text_to_speech(response)
-            sessions[session_id] = session_data
-            return JSONResponse(content={"response": response})
+            save()
+            return [response], True
         else:
             response = f"Sorry {patient_name}, I didn’t understand. How are you today?" if language == "english" else f"متاسفم {patient_name}، متوجه نشدم. امروز چطور هستید؟"
-            text_to_speech(response)
-            return JSONResponse(content={"response": response})
-
-    if chat_state == "ready_to_assist" or match_keyword(message, ['hello', 'hi', 'سلام']):
-        if match_keyword(message, ['hello', 'hi', 'سلام']):
-            print("Matched: hello/hi/سلام in ready_to_assist state")  # Debug log
-            for field, keywords in field_keywords.items():
-                message_words = clean_text(message).split()
-                for word in message_words:
-                    if match_keyword(word, keywords):
-                        print(f"Matched field: {field} with word: {word} in ready_to_assist")  # Debug log
-                        response = get_heart_disease_data(patient_id, field, language)
-                        text_to_speech(response)
-                        session_data["chat_state"] = "initial"
-                        sessions[session_id] = session_data
-                        return JSONResponse(content={"response": response})
-            if match_keyword(message, ['blood test', 'آزمایش خون']):
-                print("Matched: blood test in ready_to_assist")  # Debug log
-                response = get_test_results(patient_id, 'blood test', language)
-                text_to_speech(response)
-            elif match_keyword(message, ['blood pressure', 'فشار خون']):
-                print("Matched: blood pressure in ready_to_assist")  # Debug log
-                response = get_blood_pressure(patient_id, language)
-                text_to_speech(response)
-            elif match_keyword(message, ['blood sugar', 'قند خون']):
-                print("Matched: blood sugar in ready_to_assist")  # Debug log
-                response = get_latest_blood_sugar(patient_id, language)
-                text_to_speech(response)
-            elif match_keyword(message, ['treatment', 'درمان']):
-                print("Matched: treatment in ready_to_assist")  # Debug log
-                response = get_treatment_info(patient_id, language)
-                text_to_speech(response)
-            else:
-                response = f"How can I assist you today?" if language == "english" else f"چطور می‌تونم بهتون کمک کنم؟"
-                text_to_speech(response)
+            return [response], True
+
+    if chat_state == "ready_to_assist" or is_greeting:
+        if is_greeting:
+            # Field and topic requests were already answered above
+            logger.debug("Matched greeting in ready_to_assist state")
+            response = f"How can I assist you today?" if language == "english" else f"چطور می‌تونم بهتون کمک کنم؟"
             session_data["chat_state"] = "initial"
-            sessions[session_id] = session_data
-            return JSONResponse(content={"response": response})
+            save()
+            return [response], True
         else:
             response = "Please specify what you need, e.g., 'heart rate', 'blood pressure', 'blood sugar', 'diabetes', or 'treatment'." if language == "english" else "لطفاً بگید چی نیاز دارید، مثلاً 'ضربان قلب'، 'فشار خون'، 'قند خون'، 'دیابت' یا 'درمان'."
-            text_to_speech(response)
-            return JSONResponse(content={"response": response})
+            return [response], True
 
     response = "Please specify what you need, e.g., 'heart rate', 'blood pressure', 'blood sugar', 'diabetes', or 'treatment'." if language == "english" else "لطفاً بگید چی نیاز دارید، مثلاً 'ضربان قلب'، 'فشار خون'، 'قند خون'، 'دیابت' یا 'درمان'."
-    print("No match found, returning default response.")  # Debug log
-    text_to_speech(response)
-    return JSONResponse(content={"response": response})
\ No newline at end of file
+    logger.debug("No match found, returning default response")
+    return [response], True
+
+# Not logged in and no credentials to check: the session expired, was
+# evicted or was lost on a restart, and the client should log in again
+def needs_login(session_data, data):
+    return "patient_id" not in session_data and not data.get("email")
+
+# Chat endpoint
+@router.post("/chat")
+async def chat(request: Request, session_id: str = Depends(get_session)):
+    data = await request.json()
+    if needs_login(request.state.session, data):
+        return JSONResponse(status_code=401, content={"response": "Please log in."})
+    # Without a session cookie (credentials in the body) the new session is
+    # never sent back, so it is not stored
+    chunks, speak = await chat_turn(session_id, request.state.session, data, persist=not request.state.new_session)
+    response = "".join(chunks)
+    if not speak:
+        return JSONResponse(content={"response": response})
+    return reply(response)
+
+# Answer one chat socket message; returns False once the session is gone
+async def socket_turn(websocket, session_id, data):
+    # Re-read the session every message: /logout and the snapshot builder change it meanwhile
+    session_data = session_store.get(session_id)
+    data = data if isinstance(data, dict) else {}
+    if session_data is None or needs_login(session_data, data):
+        await websocket.close(code=SOCKET_NO_SESSION)
+        return False
+    chunks, speak = await chat_turn(session_id, session_data, data, stream=True)
+    text = []
+    for chunk in chunks:
+        text.append(chunk)
+        await websocket.send_json({"type": "chunk", "text": chunk})
+    end = {"type": "end"}
+    audio_id = text_to_speech("".join(text)) if speak else None
+    if audio_id:
+        end["audio"] = f"/audio/{audio_id}"
+    await websocket.send_json(end)
+    return True
+
+# Streaming chat: one WebSocket per browser session, opened with the session
+# cookie from / or /login. Each {"message": ...} sent by the client is answered
+# with {"type": "chunk", "text": ...} frames as the reply is produced, then
+# {"type": "end", "audio": ...} once it is complete. Messages are answered in order.
+# A message over the admission limits gets {"type": "error", "error":
+# "rate_limited" or "overloaded", "retry_after": seconds} instead.
+@router.websocket("/chat/ws")
+async def chat_socket(websocket: WebSocket):
+    session_id = websocket.cookies.get("session_id")
+    if session_store.get(session_id) is None:
+        await websocket.close(code=SOCKET_NO_SESSION)
+        return
+    await websocket.accept()
+    try:
+        while True:
+            try:
+                data = json.loads(await websocket.receive_text())
+            except ValueError:
+                await websocket.send_json({"type": "error", "error": "Messages must be JSON"})
+                continue
+            start = time.perf_counter()
+            # Each message is admitted like a POST /chat
+            try:
+                admission.check_rate(session_id, websocket.client.host if websocket.client else None)
+                await admission.acquire()
+            except Rejected as e:
+                await websocket.send_json({"type": "error", "error": e.reason, "retry_after": e.retry_seconds()})
+                continue
+            admission.admitted()
+            try:
+                if not await socket_turn(websocket, session_id, data):
+                    return
+            finally:
+                admission.chats.release(time.perf_counter() - start)
+            request_seconds.labels("WS", "/chat/ws", "message").observe(time.perf_counter() - start)
+    except WebSocketDisconnect:
+        pass
+
+# Synthesized audio for a chat reply
+@router.get("/audio/{audio_id}")
+async def audio(audio_id: str):
+    status = speech_worker.status(audio_id)
+    if status == "ready":
+        return FileResponse(speech_worker.path(audio_id), media_type="audio/wav")
+    if status == "pending":
+        return JSONResponse(status_code=202, content={"status": "pending"}, headers={"Retry-After": "1"})
+    return JSONResponse(status_code=404, content={"status": "missing"})
+
+# Longest a /speech request waits for a transcript before answering 202
+MAX_SPEECH_WAIT = 10
+
+def speech_reply(job, status_code=None):
+    content = speech_pool.result(job)
+    if status_code is None:
+        status_code = {"done": 200, "failed": 500}.get(content["status"], 202)
+    return JSONResponse(status_code=status_code, content=content)
+
+def speech_error(e):
+    if isinstance(e, SpeechBusy):
+        return JSONResponse(status_code=503, content={"status": "busy"}, headers={"Retry-After": "1"})
+    return JSONResponse(status_code=400, content={"status": "invalid", "error": str(e)})
+
+def logged_in(request):
+    return "patient_id" in request.state.session
+
+def unauthorized():
+    return JSONResponse(status_code=401, content={"status": "unauthorized"})
+
+# Patient id a speech job is opened for; only that patient's sessions can use it
+def job_owner(request):
+    return str(request.state.session["patient_id"])
+
+# The session's speech job, or None if it is missing or another patient's
+def owned_job(request, job_id):
+    job = speech_pool.get(job_id)
+    if job is None or job.get("owner") != job_owner(request):
+        return None
+    return job
+
+# Speech input: upload a complete WAV file to be transcribed by the recognizer pool
+@router.post("/speech")
+async def speech_upload(request: Request, language: str = None, wait: float = 0, session_id: str = Depends(get_session)):
+    if not logged_in(request):
+        return unauthorized()
+    try:
+        job = speech_pool.submit_wav(await request.body(), language, job_owner(request))
+    except (ValueError, SpeechBusy) as e:
+        return speech_error(e)
+    await speech_pool.wait(job, min(wait, MAX_SPEECH_WAIT))
+    return speech_reply(job)
+
+# Speech input while recording: open a job for raw 16-bit mono PCM at the given rate
+@router.post("/speech/stream")
+async def speech_stream(request: Request, rate: int = 16000, language: str = None, session_id: str = Depends(get_session)):
+    if not logged_in(request):
+        return unauthorized()
+    try:
+        job = speech_pool.open_stream(rate, language, job_owner(request))
+    except ValueError as e:
+        return speech_error(e)
+    return speech_reply(job, 201)
+
+# Append a PCM chunk; the reply carries the latest partial transcript
+@router.post("/speech/{job_id}/chunk")
+async def speech_chunk(job_id: str, request: Request, session_id: str = Depends(get_session)):
+    if not logged_in(request):
+        return unauthorized()
+    job = owned_job(request, job_id)
+    if job is None:
+        return JSONResponse(status_code=404, content={"status": "missing"})
+    try:
+        speech_pool.append(job, await request.body())
+    except ValueError as e:
+        return speech_error(e)
+    return speech_reply(job, 200)
+
+# Stop recording and queue the final transcription
+@router.post("/speech/{job_id}/finish")
+async def speech_finish(job_id: str, request: Request, wait: float = 0, session_id: str = Depends(get_session)):
+    if not logged_in(request):
+        return unauthorized()
+    job = owned_job(request, job_id)
+    if job is None:
+        return JSONResponse(status_code=404, content={"status": "missing"})
+    try:
+        speech_pool.finish(job)
+    except SpeechBusy as e:
+        return speech_error(e)
+    await speech_pool.wait(job, min(wait, MAX_SPEECH_WAIT))
+    return speech_reply(job)
+
+# Transcript of a speech job, waiting up to `wait` seconds for it
+@router.get("/speech/{job_id}")
+async def speech_result(job_id: str, request: Request, wait: float = 0, session_id: str = Depends(get_session)):
+    if not logged_in(request):
+        return unauthorized()
+    job = owned_job(request, job_id)
+    if job is None:
+        return JSONResponse(status_code=404, content={"status": "missing"})
+    await speech_pool.wait(job, min(wait, MAX_SPEECH_WAIT))
+    return speech_reply(job)
+
+# Session store metrics: live sessions, evictions, expirations and memory use
+@router.get("/sessions/stats")
+async def session_stats():
+    return JSONResponse(content=session_store.stats())
+
+# Hit ratio of the per-patient treatment/blood pressure/test result answer cache
+@router.get("/cache/stats")
+async def cache_stats():
+    return JSONResponse(content=response_cache.stats())
+
+
+# Admission control counters: admitted, queued and shed requests, live chat turns
+@router.get("/admission/stats")
+async def admission_stats():
+    return JSONResponse(content=admission.stats())
+
+# Prometheus metrics: per-stage and per-route latency histograms plus the
+# connection pool, session store, caches, remote tables, table sync, admission and TTS worker counters
+@router.get("/metrics")
+async def metrics():
+    body = render_metrics({
+        "ehospital_db_pool": pool.stats(),
+        "ehospital_sessions": session_store.stats(),
+        "ehospital_response_cache": response_cache.stats(),
+        "ehospital_credential_cache": dict(credential_cache.stats),
+        "ehospital_remote": remote.stats(),
+        "ehospital_sync": sync_stats(),
+        "ehospital_admission": admission.stats(),
+        "ehospital_tts": dict(speech_worker.stats, available=int(speech_worker.available)),
+        "ehospital_speech": speech_pool.stats,
+        "ehospital_snapshots": snapshots.stats,
+    })
+    return PlainTextResponse(body, media_type="text/plain; version=0.0.4")
@@ -0,0 +1,204 @@
+import time
+from functools import lru_cache
+from fuzzywuzzy import fuzz
+from db import query_all
+from metrics import timed
+
+# Searchable tables: the FTS5 index over their text columns, the columns a
+# result carries and the column recent results are ordered by
+SEARCHES = {
+    "treatments": {
+        "index": "treatments_fts",
+        "table": "patients_treatment",
+        "text": ("treatment", "disease_type"),
+        "columns": ("id", "patient_id", "doctor_id", "treatment", "RecordDate", "disease_type"),
+    },
+    "messages": {
+        "index": "messages_fts",
+        "table": "messages",
+        "text": ("message",),
+        "columns": ("id", "patient_id", "doctor_id", "patient_FName", "patient_LName", "message", "time_stamp"),
+    },
+}
+
+# The trigram tokenizer indexes every three characters, so it cannot match shorter queries
+MIN_QUERY = 3
+
+# Default and maximum number of results
+SEARCH_LIMIT = 20
+MAX_SEARCH_LIMIT = 200
+
+# Fuzzy matches scoring below this (0-100, see _similarity) are dropped
+FUZZY_THRESHOLD = 80
+
+# Newest rows scored as fuzzy candidates when nothing matches exactly
+FUZZY_CANDIDATES = 200
+
+# Treatment keywords the chat helpers look for, with their Persian equivalents
+# (the same pairs as intent.TOPIC_KEYWORDS)
+TREATMENT_TERMS = {
+    "blood test": ("blood test", "آزمایش خون"),
+    "blood pressure": ("blood pressure", "فشار خون"),
+}
+
+# Arabic letters often typed in place of their Persian forms
+PERSIAN_FORMS = str.maketrans({"ي": "ی", "ى": "ی", "ك": "ک"})
+ARABIC_FORMS = str.maketrans({"ی": "ي", "ک": "ك"})
+
+class InvalidQuery(ValueError):
+    pass
+
+# External-content FTS5 tables: the text stays in the base table and the
+# index is kept in sync by triggers, so every insert, upsert and delete
+# (including the CSV import and the message writer) is searchable at once
+def _index_statements(spec):
+    index, table, text = spec["index"], spec["table"], spec["text"]
+    columns = ", ".join(text)
+    new_values = ", ".join(f"NEW.{column}" for column in text)
+    old_values = ", ".join(f"OLD.{column}" for column in text)
+    delete = f"INSERT INTO {index} ({index}, rowid, {columns}) VALUES ('delete', OLD.id, {old_values});"
+    insert = f"INSERT INTO {index} (rowid, {columns}) VALUES (NEW.id, {new_values});"
+    return (
+        f"""CREATE TRIGGER IF NOT EXISTS trg_{index}_insert AFTER INSERT ON {table} BEGIN
+            {insert}
+        END""",
+        f"""CREATE TRIGGER IF NOT EXISTS trg_{index}_delete AFTER DELETE ON {table} BEGIN
+            {delete}
+        END""",
+        f"""CREATE TRIGGER IF NOT EXISTS trg_{index}_update AFTER UPDATE ON {table} BEGIN
+            {delete}
+            {insert}
+        END""",
+    )
+
+def _index_schema(spec):
+    return (f"CREATE VIRTUAL TABLE {spec['index']} USING fts5("
+            f"{', '.join(spec['text'])}, content='{spec['table']}', content_rowid='id', tokenize='trigram')")
+
+# Create missing search indexes and their triggers. A new index is filled
+# from the rows already in its table; afterwards the triggers keep it current.
+# Returns (index, seconds) for every index that was built.
+def build_search_index(conn):
+    built = []
+    for spec in SEARCHES.values():
+        exists = conn.execute("SELECT 1 FROM sqlite_master WHERE name = ?", (spec["index"],)).fetchone()
+        if not exists:
+            start = time.perf_counter()
+            conn.execute(_index_schema(spec))
+            conn.execute(f"INSERT INTO {spec['index']} ({spec['index']}) VALUES ('rebuild')")
+            built.append((spec["index"], time.perf_counter() - start))
+        for statement in _index_statements(spec):
+            conn.execute(statement)
+    conn.commit()
+    return built
+
+# Refill the search indexes over table from its rows, for writes that
+# bypassed the triggers (see bulk_load.py). Returns the indexes rebuilt.
+def rebuild_search_index(conn, table):
+    rebuilt = []
+    for spec in SEARCHES.values():
+        index = spec["index"]
+        if spec["table"] == table and conn.execute("SELECT 1 FROM sqlite_master WHERE name = ?", (index,)).fetchone():
+            conn.execute(f"INSERT INTO {index} ({index}) VALUES ('rebuild')")
+            rebuilt.append(index)
+    return rebuilt
+
+# Lower-case, Persian letter forms, single spaces; stored text is compared the same way
+def normalize(text):
+    return " ".join((text or "").translate(PERSIAN_FORMS).casefold().split())
+
+# The ways a normalized query can be spelled in the raw text the index holds
+def _spellings(text):
+    return dict.fromkeys((text, text.translate(ARABIC_FORMS)))
+
+def _phrase(text):
+    return '"' + text.replace('"', '""') + '"'
+
+# Substring match on any spelling of the query
+def exact_query(text):
+    return " OR ".join(_phrase(spelling) for spelling in _spellings(text))
+
+# Rows holding either half of a query word: a typo damages one half of a
+# word but usually leaves the other intact
+def fuzzy_query(text):
+    pieces = {}
+    for word in text.split():
+        if len(word) < MIN_QUERY:
+            continue
+        size = max(MIN_QUERY, len(word) // 2)
+        for piece in (word[:size], word[-size:]):
+            pieces.update(dict.fromkeys(_spellings(piece)))
+    return " OR ".join(_phrase(piece) for piece in pieces)
+
+# How closely the best stretch of a value spells the query. Text shorter
+# than the query is compared whole, so "blood test" does not pass for "blood pressure".
+def _similarity(text, value):
+    value = normalize(value)
+    return fuzz.partial_ratio(text, value) if len(value) >= len(text) else fuzz.ratio(text, value)
+
+# Rows scoring at least FUZZY_THRESHOLD, best first
+def _best(text, rows, spec, limit):
+    similarity = lru_cache(maxsize=None)(lambda value: _similarity(text, value))  # values repeat across rows
+    scored = [(max(similarity(row[column]) for column in spec["text"]), row) for row in rows]
+    scored = sorted((item for item in scored if item[0] >= FUZZY_THRESHOLD), key=lambda item: -item[0])
+    return [row for _, row in scored[:limit]]
+
+def _rows(sql, params):
+    return [dict(row) for row in query_all(sql, params)]
+
+# Search the whole table through its full-text index, newest rows first
+def _search_index(spec, text, limit):
+    columns = ", ".join(f"t.{column}" for column in spec["columns"])
+    sql = (f"SELECT {columns} FROM {spec['index']} JOIN {spec['table']} t ON t.id = {spec['index']}.rowid "
+           f"WHERE {spec['index']} MATCH ?")
+    rows = _rows(sql + f" ORDER BY {spec['index']}.rowid DESC LIMIT ?", (exact_query(text), limit))
+    if rows:
+        return "exact", rows
+    # Only the newest candidates are scored; ranking all of them with bm25
+    # costs a pass over every row that shares a piece
+    query = fuzzy_query(text)
+    if not query:
+        return "fuzzy", []
+    candidates = _rows(sql + f" ORDER BY {spec['index']}.rowid DESC LIMIT ?", (query, FUZZY_CANDIDATES))
+    return "fuzzy", _best(text, candidates, spec, limit)
+
+# One patient's rows are few and reached through the patient_id index; a
+# full-text lookup would walk every match in the table to find them
+def _search_patient(spec, text, patient_id, limit):
+    sql = f"SELECT {', '.join(spec['columns'])} FROM {spec['table']} WHERE patient_id = ? ORDER BY id DESC"
+    rows = _rows(sql, (patient_id,))
+    exact = [row for row in rows if any(text in normalize(row[column]) for column in spec["text"])]
+    if exact:
+        return "exact", exact[:limit]
+    return "fuzzy", _best(text, rows, spec, limit)
+
+# Search treatments or messages for text, optionally for one patient.
+# Substring matches come first (newest first); when there are none, rows
+# with a close spelling are returned instead, best first.
+@timed("search")
+def search(kind, text, patient_id=None, limit=SEARCH_LIMIT):
+    spec = SEARCHES[kind]
+    text = normalize(text)
+    if len(text) < MIN_QUERY:
+        raise InvalidQuery(f"Query must be at least {MIN_QUERY} characters")
+    limit = max(1, min(limit, MAX_SEARCH_LIMIT))
+    if patient_id is None:
+        match, rows = _search_index(spec, text, limit)
+    else:
+        match, rows = _search_patient(spec, text, patient_id, limit)
+    return {"query": text, "match": match if rows else "none", "results": rows}
+
+# Spellings the chat helpers accept for a treatment keyword
+def treatment_terms(keyword):
+    keyword = normalize(keyword)
+    return [normalize(term) for term in TREATMENT_TERMS.get(keyword, (keyword,))]
+
+# First (treatment, date) among rows ordered newest first whose treatment
+# mentions the keyword in English or Persian, or None
+def latest_matching(rows, keyword):
+    terms = treatment_terms(keyword)
+    for row in rows:
+        treatment = normalize(row[0])
+        if any(term in treatment for term in terms):
+            return row[0], row[1]
+    return None
@@ -0,0 +1,34 @@
+# Production entry point: the FastAPI app in several uvicorn worker processes.
+#
+# The database is initialized once here, under init_db's lock file, before
+# any worker starts; the workers then skip it. Sessions and speech jobs live
+# in the shared SQLite store (EHOSPITAL_SESSION_DB) and rendered audio in
+# AUDIO_DIR, so any worker can serve any request of a session. The answer
+# cache stays per process but is validated against the shared treatment
+# versions, and remote tables and logins are cached per process with a TTL.
+#
+# Usage: python serve.py [--workers N] [--host 0.0.0.0] [--port 8000]
+import argparse
+import os
+import uvicorn
+
+def main():
+    parser = argparse.ArgumentParser(description="Run the e-hospital chatbot in several worker processes")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1)
+    parser.add_argument("--host", default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=8000)
+    args = parser.parse_args()
+
+    backend = os.environ.setdefault("EHOSPITAL_SESSION_BACKEND", "sqlite")
+    if args.workers > 1 and backend != "sqlite":
+        parser.error("several workers need EHOSPITAL_SESSION_BACKEND=sqlite to share sessions")
+
+    from utils import init_db
+    init_db()
+    # Read by utils in every worker process uvicorn spawns
+    os.environ["EHOSPITAL_INIT_MODE"] = "skip"
+
+    uvicorn.run("main:app", host=args.host, port=args.port, workers=args.workers)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,177 @@
+import json
+import os
+import sys
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from db import ConnectionPool
+
+# Matches the max_age of the session_id cookie
+SESSION_TTL = 3600
+
+MAX_SESSIONS = int(os.environ.get("EHOSPITAL_MAX_SESSIONS", "10000"))
+
+def new_session_id():
+    return str(uuid.uuid4())
+
+# In-process session store: least recently used sessions are evicted once
+# max_sessions is reached, and sessions idle for longer than ttl expire.
+class MemorySessionStore:
+    backend = "memory"
+
+    def __init__(self, max_sessions=MAX_SESSIONS, ttl=SESSION_TTL):
+        self.max_sessions = max_sessions
+        self.ttl = ttl
+        self._sessions = OrderedDict()  # session id -> (expires_at, data)
+        self._lock = threading.Lock()
+        self.evictions = 0
+        self.expired = 0
+
+    def get(self, session_id):
+        if not session_id:
+            return None
+        with self._lock:
+            entry = self._sessions.get(session_id)
+            if entry is None:
+                return None
+            expires_at, data = entry
+            now = time.monotonic()
+            if expires_at <= now:
+                del self._sessions[session_id]
+                self.expired += 1
+                return None
+            self._sessions[session_id] = (now + self.ttl, data)
+            self._sessions.move_to_end(session_id)
+            return data
+
+    def save(self, session_id, data):
+        with self._lock:
+            self._sessions[session_id] = (time.monotonic() + self.ttl, data)
+            self._sessions.move_to_end(session_id)
+            self._purge()
+
+    def delete(self, session_id):
+        with self._lock:
+            self._sessions.pop(session_id, None)
+
+    # Drop expired sessions from the old end, then evict down to max_sessions
+    def _purge(self):
+        now = time.monotonic()
+        while self._sessions:
+            session_id, (expires_at, _) = next(iter(self._sessions.items()))
+            if expires_at > now:
+                break
+            del self._sessions[session_id]
+            self.expired += 1
+        while len(self._sessions) > self.max_sessions:
+            self._sessions.popitem(last=False)
+            self.evictions += 1
+
+    def stats(self):
+        with self._lock:
+            self._purge()
+            size = sys.getsizeof(self._sessions)
+            for session_id, (_, data) in self._sessions.items():
+                size += sys.getsizeof(session_id) + sys.getsizeof(data)
+                size += sum(sys.getsizeof(k) + sys.getsizeof(v) for k, v in data.items())
+            return {
+                "backend": self.backend,
+                "live_sessions": len(self._sessions),
+                "evictions": self.evictions,
+                "expired": self.expired,
+                "memory_bytes": size,
+            }
+
+    def close(self):
+        pass
+
+# SQLite-backed session store that several uvicorn workers can share.
+# Session data is stored as JSON; expired rows are purged every purge_every writes.
+class SQLiteSessionStore:
+    backend = "sqlite"
+
+    def __init__(self, path, max_sessions=MAX_SESSIONS, ttl=SESSION_TTL, purge_every=200):
+        self.pool = ConnectionPool(path, max_connections=4)
+        self.max_sessions = max_sessions
+        self.ttl = ttl
+        self.purge_every = purge_every
+        self._writes = 0
+        self.evictions = 0
+        self.expired = 0
+        with self.pool.connection() as conn:
+            conn.execute("""CREATE TABLE IF NOT EXISTS sessions (
+                id TEXT PRIMARY KEY,
+                data TEXT,
+                expires_at REAL
+            )""")
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_sessions_expires ON sessions (expires_at)")
+            conn.commit()
+
+    def get(self, session_id):
+        if not session_id:
+            return None
+        now = time.time()
+        with self.pool.connection() as conn:
+            row = conn.execute(
+                "UPDATE sessions SET expires_at = ? WHERE id = ? AND expires_at > ? RETURNING data",
+                (now + self.ttl, session_id, now)
+            ).fetchone()
+            conn.commit()
+        return json.loads(row[0]) if row else None
+
+    def save(self, session_id, data):
+        with self.pool.connection() as conn:
+            conn.execute(
+                "INSERT INTO sessions (id, data, expires_at) VALUES (?, ?, ?) "
+                "ON CONFLICT(id) DO UPDATE SET data = excluded.data, expires_at = excluded.expires_at",
+                (session_id, json.dumps(data), time.time() + self.ttl)
+            )
+            conn.commit()
+        self._writes += 1
+        if self._writes % self.purge_every == 0:
+            self._purge()
+
+    def delete(self, session_id):
+        with self.pool.connection() as conn:
+            conn.execute("DELETE FROM sessions WHERE id = ?", (session_id,))
+            conn.commit()
+
+    def _purge(self):
+        with self.pool.connection() as conn:
+            self.expired += conn.execute("DELETE FROM sessions WHERE expires_at <= ?", (time.time(),)).rowcount
+            overflow = conn.execute("SELECT COUNT(*) FROM sessions").fetchone()[0] - self.max_sessions
+            if overflow > 0:
+                self.evictions += conn.execute(
+                    "DELETE FROM sessions WHERE id IN (SELECT id FROM sessions ORDER BY expires_at LIMIT ?)",
+                    (overflow,)
+                ).rowcount
+            conn.commit()
+
+    def stats(self):
+        self._purge()
+        with self.pool.connection() as conn:
+            live = conn.execute("SELECT COUNT(*) FROM sessions").fetchone()[0]
+            page_count = conn.execute("PRAGMA page_count").fetchone()[0]
+            page_size = conn.execute("PRAGMA page_size").fetchone()[0]
+        return {
+            "backend": self.backend,
+            "live_sessions": live,
+            "evictions": self.evictions,
+            "expired": self.expired,
+            "memory_bytes": page_count * page_size,
+        }
+
+    def close(self):
+        self.pool.close()
+
+# Pick the backend from EHOSPITAL_SESSION_BACKEND ("memory" or "sqlite")
+def create_session_store():
+    backend = os.environ.get("EHOSPITAL_SESSION_BACKEND", "memory")
+    if backend == "sqlite":
+        return SQLiteSessionStore(os.environ.get("EHOSPITAL_SESSION_DB", "sessions.db"))
+    if backend != "memory":
+        raise ValueError(f"Unknown session backend: {backend}")
+    return MemorySessionStore()
+
+session_store = create_session_store()
@@ -0,0 +1,157 @@
+import asyncio
+import os
+import time
+from db import query_all
+from sync import latest_remote_record
+from response_cache import treatment_version
+from session_store import session_store
+from search import latest_matching
+from metrics import logger, timed
+from utils import (
+    HEART_DISEASE_FIELDS, TREATMENT_HISTORY_SQL, format_heart_disease, format_blood_sugar, format_treatments,
+    iter_treatments, format_test_result, format_blood_pressure
+)
+
+# Seconds a snapshot is answered from before it is rebuilt in the background
+SNAPSHOT_TTL = float(os.environ.get("EHOSPITAL_SNAPSHOT_TTL", "120"))
+
+async def _heart_disease(patient_id):
+    record = await latest_remote_record("heart_disease_test", patient_id)
+    if record is None:
+        return None
+    return {field: record[field] for field in HEART_DISEASE_FIELDS if field in record}
+
+async def _blood_sugar(patient_id):
+    record = await latest_remote_record("blood_sugar_analysis", patient_id)
+    if record is None:
+        return None
+    return {key: record[key] for key in ("blood_sugar", "date") if key in record}
+
+def _treatments(patient_id):
+    version = treatment_version(patient_id)
+    rows = query_all(TREATMENT_HISTORY_SQL, (patient_id,))
+    return {"version": version, "rows": [list(row) for row in rows]}
+
+# Everything the chat answers about one patient, fetched concurrently. Only
+# the fields the chat reads are kept, as plain JSON so the SQLite session
+# store can hold it. A part whose source failed is left out, and questions
+# about it fall back to the live helpers.
+@timed("build_snapshot")
+async def build_snapshot(patient_id):
+    parts = ("heart_disease", "blood_sugar", "treatments")
+    results = await asyncio.gather(
+        _heart_disease(patient_id),
+        _blood_sugar(patient_id),
+        return_exceptions=True,
+    )
+    # An indexed lookup of a few rows; cheaper inline than a hop to a worker thread
+    try:
+        results.append(_treatments(patient_id))
+    except Exception as e:
+        results.append(e)
+    snapshot = {"patient_id": patient_id, "built_at": time.time()}
+    for part, result in zip(parts, results):
+        if isinstance(result, Exception):
+            logger.warning("Snapshot %s for patient %s failed: %s", part, patient_id, result)
+        else:
+            snapshot[part] = result
+    return snapshot
+
+# Rows of the snapshot's treatment history, or None if missing or older than
+# the patient's current treatment version (see utils.TRIGGERS)
+def _treatment_rows(snapshot):
+    treatments = snapshot.get("treatments")
+    if treatments is None or treatments["version"] is None:
+        return None
+    if treatments["version"] != treatment_version(snapshot["patient_id"]):
+        return None
+    return treatments["rows"]
+
+# Answer a heart_disease_test field question, or None to use the live helper
+def answer_field(snapshot, field, language="english"):
+    if snapshot is None or "heart_disease" not in snapshot:
+        return None
+    return format_heart_disease(snapshot["heart_disease"], field, language)
+
+# Answer a topic question, or None to use the live helper
+def answer_topic(snapshot, topic, language="english"):
+    if snapshot is None:
+        return None
+    if topic == "blood_sugar":
+        if "blood_sugar" not in snapshot:
+            return None
+        return format_blood_sugar(snapshot["blood_sugar"], language)
+    rows = _treatment_rows(snapshot)
+    if rows is None:
+        return None
+    if topic == "treatment":
+        return format_treatments(rows, language)
+    if topic == "blood_pressure":
+        return format_blood_pressure(latest_matching(rows, "blood pressure"), language)
+    if topic == "blood_test":
+        return format_test_result(latest_matching(rows, "blood test"), "blood test", language)
+    return None
+
+# Treatment history as chunks for a streamed reply, or None to use the live helper
+def stream_treatments(snapshot, language="english"):
+    rows = _treatment_rows(snapshot) if snapshot is not None else None
+    return iter_treatments(rows, language) if rows is not None else None
+
+# Keeps each logged-in session's snapshot and rebuilds it in the background
+# once it is older than ttl; stale snapshots keep being served until the
+# rebuilt one is saved. Snapshots are stored next to the session in the
+# session store, under their own key: a chat turn saves the copy of the
+# session it loaded, which would erase a snapshot saved inside it meanwhile.
+class SnapshotManager:
+    def __init__(self, ttl=SNAPSHOT_TTL):
+        self.ttl = ttl
+        self._refreshing = {}  # session id -> task
+        self.stats = {"built": 0, "served": 0, "stale": 0, "missing": 0}
+
+    # Start building a snapshot for a session that just logged in
+    def prefetch(self, session_id, patient_id):
+        self._schedule(session_id, patient_id)
+
+    def _key(self, session_id):
+        return f"{session_id}:snapshot"
+
+    def get(self, session_id, session_data):
+        snapshot = (session_store.get(self._key(session_id)) or {}).get("snapshot")
+        patient_id = session_data.get("patient_id")
+        if snapshot is None or snapshot.get("patient_id") != patient_id:
+            self.stats["missing"] += 1
+            if patient_id is not None:
+                self._schedule(session_id, patient_id)
+            return None
+        if time.time() - snapshot["built_at"] >= self.ttl:
+            self.stats["stale"] += 1
+            self._schedule(session_id, patient_id)
+        self.stats["served"] += 1
+        return snapshot
+
+    def _schedule(self, session_id, patient_id):
+        if session_id in self._refreshing:
+            return
+        task = asyncio.get_running_loop().create_task(self._build(session_id, patient_id))
+        self._refreshing[session_id] = task
+        task.add_done_callback(lambda _: self._refreshing.pop(session_id, None))
+
+    async def _build(self, session_id, patient_id):
+        snapshot = await build_snapshot(patient_id)
+        self.stats["built"] += 1
+        # Dropped if the session logged out or ended meanwhile
+        session_data = session_store.get(session_id)
+        if session_data is not None and session_data.get("patient_id") == patient_id:
+            # Wrapped, so the entry never reads as a logged-in session if sent as a cookie
+            session_store.save(self._key(session_id), {"snapshot": snapshot})
+
+    # Forget a session's snapshot (on login and logout)
+    def discard(self, session_id):
+        session_store.delete(self._key(session_id))
+
+    # Wait for in-flight builds (used on shutdown)
+    async def drain(self):
+        while self._refreshing:
+            await asyncio.gather(*list(self._refreshing.values()), return_exceptions=True)
+
+snapshots = SnapshotManager()
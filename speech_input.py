@@ -0,0 +1,464 @@
+import asyncio
+import importlib
+import io
+import json
+import os
+import threading
+import time
+import uuid
+import wave
+from collections import OrderedDict
+from db import ConnectionPool
+from metrics import record
+
+# Recognizer used by the worker processes: "sphinx" (offline, English), "vosk"
+# (offline, model in ./model), "whisper" (offline, English and Persian),
+# "google" (online) or "package.module:function" for a custom backend
+STT_BACKEND = os.environ.get("EHOSPITAL_STT_BACKEND", "sphinx")
+STT_WORKERS = int(os.environ.get("EHOSPITAL_STT_WORKERS", "2"))
+
+# Decodes queued or running at once; further uploads get a 503
+MAX_PENDING = 16
+MAX_AUDIO_SECONDS = 30
+MAX_JOBS = 1000
+JOB_TTL = 300
+
+# Seconds between checks on a job another worker process is decoding
+POLL_INTERVAL = 0.1
+
+# Backends take (recognizer, audio_data, language) and return the transcript;
+# language is "english", "persian" or None when the client did not say
+def _sphinx(recognizer, audio, language):
+    return recognizer.recognize_sphinx(audio)
+
+def _vosk(recognizer, audio, language):
+    return json.loads(recognizer.recognize_vosk(audio))["text"]
+
+def _whisper(recognizer, audio, language):
+    model = os.environ.get("EHOSPITAL_WHISPER_MODEL", "base")
+    return recognizer.recognize_whisper(audio, model=model, language=language)
+
+def _google(recognizer, audio, language):
+    return recognizer.recognize_google(audio, language="fa-IR" if language == "persian" else "en-US")
+
+BACKENDS = {"sphinx": _sphinx, "vosk": _vosk, "whisper": _whisper, "google": _google}
+
+def load_backend(name):
+    if name in BACKENDS:
+        return BACKENDS[name]
+    module_name, _, function_name = name.partition(":")
+    if not function_name:
+        raise ValueError(f"Unknown speech backend: {name}")
+    return getattr(importlib.import_module(module_name), function_name)
+
+# Runs in a worker process: decode one WAV file to lower-case text ("" if
+# nothing intelligible was said)
+def transcribe(backend, wav_bytes, language=None):
+    import speech_recognition as sr
+    recognizer = sr.Recognizer()
+    with sr.AudioFile(io.BytesIO(wav_bytes)) as source:
+        audio = recognizer.record(source)
+    try:
+        return load_backend(backend)(recognizer, audio, language).strip().lower()
+    except sr.UnknownValueError:
+        return ""
+
+# Wrap raw 16-bit mono PCM in a WAV header
+def pcm_to_wav(pcm, rate):
+    buffer = io.BytesIO()
+    with wave.open(buffer, "wb") as f:
+        f.setnchannels(1)
+        f.setsampwidth(2)
+        f.setframerate(rate)
+        f.writeframes(pcm)
+    return buffer.getvalue()
+
+# Length of a WAV file in seconds; raises ValueError if it is not one
+def wav_seconds(wav_bytes):
+    try:
+        with wave.open(io.BytesIO(wav_bytes), "rb") as f:
+            return f.getnframes() / f.getframerate()
+    except (wave.Error, EOFError) as e:
+        raise ValueError(f"Not a WAV file: {e}")
+
+class SpeechBusy(Exception):
+    pass
+
+def _failed(future):
+    return future.cancelled() or future.exception() is not None
+
+# owner is the patient id of the session that opened the job
+def _new_job(rate, language, status, owner):
+    return {
+        "id": uuid.uuid4().hex, "rate": rate, "language": language, "status": status, "owner": owner,
+        "partial": "", "transcript": None, "error": None, "created": time.time(),
+    }
+
+# Speech jobs of this process only: the audio received so far, the status
+# ("recording", "pending", "done" or "failed") and the transcripts. The
+# oldest are dropped once max_jobs is reached or they are older than ttl.
+class MemorySpeechJobs:
+    backend = "memory"
+
+    def __init__(self, max_jobs=MAX_JOBS, ttl=JOB_TTL):
+        self.max_jobs = max_jobs
+        self.ttl = ttl
+        self._jobs = OrderedDict()  # job id -> job dict with its "pcm" bytearray, oldest first
+        self._lock = threading.Lock()
+
+    def create(self, rate, language, status, owner=None):
+        job = _new_job(rate, language, status, owner)
+        now = time.time()
+        with self._lock:
+            while self._jobs:
+                oldest = next(iter(self._jobs.values()))
+                if len(self._jobs) < self.max_jobs and oldest["created"] + self.ttl > now:
+                    break
+                self._jobs.popitem(last=False)
+            self._jobs[job["id"]] = dict(job, pcm=bytearray())
+        return job
+
+    def get(self, job_id):
+        with self._lock:
+            job = self._jobs.get(job_id)
+            return None if job is None else {key: value for key, value in job.items() if key != "pcm"}
+
+    # Add a chunk to a recording job and return all its audio so far
+    def append(self, job_id, chunk, max_bytes):
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is None or job["status"] != "recording":
+                raise ValueError("Recording already finished")
+            if len(job["pcm"]) + len(chunk) > max_bytes:
+                raise ValueError(f"Audio longer than {MAX_AUDIO_SECONDS} seconds")
+            job["pcm"] += chunk
+            return bytes(job["pcm"])
+
+    # Move a recording job to "pending" and return its audio, or None if it
+    # was already finished
+    def stop_recording(self, job_id):
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is None or job["status"] != "recording":
+                return None
+            job["status"] = "pending"
+            return bytes(job["pcm"])
+
+    def update(self, job_id, **fields):
+        with self._lock:
+            if job_id in self._jobs:
+                self._jobs[job_id].update(fields)
+
+    def close(self):
+        pass
+
+# Speech jobs in SQLite, so a job opened on one uvicorn worker can be
+# appended to, finished and polled through any other. Audio is kept as one
+# row per chunk until recording stops; the worker that finishes a job
+# decodes it and writes the transcript back.
+class SQLiteSpeechJobs:
+    backend = "sqlite"
+
+    def __init__(self, path, max_jobs=MAX_JOBS, ttl=JOB_TTL, purge_every=100):
+        self.pool = ConnectionPool(path, max_connections=4)
+        self.max_jobs = max_jobs
+        self.ttl = ttl
+        self.purge_every = purge_every
+        self._created = 0
+        with self.pool.connection() as conn:
+            conn.execute("""CREATE TABLE IF NOT EXISTS speech_jobs (
+                id TEXT PRIMARY KEY,
+                rate INTEGER,
+                language TEXT,
+                status TEXT,
+                partial TEXT,
+                transcript TEXT,
+                error TEXT,
+                created REAL,
+                size INTEGER DEFAULT 0,
+                owner TEXT
+            )""")
+            # Stores created before jobs had owners
+            if "owner" not in {row[1] for row in conn.execute("PRAGMA table_info(speech_jobs)")}:
+                conn.execute("ALTER TABLE speech_jobs ADD COLUMN owner TEXT")
+            conn.execute("""CREATE TABLE IF NOT EXISTS speech_chunks (
+                job_id TEXT,
+                data BLOB
+            )""")
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_speech_jobs_created ON speech_jobs (created)")
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_speech_chunks_job ON speech_chunks (job_id)")
+            conn.commit()
+
+    def create(self, rate, language, status, owner=None):
+        job = _new_job(rate, language, status, owner)
+        with self.pool.connection() as conn:
+            conn.execute(
+                "INSERT INTO speech_jobs (id, rate, language, status, partial, created, owner) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (job["id"], rate, language, status, "", job["created"], owner)
+            )
+            conn.commit()
+        self._created += 1
+        if self._created % self.purge_every == 0:
+            self._purge()
+        return job
+
+    def get(self, job_id):
+        with self.pool.connection() as conn:
+            row = conn.execute(
+                "SELECT id, rate, language, status, partial, transcript, error, created, owner FROM speech_jobs "
+                "WHERE id = ? AND created > ?", (job_id, time.time() - self.ttl)
+            ).fetchone()
+        return dict(row) if row else None
+
+    def _audio(self, conn, job_id):
+        rows = conn.execute("SELECT data FROM speech_chunks WHERE job_id = ? ORDER BY rowid", (job_id,))
+        return b"".join(row[0] for row in rows)
+
+    def append(self, job_id, chunk, max_bytes):
+        with self.pool.connection() as conn:
+            # The size check and the insert share one transaction, so
+            # concurrent chunks cannot overshoot max_bytes together
+            accepted = conn.execute(
+                "UPDATE speech_jobs SET size = size + ? WHERE id = ? AND status = 'recording' AND size + ? <= ? "
+                "RETURNING id", (len(chunk), job_id, len(chunk), max_bytes)
+            ).fetchone()
+            if accepted:
+                conn.execute("INSERT INTO speech_chunks (job_id, data) VALUES (?, ?)", (job_id, chunk))
+                pcm = self._audio(conn, job_id)
+            conn.commit()
+        if accepted:
+            return pcm
+        job = self.get(job_id)
+        if job is None or job["status"] != "recording":
+            raise ValueError("Recording already finished")
+        raise ValueError(f"Audio longer than {MAX_AUDIO_SECONDS} seconds")
+
+    def stop_recording(self, job_id):
+        with self.pool.connection() as conn:
+            stopped = conn.execute(
+                "UPDATE speech_jobs SET status = 'pending' WHERE id = ? AND status = 'recording' RETURNING id",
+                (job_id,)
+            ).fetchone()
+            pcm = self._audio(conn, job_id) if stopped else None
+            conn.commit()
+        return pcm
+
+    def update(self, job_id, **fields):
+        assignments = ", ".join(f"{field} = ?" for field in fields)
+        with self.pool.connection() as conn:
+            conn.execute(f"UPDATE speech_jobs SET {assignments} WHERE id = ?", (*fields.values(), job_id))
+            if fields.get("status") in ("done", "failed"):
+                conn.execute("DELETE FROM speech_chunks WHERE job_id = ?", (job_id,))
+            conn.commit()
+
+    def _purge(self):
+        with self.pool.connection() as conn:
+            conn.execute("DELETE FROM speech_jobs WHERE created <= ?", (time.time() - self.ttl,))
+            conn.execute(
+                "DELETE FROM speech_jobs WHERE id IN (SELECT id FROM speech_jobs ORDER BY created DESC LIMIT -1 OFFSET ?)",
+                (self.max_jobs,)
+            )
+            conn.execute("DELETE FROM speech_chunks WHERE job_id NOT IN (SELECT id FROM speech_jobs)")
+            conn.commit()
+
+    def close(self):
+        self.pool.close()
+
+# Jobs live with the sessions: in SQLite (EHOSPITAL_SESSION_DB) when
+# EHOSPITAL_SESSION_BACKEND=sqlite, so every worker sees every job
+def create_speech_jobs():
+    if os.environ.get("EHOSPITAL_SESSION_BACKEND", "memory") == "sqlite":
+        return SQLiteSpeechJobs(os.environ.get("EHOSPITAL_SESSION_DB", "sessions.db"))
+    return MemorySpeechJobs()
+
+# Speech-to-text off the event loop.
+#
+# Uploaded audio is decoded by a bounded pool of worker processes, so a slow
+# recognizer never blocks request handling and never holds the GIL of the
+# server process. Clients either upload a finished WAV file or open a job,
+# stream raw PCM chunks into it while recording and finish it; while chunks
+# arrive, idle workers decode the audio so far to give partial transcripts.
+# Job state is kept in a MemorySpeechJobs or SQLiteSpeechJobs store; only
+# the decodes in flight belong to this process.
+class SpeechRecognizerPool:
+    def __init__(self, backend=STT_BACKEND, workers=STT_WORKERS, max_pending=MAX_PENDING, jobs=None):
+        self.backend = backend
+        self.workers = workers
+        self.max_pending = max_pending
+        self.jobs = jobs if jobs is not None else create_speech_jobs()
+        self._executor = None
+        self._finals = {}    # job id -> future of its final decode
+        self._partials = {}  # job id -> future of its partial decode
+        self._active = 0
+        self._lock = threading.Lock()
+        self.stats = {"submitted": 0, "completed": 0, "failed": 0, "rejected": 0, "partials": 0}
+
+    # The process pool machinery is imported with the first executor
+    def _new_executor(self):
+        import multiprocessing
+        from concurrent.futures import ProcessPoolExecutor
+        # spawn: the server process has threads (TTS, message writer) that fork would copy mid-state
+        return ProcessPoolExecutor(self.workers, mp_context=multiprocessing.get_context("spawn"))
+
+    # Check the backend name at startup; worker processes are started with
+    # the first decode
+    def start(self):
+        load_backend(self.backend)  # fail at startup on a misspelled backend
+
+    def _ensure_executor(self):
+        with self._lock:
+            if self._executor is None:
+                self._executor = self._new_executor()
+
+    # Swap out a pool a worker died in, unless another caller already did, and
+    # shut it down so its management thread and surviving workers exit
+    def _replace_executor(self, broken):
+        with self._lock:
+            if self._executor is broken:
+                self._executor = self._new_executor()
+            executor = self._executor
+        broken.shutdown(wait=False, cancel_futures=True)
+        return executor
+
+    def stop(self):
+        with self._lock:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown(wait=False, cancel_futures=True)
+
+    def close(self):
+        self.stop()
+        self.jobs.close()
+
+    def _submit(self, wav_bytes, language, limit):
+        if self._executor is None:
+            self._ensure_executor()
+        with self._lock:
+            if self._active >= limit:
+                return None
+            self._active += 1
+        from concurrent.futures.process import BrokenProcessPool
+        started = time.perf_counter()
+        executor = self._executor
+        try:
+            future = executor.submit(transcribe, self.backend, wav_bytes, language)
+        except BrokenProcessPool:
+            # A worker died (e.g. the recognizer crashed); replace the pool once
+            try:
+                future = self._replace_executor(executor).submit(transcribe, self.backend, wav_bytes, language)
+            except BaseException:
+                with self._lock:
+                    self._active -= 1
+                raise
+
+        def done(future):
+            with self._lock:
+                self._active -= 1
+            record("speech_decode", time.perf_counter() - started)
+        future.add_done_callback(done)
+        return future
+
+    def _decode(self, job, wav_bytes):
+        future = self._submit(wav_bytes, job["language"], self.max_pending)
+        if future is None:
+            self.stats["rejected"] += 1
+            raise SpeechBusy()
+        self._finals[job["id"]] = future
+        self.stats["submitted"] += 1
+
+        # Runs before any waiter resumes, so the store is current when it does
+        def done(future):
+            if _failed(future):
+                error = "cancelled" if future.cancelled() else str(future.exception())
+                self.jobs.update(job["id"], status="failed", error=error)
+            else:
+                self.jobs.update(job["id"], status="done", transcript=future.result())
+            with self._lock:
+                self.stats["failed" if _failed(future) else "completed"] += 1
+                self._finals.pop(job["id"], None)
+        future.add_done_callback(done)
+
+    def _decode_partial(self, job, wav_bytes):
+        future = self._submit(wav_bytes, job["language"], self.workers)
+        if future is None:
+            return
+        self._partials[job["id"]] = future
+        self.stats["partials"] += 1
+
+        def done(future):
+            if not _failed(future):
+                self.jobs.update(job["id"], partial=future.result())
+            with self._lock:
+                self._partials.pop(job["id"], None)
+        future.add_done_callback(done)
+
+    def get(self, job_id):
+        return self.jobs.get(job_id)
+
+    # Decode a complete WAV upload; raises ValueError for bad or overlong audio
+    def submit_wav(self, wav_bytes, language=None, owner=None):
+        if wav_seconds(wav_bytes) > MAX_AUDIO_SECONDS:
+            raise ValueError(f"Audio longer than {MAX_AUDIO_SECONDS} seconds")
+        job = self.jobs.create(None, language, "pending", owner)
+        try:
+            self._decode(job, wav_bytes)
+        except SpeechBusy:
+            self.jobs.update(job["id"], status="failed", error="busy")
+            raise
+        return job
+
+    # Open a job for raw 16-bit mono PCM sent in chunks at the given sample rate
+    def open_stream(self, rate, language=None, owner=None):
+        if not 8000 <= rate <= 48000:
+            raise ValueError("Sample rate must be between 8000 and 48000")
+        return self.jobs.create(rate, language, "recording", owner)
+
+    def append(self, job, chunk):
+        if job["status"] != "recording":
+            raise ValueError("Recording already finished")
+        pcm = self.jobs.append(job["id"], chunk, MAX_AUDIO_SECONDS * 2 * job["rate"])
+        # Partial decodes only use workers nobody else is waiting for
+        if job["id"] not in self._partials:
+            self._decode_partial(job, pcm_to_wav(pcm, job["rate"]))
+
+    def finish(self, job):
+        pcm = self.jobs.stop_recording(job["id"])
+        if pcm is not None:
+            try:
+                self._decode(job, pcm_to_wav(pcm, job["rate"]))
+            except SpeechBusy:
+                self.jobs.update(job["id"], status="recording")
+                raise
+        return job
+
+    # Wait up to timeout seconds for the final transcript. A job decoded by
+    # another worker process is polled in the shared store.
+    async def wait(self, job, timeout):
+        if timeout <= 0:
+            return
+        future = self._finals.get(job["id"])
+        if future is not None:
+            try:
+                await asyncio.wait_for(asyncio.shield(asyncio.wrap_future(future)), timeout)
+            except Exception:
+                pass  # timed out or failed; result() reports which
+            return
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            current = self.jobs.get(job["id"])
+            if current is None or current["status"] != "pending":
+                return
+            await asyncio.sleep(min(POLL_INTERVAL, deadline - time.monotonic()))
+
+    def result(self, job):
+        current = self.jobs.get(job["id"]) or dict(job, status="failed", error="expired")
+        content = {"id": current["id"], "status": current["status"]}
+        if current["status"] == "done":
+            content["transcript"] = current["transcript"]
+        elif current["status"] == "failed":
+            content["error"] = current["error"]
+        elif current["partial"]:
+            content["partial"] = current["partial"]
+        return content
+
+speech_pool = SpeechRecognizerPool()
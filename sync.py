@@ -0,0 +1,369 @@
+# Local mirror of the remote e-hospital /table/<name> endpoints.
+#
+# A background thread re-syncs the tables in SYNC_TABLES every SYNC_INTERVAL
+# seconds, several downloads at a time, into remote_rows in the main
+# database. Responses are parsed as they arrive, so a large table is never
+# held in memory (only its row keys and hashes are), and a row is written
+# only when its hash changed. The chat helpers read the mirror through
+# latest_remote_record and fall back to the remote API for tables that are not
+# mirrored or whose last sync is older than SYNC_MAX_AGE.
+#
+# Usage: python sync.py [--tables heart_disease_test,blood_sugar_analysis | --all]
+#                       [--concurrency 4] [--api URL]
+import argparse
+import asyncio
+import hashlib
+import json
+import os
+import re
+import sqlite3
+import threading
+import time
+from db import DATABASE, PRAGMAS, file_lock, query_one, query_all
+from metrics import logger
+from remote import BASE_URL, TIMEOUT, RemoteTableError, remote
+
+SYNC_TABLES = [name for name in os.environ.get(
+    "EHOSPITAL_SYNC_TABLES", "heart_disease_test,blood_sugar_analysis").split(",") if name]
+
+# Seconds between syncs; 0 turns the background sync off
+SYNC_INTERVAL = float(os.environ.get("EHOSPITAL_SYNC_INTERVAL", "300"))
+
+# A mirrored table not synced for this long is read from the remote API again
+SYNC_MAX_AGE = float(os.environ.get("EHOSPITAL_SYNC_MAX_AGE", "3600"))
+
+# Tables downloaded at the same time
+SYNC_CONCURRENCY = int(os.environ.get("EHOSPITAL_SYNC_CONCURRENCY", "4"))
+
+# Changed rows written per transaction, so a sync never holds the write lock for long
+BATCH = 500
+
+# Every table of the remote database, one name per line
+TABLES_FILE = os.path.join("data", "e-hospital_db_tables_name 1 (1).txt")
+
+# A row is keyed by the first of these fields it has. Keyed by patient_id,
+# a later row of the same patient replaces the earlier one, which keeps the
+# latest record per patient like RemoteTable does.
+KEY_FIELDS = ("id", "patient_id")
+
+# row_key has no declared type, so integer keys sort as numbers
+MIRROR_SCHEMA = (
+    """CREATE TABLE IF NOT EXISTS remote_rows (
+        table_name TEXT NOT NULL,
+        row_key NOT NULL,
+        patient_id INTEGER,
+        hash INTEGER NOT NULL,
+        data TEXT NOT NULL,
+        PRIMARY KEY (table_name, row_key)
+    )""",
+    "CREATE INDEX IF NOT EXISTS idx_remote_rows_patient ON remote_rows (table_name, patient_id, row_key)",
+    # Outcome of the last sync of each table; synced_at is the last successful one
+    """CREATE TABLE IF NOT EXISTS sync_state (
+        table_name TEXT PRIMARY KEY,
+        etag TEXT,
+        last_modified TEXT,
+        synced_at REAL,
+        seconds REAL,
+        rows INTEGER NOT NULL DEFAULT 0,
+        inserted INTEGER NOT NULL DEFAULT 0,
+        updated INTEGER NOT NULL DEFAULT 0,
+        deleted INTEGER NOT NULL DEFAULT 0,
+        unchanged INTEGER NOT NULL DEFAULT 0,
+        bytes INTEGER NOT NULL DEFAULT 0,
+        not_modified INTEGER NOT NULL DEFAULT 0,
+        errors INTEGER NOT NULL DEFAULT 0,
+        error TEXT
+    )""",
+)
+
+UPSERT_SQL = """INSERT INTO remote_rows (table_name, row_key, patient_id, hash, data) VALUES (?, ?, ?, ?, ?)
+    ON CONFLICT(table_name, row_key) DO UPDATE SET
+        patient_id = excluded.patient_id, hash = excluded.hash, data = excluded.data"""
+
+# Create the mirror tables
+def build_mirror(conn):
+    for statement in MIRROR_SCHEMA:
+        conn.execute(statement)
+    conn.commit()
+
+def _row_key(row, position):
+    for field in KEY_FIELDS:
+        if row.get(field) is not None:
+            return row[field]
+    return position
+
+# 64-bit hash of a row's JSON text. The text is hashed as the server sent
+# it, which is cheaper than re-encoding the row; a server that changes its
+# formatting costs one sync that rewrites every row.
+def _hash(data):
+    digest = hashlib.blake2b(data.encode("utf-8"), digest_size=8).digest()
+    return int.from_bytes(digest, "big", signed=True)
+
+_WHITESPACE = re.compile(r"\s*")
+
+# Incremental parser for a JSON array: feed() takes text as it arrives and
+# returns the items completed so far, keeping only the unfinished tail.
+# With raw=True each item comes with its JSON text: (value, text).
+class JSONArrayParser:
+    def __init__(self, raw=False):
+        self.raw = raw
+        self._decoder = json.JSONDecoder()
+        self._buffer = ""
+        self._state = "start"  # start, first (after "["), item (after ","), next, done
+
+    def feed(self, text):
+        buffer = self._buffer + text
+        pos = 0
+        items = []
+        while True:
+            pos = _WHITESPACE.match(buffer, pos).end()
+            if pos == len(buffer):
+                break
+            char = buffer[pos]
+            if self._state == "start":
+                if char != "[":
+                    raise ValueError("expected a JSON array")
+                self._state = "first"
+                pos += 1
+            elif self._state == "done":
+                raise ValueError("data after the JSON array")
+            elif char == "]" and self._state in ("first", "next"):
+                self._state = "done"
+                pos += 1
+            elif self._state == "next":
+                if char != ",":
+                    raise ValueError(f"expected ',' at {char!r}")
+                self._state = "item"
+                pos += 1
+            else:
+                try:
+                    value, end = self._decoder.raw_decode(buffer, pos)
+                except json.JSONDecodeError:
+                    break  # unfinished item; wait for more text
+                if isinstance(value, (int, float)) and (end == len(buffer) or buffer[end] not in ",] \t\r\n"):
+                    break  # a number may go on in the next chunk ("2" of "2.5")
+                items.append((value, buffer[pos:end]) if self.raw else value)
+                self._state = "next"
+                pos = end
+        self._buffer = buffer[pos:]
+        return items
+
+    def close(self):
+        if self._state != "done":
+            raise ValueError("truncated JSON array")
+
+# Mirrors remote tables into remote_rows, in the calling thread (sync_once)
+# or in a background thread every interval seconds (start/stop).
+class TableSync:
+    def __init__(self, tables=SYNC_TABLES, base_url=BASE_URL, interval=SYNC_INTERVAL,
+                 concurrency=SYNC_CONCURRENCY, database=DATABASE, timeout=TIMEOUT):
+        self.tables = list(tables)
+        self.base_url = base_url
+        self.interval = interval
+        self.concurrency = concurrency
+        self.database = database
+        self.timeout = timeout
+        self._stop = threading.Event()
+        self._thread = None
+
+    def _connect(self):
+        conn = sqlite3.connect(self.database, timeout=30)
+        for pragma in PRAGMAS:
+            conn.execute(pragma)
+        build_mirror(conn)
+        return conn
+
+    # Write a batch of changed rows in its own transaction
+    def _write(self, conn, name, batch):
+        with conn:
+            conn.executemany(UPSERT_SQL, [(name, *row) for row in batch])
+        batch.clear()
+
+    async def _sync_table(self, conn, http, name):
+        state = conn.execute("SELECT etag, last_modified FROM sync_state WHERE table_name = ?", (name,)).fetchone()
+        headers = {}
+        if state and state[0]:
+            headers["If-None-Match"] = state[0]
+        if state and state[1]:
+            headers["If-Modified-Since"] = state[1]
+        result = {"table": name, "status": "synced", "rows": 0, "inserted": 0, "updated": 0, "deleted": 0,
+                  "unchanged": 0, "bytes": 0}
+        start = time.perf_counter()
+        async with http.stream("GET", f"/table/{name}", headers=headers) as response:
+            if response.status_code == 304:
+                result["status"] = "not_modified"
+            elif response.status_code != 200:
+                raise RemoteTableError(response.status_code)
+            else:
+                hashes = dict(conn.execute("SELECT row_key, hash FROM remote_rows WHERE table_name = ?", (name,)))
+                seen = set()
+                batch = []
+                parser = JSONArrayParser(raw=True)
+                position = 0
+                async for text in response.aiter_text():
+                    for row, data in parser.feed(text):
+                        if not isinstance(row, dict):
+                            raise ValueError(f"/table/{name} returned a {type(row).__name__} row")
+                        key = _row_key(row, position)
+                        position += 1
+                        digest = _hash(data)
+                        previous = hashes.get(key)
+                        if previous == digest:
+                            if key not in seen:
+                                result["unchanged"] += 1
+                        else:
+                            result["inserted" if previous is None else "updated"] += 1
+                            hashes[key] = digest
+                            batch.append((key, row.get("patient_id"), digest, data))
+                            if len(batch) >= BATCH:
+                                self._write(conn, name, batch)
+                        seen.add(key)
+                parser.close()
+                self._write(conn, name, batch)
+                gone = [(name, key) for key in hashes if key not in seen]
+                with conn:
+                    conn.executemany("DELETE FROM remote_rows WHERE table_name = ? AND row_key = ?", gone)
+                result["deleted"] = len(gone)
+                result["rows"] = len(seen)
+                result["bytes"] = response.num_bytes_downloaded
+        result["seconds"] = time.perf_counter() - start
+        with conn:
+            if result["status"] == "not_modified":
+                conn.execute("""INSERT INTO sync_state (table_name, synced_at, seconds, not_modified, error)
+                    VALUES (?, ?, ?, 1, NULL) ON CONFLICT(table_name) DO UPDATE SET
+                    synced_at = excluded.synced_at, seconds = excluded.seconds,
+                    not_modified = not_modified + 1, error = NULL""", (name, time.time(), result["seconds"]))
+            else:
+                conn.execute("""INSERT INTO sync_state
+                    (table_name, etag, last_modified, synced_at, seconds, rows, inserted, updated, deleted, unchanged, bytes, error)
+                    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, NULL) ON CONFLICT(table_name) DO UPDATE SET
+                    etag = excluded.etag, last_modified = excluded.last_modified, synced_at = excluded.synced_at,
+                    seconds = excluded.seconds, rows = excluded.rows, inserted = excluded.inserted,
+                    updated = excluded.updated, deleted = excluded.deleted, unchanged = excluded.unchanged,
+                    bytes = excluded.bytes, error = NULL""",
+                    (name, response.headers.get("ETag"), response.headers.get("Last-Modified"), time.time(),
+                     result["seconds"], result["rows"], result["inserted"], result["updated"], result["deleted"],
+                     result["unchanged"], result["bytes"]))
+        return result
+
+    # Sync one table, recording a failure in sync_state instead of raising
+    async def _sync_guarded(self, conn, http, semaphore, name):
+        import httpx
+        async with semaphore:
+            try:
+                return await self._sync_table(conn, http, name)
+            except (httpx.HTTPError, RemoteTableError, ValueError) as e:
+                if conn.in_transaction:
+                    conn.rollback()
+                with conn:
+                    conn.execute("""INSERT INTO sync_state (table_name, errors, error) VALUES (?, 1, ?)
+                        ON CONFLICT(table_name) DO UPDATE SET errors = errors + 1, error = excluded.error""",
+                        (name, str(e) or type(e).__name__))
+                return {"table": name, "status": "error", "error": str(e) or type(e).__name__}
+
+    # Sync every table once; returns a result dict per table, or None when
+    # another process holds the sync lock (it is syncing the same database)
+    async def sync_once(self, tables=None):
+        import httpx
+        with file_lock(f"{self.database}.sync-lock", blocking=False) as held:
+            if not held:
+                return None
+            conn = self._connect()
+            read, connect = self.timeout
+            limits = httpx.Limits(max_connections=self.concurrency)
+            try:
+                async with httpx.AsyncClient(base_url=self.base_url, limits=limits,
+                                             timeout=httpx.Timeout(read, connect=connect)) as http:
+                    semaphore = asyncio.Semaphore(self.concurrency)
+                    return await asyncio.gather(*(self._sync_guarded(conn, http, semaphore, name)
+                                                  for name in (tables or self.tables)))
+            finally:
+                conn.close()
+
+    def _run(self):
+        delay = 0
+        while not self._stop.wait(delay):
+            start = time.monotonic()
+            try:
+                asyncio.run(self.sync_once())
+            except Exception as e:
+                logger.warning("Table sync failed: %s", e)
+            delay = max(0.0, self.interval - (time.monotonic() - start))
+
+    def start(self):
+        if self.interval <= 0 or not self.tables or (self._thread is not None and self._thread.is_alive()):
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="table-sync", daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout=5.0):
+        if self._thread is None:
+            return
+        self._stop.set()
+        self._thread.join(timeout)
+        self._thread = None
+
+table_sync = TableSync()
+
+# The mirrored copy of a patient's latest record: (True, record or None),
+# or (False, None) if the table is not mirrored or its copy is too old
+def local_record(name, patient_id, max_age=SYNC_MAX_AGE):
+    try:
+        row = query_one("""SELECT r.data, s.synced_at FROM sync_state s
+            LEFT JOIN remote_rows r ON r.table_name = s.table_name AND r.patient_id = ?
+            WHERE s.table_name = ? AND s.synced_at >= ?
+            ORDER BY r.row_key DESC LIMIT 1""", (patient_id, name, time.time() - max_age))
+    except sqlite3.OperationalError:
+        return False, None  # mirror tables not created yet
+    if row is None:
+        return False, None
+    return True, json.loads(row[0]) if row[0] is not None else None
+
+# Latest record of a patient in a remote table: from the mirror when it is
+# current, otherwise from the cached remote client
+async def latest_remote_record(name, patient_id):
+    mirrored, record = local_record(name, patient_id)
+    if mirrored:
+        return record
+    return await remote.table(name).get(patient_id)
+
+# Last sync of each mirrored table, for /metrics; shared by all processes
+def sync_stats():
+    rows = query_all("""SELECT table_name, synced_at, seconds, rows, inserted, updated, deleted, unchanged,
+        bytes, not_modified, errors, error IS NOT NULL FROM sync_state""")
+    now = time.time()
+    return {row[0]: {
+        "age_seconds": now - row[1] if row[1] is not None else -1, "sync_seconds": row[2] or 0.0,
+        "rows": row[3], "inserted": row[4], "updated": row[5], "deleted": row[6], "unchanged": row[7],
+        "bytes": row[8], "not_modified": row[9], "errors": row[10], "failing": row[11],
+    } for row in rows}
+
+def main():
+    parser = argparse.ArgumentParser(description="Mirror remote e-hospital tables into the local database")
+    parser.add_argument("--tables", default=",".join(SYNC_TABLES), help="comma-separated table names")
+    parser.add_argument("--all", action="store_true", help=f"every table listed in {TABLES_FILE}")
+    parser.add_argument("--concurrency", type=int, default=SYNC_CONCURRENCY)
+    parser.add_argument("--api", default=BASE_URL)
+    args = parser.parse_args()
+    if args.all:
+        with open(TABLES_FILE, encoding="utf-8") as f:
+            tables = [line.strip() for line in f if line.strip()]
+    else:
+        tables = [name for name in args.tables.split(",") if name]
+
+    start = time.perf_counter()
+    results = asyncio.run(TableSync(tables, args.api, concurrency=args.concurrency).sync_once())
+    if results is None:
+        parser.exit(1, "Another process is syncing this database\n")
+    for result in results:
+        if result["status"] == "error":
+            print(f"{result['table']}: error: {result['error']}")
+        else:
+            print(f"{result['table']}: {result['status']}, {result['rows']} rows (+{result['inserted']} "
+                  f"~{result['updated']} -{result['deleted']}), {result['bytes']} bytes in "
+                  f"{result['seconds'] * 1000:.1f} ms")
+    print(f"synced {len(results)} tables in {time.perf_counter() - start:.2f} s")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,192 @@
+import hashlib
+import os
+import queue
+import re
+import threading
+import time
+from collections import OrderedDict
+from metrics import logger
+
+AUDIO_DIR = os.environ.get("EHOSPITAL_AUDIO_DIR", "audio_cache")
+
+# Rendered files kept on disk before the least recently used are removed
+MAX_AUDIO_FILES = 2000
+
+# A pending marker older than this belongs to a worker process that died mid-render
+PENDING_TTL = 60
+
+AUDIO_ID_PATTERN = re.compile(r"^[0-9a-f]{20}$")
+
+# Audio files are named after a hash of the text, so repeated replies
+# (greetings, prompts) map to the same file
+def audio_id_for(text):
+    return hashlib.sha1(text.encode("utf-8")).hexdigest()[:20]
+
+# Long-lived text-to-speech worker.
+#
+# A single thread owns one pyttsx3 engine (engines are not thread-safe) and
+# renders queued replies to WAV files under AUDIO_DIR. submit() only enqueues,
+# so /chat returns straight away and the client fetches the audio later.
+# Queued replies get a marker file next to their WAV, so with several server
+# processes sharing AUDIO_DIR any of them can tell the client to keep waiting.
+class SpeechWorker:
+    def __init__(self, audio_dir=AUDIO_DIR, max_files=MAX_AUDIO_FILES, max_pending=256):
+        self.audio_dir = audio_dir
+        self.max_files = max_files
+        self._queue = queue.Queue(maxsize=max_pending)
+        self._ready = OrderedDict()  # audio id -> None, in least recently used order
+        self._pending = set()
+        self._lock = threading.Lock()
+        self._thread = None
+        self.available = True
+        self.stats = {"rendered": 0, "cache_hits": 0, "dropped": 0, "failed": 0}
+
+    def path(self, audio_id):
+        return os.path.join(self.audio_dir, f"{audio_id}.wav")
+
+    def _marker(self, audio_id):
+        return os.path.join(self.audio_dir, f"{audio_id}.pending")
+
+    def _mark_pending(self, audio_id):
+        try:
+            open(self._marker(audio_id), "w").close()
+        except OSError:
+            pass
+
+    def _unmark_pending(self, audio_id):
+        try:
+            os.remove(self._marker(audio_id))
+        except OSError:
+            pass
+
+    def start(self):
+        with self._lock:
+            if self._thread is not None and self._thread.is_alive():
+                return
+            os.makedirs(self.audio_dir, exist_ok=True)
+            # Pick up files rendered by a previous run, oldest first
+            names = [name for name in os.listdir(self.audio_dir)
+                     if name.endswith(".wav") and AUDIO_ID_PATTERN.match(name[:-4])]
+            names.sort(key=lambda name: os.path.getmtime(os.path.join(self.audio_dir, name)))
+            for name in names:
+                self._ready[name[:-4]] = None
+            self._thread = threading.Thread(target=self._run, name="tts-worker", daemon=True)
+            self._thread.start()
+
+    def stop(self, timeout=5.0):
+        if self._thread is None:
+            return
+        # Replies still queued are dropped, which also leaves room for the stop
+        # marker when the queue is full or the worker has died
+        with self._lock:
+            while True:
+                try:
+                    item = self._queue.get_nowait()
+                except queue.Empty:
+                    break
+                if item is not None:
+                    self.stats["dropped"] += 1
+                    self._pending.discard(item[0])
+                    self._unmark_pending(item[0])
+            self._queue.put_nowait(None)
+        self._thread.join(timeout)
+        self._thread = None
+
+    # Queue text for synthesis and return its audio id without waiting
+    def submit(self, text):
+        if not self.available:
+            return None
+        audio_id = audio_id_for(text)
+        with self._lock:
+            if audio_id in self._ready:
+                self._ready.move_to_end(audio_id)
+                self.stats["cache_hits"] += 1
+                return audio_id
+            if audio_id in self._pending:
+                self.stats["cache_hits"] += 1
+                return audio_id
+            self._mark_pending(audio_id)
+            try:
+                self._queue.put_nowait((audio_id, text))
+            except queue.Full:
+                self.stats["dropped"] += 1
+                self._unmark_pending(audio_id)
+                return None
+            self._pending.add(audio_id)
+        if self._thread is None:
+            self.start()
+        return audio_id
+
+    # "ready", "pending" or "missing"
+    def status(self, audio_id):
+        if not AUDIO_ID_PATTERN.match(audio_id):
+            return "missing"
+        with self._lock:
+            if audio_id in self._pending:
+                return "pending"
+        # Rendered, or still being rendered, by any process sharing audio_dir;
+        # the file may also have been evicted by another process
+        if os.path.exists(self.path(audio_id)):
+            return "ready"
+        try:
+            if time.time() - os.path.getmtime(self._marker(audio_id)) < PENDING_TTL:
+                return "pending"
+        except OSError:
+            pass
+        return "missing"
+
+    def _finish(self, audio_id, ok):
+        evicted = []
+        self._unmark_pending(audio_id)
+        with self._lock:
+            self._pending.discard(audio_id)
+            if ok:
+                self._ready[audio_id] = None
+                self.stats["rendered"] += 1
+                while len(self._ready) > self.max_files:
+                    evicted.append(self._ready.popitem(last=False)[0])
+            else:
+                self.stats["failed"] += 1
+        for old_id in evicted:
+            try:
+                os.remove(self.path(old_id))
+            except OSError:
+                pass
+
+    # pyttsx3 and its speech driver are loaded with the first reply to
+    # render, not when the server starts
+    def _load_engine(self):
+        try:
+            import pyttsx3
+            return pyttsx3.init()
+        except Exception as e:
+            logger.warning("Text-to-speech unavailable: %s", e)
+            self.available = False
+            return None
+
+    def _run(self):
+        engine = None
+        loaded = False
+        while True:
+            item = self._queue.get()
+            if item is None:
+                break
+            audio_id, text = item
+            if not loaded:
+                engine = self._load_engine()
+                loaded = True
+            if engine is None:
+                self._finish(audio_id, False)
+                continue
+            target = self.path(audio_id)
+            partial = f"{target}.part.wav"
+            try:
+                engine.save_to_file(text, partial)
+                engine.runAndWait()
+                os.replace(partial, target)
+                self._finish(audio_id, True)
+            except Exception:
+                logger.exception("Text-to-speech failed")
+                self._finish(audio_id, False)
+
+speech_worker = SpeechWorker()
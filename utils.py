@@ -1,10 +1,15 @@
+import os
 import sqlite3
-import pandas as pd
-import speech_recognition as sr
-import pyttsx3
-import requests
+import time
 import re
 from fuzzywuzzy import fuzz
+from db import DATABASE, query_one, query_all, file_lock
+from search import build_search_index, latest_matching
+from response_cache import cached_by_patient
+from remote import RemoteTableError
+from sync import latest_remote_record, build_mirror
+from tts import speech_worker
+from metrics import logger, timed
 
 # Function to detect language (Persian or English)
 def detect_language(text):
@@ -26,240 +31,343 @@ def match_keyword(text, keywords, threshold=60):  # Threshold set to 60
             return True
     return False
 
-# Function to initialize the database and load CSV data
-def init_db():
-    conn = sqlite3.connect("database.db")
-    cursor = conn.cursor()
-
-    # Create tables if they don’t exist
-    cursor.execute("""CREATE TABLE IF NOT EXISTS patients (
+# Table definitions; ids are INTEGER to match the values in the CSV exports
+TABLE_SCHEMAS = {
+    "patients": """CREATE TABLE IF NOT EXISTS patients (
         id INTEGER PRIMARY KEY,
         uuid TEXT,
-        age INTEGER,
-        gender TEXT,
+        Age INTEGER,
+        Gender TEXT,
         FName TEXT,
         LName TEXT,
         EmailId TEXT,
         password TEXT
-    )""")
-
-    cursor.execute("""CREATE TABLE IF NOT EXISTS patient_doctor (
+    )""",
+    "patient_doctor": """CREATE TABLE IF NOT EXISTS patient_doctor (
         id INTEGER PRIMARY KEY,
-        patient_id TEXT,
-        doctor_id TEXT,
+        patient_id INTEGER,
+        doctor_id INTEGER,
         relationship_start_date TEXT,
         relationship_status TEXT,
-        association_type TEXT
-    )""")
-
-    cursor.execute("""CREATE TABLE IF NOT EXISTS online_patients (
-        online_patient_id TEXT PRIMARY KEY,
+        association_type TEXT,
+        record_date TEXT
+    )""",
+    "online_patients": """CREATE TABLE IF NOT EXISTS online_patients (
+        online_patient_id INTEGER PRIMARY KEY,
         Fname TEXT,
         email TEXT,
         session_status TEXT,
         start_time TEXT
-    )""")
-
-    cursor.execute("""CREATE TABLE IF NOT EXISTS messages (
+    )""",
+    "messages": """CREATE TABLE IF NOT EXISTS messages (
         id INTEGER PRIMARY KEY,
-        patient_id TEXT,
-        doctor_id TEXT,
+        patient_id INTEGER,
+        doctor_id INTEGER,
+        doctor_FName TEXT,
+        doctor_LName TEXT,
         patient_FName TEXT,
         patient_LName TEXT,
         message TEXT,
+        time_sent TEXT,
         time_stamp TEXT
-    )""")
-
-    cursor.execute("""CREATE TABLE IF NOT EXISTS patients_treatment (
+    )""",
+    "patients_treatment": """CREATE TABLE IF NOT EXISTS patients_treatment (
         id INTEGER PRIMARY KEY,
-        patient_id TEXT,
-        doctor_id TEXT,
+        patient_id INTEGER,
+        doctor_id INTEGER,
         treatment TEXT,
         RecordDate TEXT,
         disease_type TEXT,
-        disease_id TEXT
-    )""")
+        disease_id INTEGER
+    )""",
+}
+
+# Indexes used by the query helpers
+INDEXES = (
+    "CREATE INDEX IF NOT EXISTS idx_patients_email ON patients (EmailId)",
+    "CREATE INDEX IF NOT EXISTS idx_treatment_patient_date ON patients_treatment (patient_id, RecordDate)",
+    # Per-patient and per-doctor reads of messages (see inbox.py); the
+    # patient one replaces the former index on patient_id alone
+    "DROP INDEX IF EXISTS idx_messages_patient",
+    "CREATE INDEX IF NOT EXISTS idx_messages_patient_time ON messages (patient_id, time_stamp)",
+    "CREATE INDEX IF NOT EXISTS idx_messages_doctor_time ON messages (doctor_id, time_stamp)",
+)
+
+# Per-patient change counter for patients_treatment, used to invalidate cached answers
+TRIGGERS = (
+    """CREATE TABLE IF NOT EXISTS treatment_versions (
+        patient_id INTEGER PRIMARY KEY,
+        version INTEGER NOT NULL
+    )""",
+    """CREATE TRIGGER IF NOT EXISTS trg_treatment_insert AFTER INSERT ON patients_treatment BEGIN
+        INSERT INTO treatment_versions (patient_id, version) VALUES (NEW.patient_id, 1)
+        ON CONFLICT(patient_id) DO UPDATE SET version = version + 1;
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS trg_treatment_update AFTER UPDATE ON patients_treatment BEGIN
+        INSERT INTO treatment_versions (patient_id, version) VALUES (OLD.patient_id, 1)
+        ON CONFLICT(patient_id) DO UPDATE SET version = version + 1;
+        INSERT INTO treatment_versions (patient_id, version) VALUES (NEW.patient_id, 1)
+        ON CONFLICT(patient_id) DO UPDATE SET version = version + 1;
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS trg_treatment_delete AFTER DELETE ON patients_treatment BEGIN
+        INSERT INTO treatment_versions (patient_id, version) VALUES (OLD.patient_id, 1)
+        ON CONFLICT(patient_id) DO UPDATE SET version = version + 1;
+    END""",
+)
+
+# Version counters of the resources the read API serves, bumped by triggers
+# on every write so conditional GETs can be answered without reading rows:
+# ("patients", 0) for the patient list, ("messages", patient_id) and
+# ("treatments", patient_id) per patient. changed_at is the Unix time of the
+# last bump.
+RESOURCE_VERSIONS = (
+    ("patients", "patients", "0"),
+    ("messages", "messages", "{row}.patient_id"),
+    ("treatments", "patients_treatment", "{row}.patient_id"),
+)
+
+def _bump_version(resource, scope):
+    return f"""
+        INSERT INTO resource_versions (resource, scope, version, changed_at)
+        SELECT '{resource}', {scope}, 1, (julianday('now') - 2440587.5) * 86400.0 WHERE {scope} IS NOT NULL
+        ON CONFLICT(resource, scope) DO UPDATE SET version = version + 1, changed_at = excluded.changed_at;"""
 
-    # Load CSV data into tables
-    patients_df = pd.read_csv("data/patients_registration (1).csv")
-    patients_df[["id", "uuid", "Age", "Gender", "FName", "LName", "EmailId", "password"]].to_sql("patients", conn, if_exists="replace", index=False)
+# An update bumps the row's old and new scope (once more if they are the same)
+def _version_trigger(resource, table, scope, event):
+    rows = {"INSERT": ("NEW",), "UPDATE": ("OLD", "NEW"), "DELETE": ("OLD",)}[event]
+    bumps = "".join(_bump_version(resource, scope.format(row=row)) for row in rows)
+    return f"""CREATE TRIGGER IF NOT EXISTS trg_{resource}_version_{event.lower()} AFTER {event} ON {table} BEGIN{bumps}
+    END"""
 
-    patient_doctor_df = pd.read_csv("data/patient_doctor (1).csv")
-    patient_doctor_df.to_sql("patient_doctor", conn, if_exists="replace", index=False)
+TRIGGERS += (
+    """CREATE TABLE IF NOT EXISTS resource_versions (
+        resource TEXT NOT NULL,
+        scope INTEGER NOT NULL,
+        version INTEGER NOT NULL,
+        changed_at REAL NOT NULL,
+        PRIMARY KEY (resource, scope)
+    )""",
+) + tuple(
+    _version_trigger(resource, table, scope, event)
+    for resource, table, scope in RESOURCE_VERSIONS for event in ("INSERT", "UPDATE", "DELETE")
+)
 
-    online_patients_df = pd.read_csv("data/online_patients (1).csv")
-    online_patients_df.to_sql("online_patients", conn, if_exists="replace", index=False)
+# Bump the versions of every patient (or the patient list) with rows in
+# table, for writes that bypassed the triggers (see bulk_load.py)
+def bump_versions(conn, table):
+    if table == "patients_treatment":
+        conn.execute("""INSERT INTO treatment_versions (patient_id, version)
+            SELECT DISTINCT patient_id, 1 FROM patients_treatment WHERE patient_id IS NOT NULL
+            ON CONFLICT(patient_id) DO UPDATE SET version = version + 1""")
+    for resource, source, scope in RESOURCE_VERSIONS:
+        if source == table:
+            scope = scope.format(row=table)
+            conn.execute(f"""INSERT INTO resource_versions (resource, scope, version, changed_at)
+                SELECT DISTINCT '{resource}', {scope}, 1, (julianday('now') - 2440587.5) * 86400.0
+                FROM {table} WHERE {scope} IS NOT NULL
+                ON CONFLICT(resource, scope) DO UPDATE SET version = version + 1, changed_at = excluded.changed_at""")
 
-    messages_df = pd.read_csv("data/patient_to_doctor_message (1).csv")
-    messages_df.to_sql("messages", conn, if_exists="replace", index=False)
+# CSV exports loaded at startup: (table, file under data/, columns to load or None for all)
+CSV_TABLES = (
+    ("patients", "patients_registration (1).csv", ["id", "uuid", "Age", "Gender", "FName", "LName", "EmailId", "password"]),
+    ("patient_doctor", "patient_doctor (1).csv", None),
+    ("online_patients", "online_patients (1).csv", None),
+    ("messages", "patient_to_doctor_message (1).csv", None),
+    ("patients_treatment", "patients_treatment (1).csv", None),
+)
 
-    treatments_df = pd.read_csv("data/patients_treatment (1).csv")
-    treatments_df.to_sql("patients_treatment", conn, if_exists="replace", index=False)
+# "incremental" re-imports only changed CSVs, "full" re-imports all of them, "skip" does neither
+INIT_MODE = os.environ.get("EHOSPITAL_INIT_MODE", "incremental")
 
+# Older versions loaded tables with pandas' to_sql, which drops primary keys.
+# Rebuild such a table with its real schema so rows can be upserted by id.
+def _ensure_primary_key(conn, table, schema):
+    info = conn.execute(f"PRAGMA table_info({table})").fetchall()
+    if not info or any(row[5] for row in info):
+        return
+    conn.execute("BEGIN")
+    conn.execute(f"ALTER TABLE {table} RENAME TO {table}_old")
+    conn.execute(schema)
+    new_columns = {row[1].lower() for row in conn.execute(f"PRAGMA table_info({table})")}
+    columns = ", ".join(row[1] for row in info if row[1].lower() in new_columns)
+    conn.execute(f"INSERT OR REPLACE INTO {table} ({columns}) SELECT {columns} FROM {table}_old ORDER BY rowid")
+    conn.execute(f"DROP TABLE {table}_old")
     conn.commit()
-    conn.close()
+
+# Function to initialize the database and load CSV data. Runs under a lock
+# file next to the database, so server processes started together take turns
+# and the later ones find the CSVs already imported.
+def init_db(mode=INIT_MODE, database=DATABASE, data_dir="data"):
+    if mode == "skip":
+        return
+    with file_lock(f"{database}.init-lock"):
+        _init_db(mode, database, data_dir)
+
+def _init_db(mode, database, data_dir):
+    # Only needed by processes that initialize
+    from bulk_load import repair_interrupted
+    from csv_import import import_changed_csvs
+    from inbox import build_inbox
+    start = time.perf_counter()
+    conn = sqlite3.connect(database)
+    try:
+        # Create tables if they don’t exist
+        for table, schema in TABLE_SCHEMAS.items():
+            _ensure_primary_key(conn, table, schema)
+            conn.execute(schema)
+        for statement in INDEXES + TRIGGERS:
+            conn.execute(statement)
+        conn.commit()
+        for table, rows, rebuilt in repair_interrupted(conn):
+            logger.warning("init_db: the bulk load of %s was interrupted after %s rows; restored its indexes and "
+                           "triggers and rebuilt %s. Run bulk_load.py --resume to finish it",
+                           table, rows, ", ".join(rebuilt) or "nothing")
+
+        # Load CSV data into tables, skipping files that have not changed
+        tables = [(table, os.path.join(data_dir, name), columns) for table, name, columns in CSV_TABLES]
+        for table, status, rows, seconds in import_changed_csvs(conn, tables, force=(mode == "full")):
+            logger.info("init_db: %s %s, %s rows in %.1f ms", table, status, rows, seconds * 1000)
+
+        # Built after the first import, so a new database indexes its rows in one pass
+        for index, seconds in build_search_index(conn):
+            logger.info("init_db: built %s in %.1f ms", index, seconds * 1000)
+        seconds = build_inbox(conn)
+        if seconds is not None:
+            logger.info("init_db: built message_threads in %.1f ms", seconds * 1000)
+        build_mirror(conn)
+    finally:
+        conn.close()
+    logger.info("init_db: done in %.1f ms (%s)", (time.perf_counter() - start) * 1000, mode)
 
 # Function to verify patient
+@timed("verify_patient")
 def verify_patient(email, password):
-    conn = sqlite3.connect("database.db")
-    cursor = conn.cursor()
-    cursor.execute("SELECT id, FName FROM patients WHERE EmailId = ? AND password = ?", (email, password))
-    result = cursor.fetchone()
-    conn.close()
-    return result  # Returns (id, FName) or None
+    result = query_one("SELECT id, FName FROM patients WHERE EmailId = ? AND password = ?", (email, password))
+    return tuple(result) if result else None  # Returns (id, FName) or None
+
+# Treatment history text from (treatment, RecordDate, disease_type) rows, newest first,
+# one line at a time, for replies streamed while they are formatted
+def iter_treatments(results, language="english"):
+    if not results:
+        yield "No treatment records found." if language == "english" else "No treatment history found."
+        return
+    yield "Your treatments:"
+    for treatment, date, disease in results:
+        if treatment and treatment.strip():
+            line = f"\n- Date: {date}, Treatment: {treatment}"
+            if disease and disease.strip():
+                line += f", Disease: {disease}"
+            yield line
+
+def format_treatments(results, language="english"):
+    return "".join(iter_treatments(results, language)).strip()
+
+def format_test_result(result, test_type, language="english"):
+    if result:
+        treatment, date = result
+        return f"Latest {test_type} result: {treatment} (Date: {date})"
+    return f"No {test_type} results found."
+
+def format_blood_pressure(result, language="english"):
+    if result:
+        treatment, date = result
+        return f"Latest blood pressure: {treatment} (Date: {date})"
+    return "No blood pressure records found."
+
+TREATMENT_HISTORY_SQL = (
+    "SELECT treatment, RecordDate, disease_type FROM patients_treatment "
+    "WHERE patient_id = ? ORDER BY RecordDate DESC"
+)
 
 # Function to get treatment information
+@timed("get_treatment_info")
+@cached_by_patient("treatment")
 def get_treatment_info(patient_id, language="english"):
-    conn = sqlite3.connect("database.db")
-    cursor = conn.cursor()
-    cursor.execute("SELECT treatment, RecordDate, disease_type FROM patients_treatment WHERE patient_id = ? ORDER BY RecordDate DESC", (patient_id,))
-    results = cursor.fetchall()
-    conn.close()
-    
-    if results:
-        if language == "persian":
-            response = "Your treatments:\n"
-            for treatment, date, disease in results:
-                if treatment and treatment.strip():
-                    response += f"- Date: {date}, Treatment: {treatment}"
-                    if disease and disease.strip():
-                        response += f", Disease: {disease}"
-                    response += "\n"
-            return response.strip()
-        else:
-            response = "Your treatments:\n"
-            for treatment, date, disease in results:
-                if treatment and treatment.strip():
-                    response += f"- Date: {date}, Treatment: {treatment}"
-                    if disease and disease.strip():
-                        response += f", Disease: {disease}"
-                    response += "\n"
-            return response.strip()
-    return "No treatment records found." if language == "english" else "No treatment history found."
+    results = query_all(TREATMENT_HISTORY_SQL, (patient_id,))
+    return format_treatments(results, language)
+
+# Treatment information as chunks; the rows are read before the first one is produced
+def iter_treatment_info(patient_id, language="english"):
+    return iter_treatments(query_all(TREATMENT_HISTORY_SQL, (patient_id,)), language)
+
+# A patient's treatment history, newest first. The few rows come from the
+# patient index and are matched in English or Persian by search.latest_matching;
+# the full-text index is for searching across all patients.
+PATIENT_TREATMENTS_SQL = "SELECT treatment, RecordDate FROM patients_treatment WHERE patient_id = ? ORDER BY RecordDate DESC"
 
 # Function to get test results
+@timed("get_test_results")
+@cached_by_patient("test_results")
 def get_test_results(patient_id, test_type, language="english"):
-    conn = sqlite3.connect("database.db")
-    cursor = conn.cursor()
-    cursor.execute("SELECT treatment, RecordDate FROM patients_treatment WHERE patient_id = ? AND treatment LIKE ? ORDER BY RecordDate DESC LIMIT 1", 
-                   (patient_id, f"%{test_type}%"))
-    result = cursor.fetchone()
-    conn.close()
-    
-    if result:
-        treatment, date = result
-        if language == "persian":
-            return f"Latest {test_type} result: {treatment} (Date: {date})"
-        else:
-            return f"Latest {test_type} result: {treatment} (Date: {date})"
-    return f"No {test_type} results found." if language == "english" else f"No {test_type} results found."
+    rows = query_all(PATIENT_TREATMENTS_SQL, (patient_id,))
+    return format_test_result(latest_matching(rows, test_type), test_type, language)
 
 # Function to get the latest blood pressure
+@timed("get_blood_pressure")
+@cached_by_patient("blood_pressure")
 def get_blood_pressure(patient_id, language="english"):
-    conn = sqlite3.connect("database.db")
-    cursor = conn.cursor()
-    cursor.execute("""
-        SELECT treatment, RecordDate 
-        FROM patients_treatment 
-        WHERE patient_id = ? AND treatment LIKE '%Blood Pressure%' 
-        ORDER BY RecordDate DESC 
-        LIMIT 1
-    """, (patient_id,))
-    result = cursor.fetchone()
-    conn.close()
-    
-    if result:
-        treatment, date = result
-        if language == "persian":
-            return f"Latest blood pressure: {treatment} (Date: {date})"
-        else:
-            return f"Latest blood pressure: {treatment} (Date: {date})"
-    return "No blood pressure records found." if language == "english" else "No blood pressure records found."
+    rows = query_all(PATIENT_TREATMENTS_SQL, (patient_id,))
+    return format_blood_pressure(latest_matching(rows, "blood pressure"), language)
+
+# Latest blood sugar text from a blood_sugar_analysis record (None if the patient has none)
+def format_blood_sugar(latest_record, language="english"):
+    if latest_record is not None:
+        blood_sugar = latest_record.get("blood_sugar", "No value recorded")
+        date = latest_record.get("date", "Unknown date")
+        return f"Latest blood sugar: {blood_sugar} (Date: {date})"
+    return "No blood sugar records found."
 
 # Function to get the latest blood sugar from the API
-def get_latest_blood_sugar(patient_id, language="english"):
-    url = "https://e-react-node-backend-22ed6864d5f3.herokuapp.com/table/blood_sugar_analysis"
+@timed("get_latest_blood_sugar")
+async def get_latest_blood_sugar(patient_id, language="english"):
     try:
-        response = requests.get(url)
-        if response.status_code == 200:
-            data = response.json()
-            patient_records = [record for record in data if record.get("patient_id") == patient_id]
-            if patient_records:
-                latest_record = patient_records[-1]
-                blood_sugar = latest_record.get("blood_sugar", "No value recorded" if language == "english" else "No value recorded")
-                date = latest_record.get("date", "Unknown date" if language == "english" else "Unknown date")
-                if language == "persian":
-                    return f"Latest blood sugar: {blood_sugar} (Date: {date})"
-                else:
-                    return f"Latest blood sugar: {blood_sugar} (Date: {date})"
-            return "No blood sugar records found." if language == "english" else "No blood sugar records found."
-        else:
-            return f"Server connection error: {response.status_code}" if language == "english" else f"Server connection error: {response.status_code}"
+        latest_record = await latest_remote_record("blood_sugar_analysis", patient_id)
+        return format_blood_sugar(latest_record, language)
+    except RemoteTableError as e:
+        return f"Server connection error: {e.status_code}"
     except Exception as e:
-        return f"Error fetching data: {str(e)}" if language == "english" else f"Error fetching data: {str(e)}"
+        return f"Error fetching data: {str(e)}"
+
+# Display names of the heart_disease_test fields (Persian, English)
+HEART_DISEASE_FIELDS = {
+    "patient_id": ("Patient ID", "Patient ID"),
+    "education": ("Education", "Education"),
+    "currentSmoker": ("Current Smoker", "Current Smoker"),
+    "cigsPerDay": ("Cigarettes per Day", "Cigarettes per Day"),
+    "BPMeds": ("Blood Pressure Medication", "Blood Pressure Medication"),
+    "prevalentStroke": ("Prevalent Stroke", "Prevalent Stroke"),
+    "prevalentHyp": ("Prevalent Hypertension", "Prevalent Hypertension"),
+    "diabetes": ("Diabetes", "Diabetes"),
+    "BMI": ("BMI", "BMI"),
+    "totChol": ("Total Cholesterol", "Total Cholesterol"),
+    "sysBP": ("Systolic BP", "Systolic BP"),
+    "diaBP": ("Diastolic BP", "Diastolic BP"),
+    "heartRate": ("Heart Rate", "Heart Rate"),
+    "glucose": ("Glucose", "Glucose"),
+    "test_time": ("Test Time", "Test Time"),
+    "CHD": ("Coronary Heart Disease", "Coronary Heart Disease")
+}
+
+# One field of a heart_disease_test record as text (None if the patient has none)
+def format_heart_disease(latest_record, field, language="english"):
+    if latest_record is not None:
+        value = latest_record.get(field, "No value recorded")
+        persian_name, english_name = HEART_DISEASE_FIELDS.get(field, (field, field))
+        return f"{persian_name}: {value}" if language == "persian" else f"{english_name}: {value}"
+    return "No records found."
 
 # Function to get data from heart_disease_test API
-def get_heart_disease_data(patient_id, field, language="english"):
-    url = "https://e-react-node-backend-22ed6864d5f3.herokuapp.com/table/heart_disease_test"
+@timed("get_heart_disease_data")
+async def get_heart_disease_data(patient_id, field, language="english"):
     try:
-        response = requests.get(url)
-        if response.status_code == 200:
-            data = response.json()
-            patient_records = [record for record in data if record.get("patient_id") == patient_id]
-            if patient_records:
-                latest_record = patient_records[-1]
-                value = latest_record.get(field, "No value recorded" if language == "english" else "No value recorded")
-                field_names = {
-                    "patient_id": ("Patient ID", "Patient ID"),
-                    "education": ("Education", "Education"),
-                    "currentSmoker": ("Current Smoker", "Current Smoker"),
-                    "cigsPerDay": ("Cigarettes per Day", "Cigarettes per Day"),
-                    "BPMeds": ("Blood Pressure Medication", "Blood Pressure Medication"),
-                    "prevalentStroke": ("Prevalent Stroke", "Prevalent Stroke"),
-                    "prevalentHyp": ("Prevalent Hypertension", "Prevalent Hypertension"),
-                    "diabetes": ("Diabetes", "Diabetes"),
-                    "BMI": ("BMI", "BMI"),
-                    "totChol": ("Total Cholesterol", "Total Cholesterol"),
-                    "sysBP": ("Systolic BP", "Systolic BP"),
-                    "diaBP": ("Diastolic BP", "Diastolic BP"),
-                    "heartRate": ("Heart Rate", "Heart Rate"),
-                    "glucose": ("Glucose", "Glucose"),
-                    "test_time": ("Test Time", "Test Time"),
-                    "CHD": ("Coronary Heart Disease", "Coronary Heart Disease")
-                }
-                persian_name, english_name = field_names.get(field, (field, field))
-                if language == "persian":
-                    return f"{persian_name}: {value}"
-                else:
-                    return f"{english_name}: {value}"
-            return "No records found." if language == "english" else "No records found."
-        else:
-            return f"Server connection error: {response.status_code}" if language == "english" else f"Server connection error: {response.status_code}"
+        latest_record = await latest_remote_record("heart_disease_test", patient_id)
+        return format_heart_disease(latest_record, field, language)
+    except RemoteTableError as e:
+        return f"Server connection error: {e.status_code}"
     except Exception as e:
-        return f"Error fetching data: {str(e)}" if language == "english" else f"Error fetching data: {str(e)}"
-
-# Function to recognize speech
-def recognize_speech():
-    recognizer = sr.Recognizer()
-    with sr.Microphone() as source:
-        print("Listening... Say something!")
-        audio = recognizer.listen(source, timeout=5)
-    try:
-        text = recognizer.recognize_google(audio)
-        print(f"You said: {text}")
-        return text.lower()
-    except sr.WaitTimeoutError:
-        print("No speech detected. Please try again.")
-        return ""
-    except sr.UnknownValueError:
-        print("Could not understand audio. Please try again.")
-        return ""
-    except sr.RequestError as e:
-        print(f"Could not request results; {e}")
-        return ""
-
-# Function to convert text to speech
+        return f"Error fetching data: {str(e)}"
+
+# Function to convert text to speech in the background; returns the audio id
+@timed("text_to_speech")
 def text_to_speech(text):
-    engine = pyttsx3.init()
-    engine.say(text)
-    engine.runAndWait()
\ No newline at end of file
+    return speech_worker.submit(text)
\ No newline at end of file